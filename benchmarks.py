@@ -0,0 +1,590 @@
+##################################################
+# BENCHMARKS
+##################################################
+#
+# Run with e.g.
+#
+#   python benchmarks.py nearest --scales 10000,100000,1000000,10000000
+#   python benchmarks.py suite --thresholds benchmark_thresholds.json
+#   python benchmarks.py startup --runs 20
+#   python benchmarks.py concurrency --clients 1,10,50,200
+#
+# The database defaults to a throwaway SQLite file; point --database at a
+# local Postgres (postgresql://localhost/latitune_bench) for realistic numbers.
+#
+# `suite` seeds every model and drives every route with a weighted mix of
+# requests, reporting latency, queries per request and memory. With
+# --thresholds it exits non-zero when a route is slower or makes more
+# queries than the checked-in file allows; --write-thresholds regenerates
+# that file from the current run.
+
+import os
+import sys
+import time
+import math
+import random
+import argparse
+import resource
+import socket
+import urllib2
+import threading
+import tempfile
+import subprocess
+import json
+from datetime import datetime, timedelta
+
+DEFAULT_DATABASE = "sqlite:////tmp/latitune_bench.db"
+SEED_CHUNK       = 50000
+
+# Blips cluster around a handful of metro areas, with some global noise
+METROS = [(40.71, -74.00), (51.51, -0.13), (35.68, 139.69),
+          (37.77, -122.42), (-33.87, 151.21), (48.86, 2.35)]
+
+def bench_env(database):
+  """The environment the app is benchmarked in"""
+  env = dict(os.environ, DATABASE_URL=database)
+  env.setdefault('LATITUNE_SECRET_KEY', 'latitune benchmarks')
+  env.setdefault('LATITUNE_METRICS_TOKEN', 'latitune benchmarks')
+  return env
+
+def load_app(database):
+  os.environ.update(bench_env(database))
+  import latitune
+  latitune.create_app()
+  return latitune
+
+def random_point(rng):
+  if rng.random() < 0.8:
+    lat, lng = rng.choice(METROS)
+    return (max(-90.0, min(90.0, rng.gauss(lat, 0.5))),
+            (rng.gauss(lng, 0.5) + 180.0) % 360.0 - 180.0)
+  return rng.uniform(-90.0, 90.0), rng.uniform(-180.0, 180.0)
+
+def percentile(samples, pct):
+  ordered = sorted(samples)
+  return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+
+def report(label, samples):
+  print("%-28s p50 %8.2fms  p99 %8.2fms" % (label,
+        percentile(samples, 50) * 1000, percentile(samples, 99) * 1000))
+
+def seed_blips(latitune, count, rng):
+  """Grow the blip table to `count` rows with synthetic points"""
+  table = latitune.Blip.__table__
+  existing = latitune.Blip.query.count()
+  while existing < count:
+    rows = []
+    for i in range(min(SEED_CHUNK, count - existing)):
+      lat, lng = random_point(rng)
+      rows.append(latitune.Blip.row(1, 1, lng, lat))
+    latitune.db.session.execute(table.insert(), rows)
+    latitune.db.session.commit()
+    existing += len(rows)
+
+def bench_nearest(args):
+  latitune = load_app(args.database)
+  latitune.db.drop_all()
+  latitune.db.create_all()
+  rng = random.Random(args.seed)
+  for scale in sorted(int(s) for s in args.scales.split(",")):
+    seed_blips(latitune, scale, rng)
+    samples = []
+    for i in range(args.queries):
+      lat, lng = random_point(rng)
+      start = time.time()
+      latitune.Blip.nearest(lat, lng)
+      samples.append(time.time() - start)
+      latitune.db.session.remove()
+    report("nearest @ %d blips" % scale, samples)
+
+def bench_engines(args):
+  """GET /api/blip nearest and radius lookups through the SQL path and the
+  in-memory NumPy engine (NEAREST_ENGINE)"""
+  latitune = load_app(args.database)
+  import nearest
+  if nearest.numpy is None:
+    sys.exit("the memory engine needs NumPy")
+  latitune.db.drop_all()
+  latitune.db.create_all()
+  latitune.app.config['RESPONSE_CACHE_ENABLED'] = False
+  rng = random.Random(args.seed)
+  client = latitune.app.test_client()
+  for scale in sorted(int(s) for s in args.scales.split(",")):
+    seed_blips(latitune, scale, rng)
+    points = [random_point(rng) for i in range(args.queries)]
+    for engine in ["sql", "memory"]:
+      latitune.app.config['NEAREST_ENGINE'] = engine
+      nearest.index = None
+      client.get("/api/blip?latitude=0&longitude=0")
+      for label, query in [("nearest", "latitude=%r&longitude=%r"),
+                           ("radius", "latitude=%r&longitude=%r&radius=" + str(args.radius))]:
+        samples = []
+        for lat, lng in points:
+          start = time.time()
+          client.get("/api/blip?" + query % (lat, lng))
+          samples.append(time.time() - start)
+        report("%s %s @ %d blips" % (engine, label, scale), samples)
+
+def bench_ingest(args):
+  """Blips/second through PUT /api/blip one at a time vs PUT /api/blip/batch"""
+  latitune = load_app(args.database)
+  latitune.db.drop_all()
+  latitune.db.create_all()
+  rng = random.Random(args.seed)
+  user = latitune.User("bench", "bench@example.com", "benchpass")
+  song = latitune.Song("Artist", "Title", "SOBENCH")
+  # Resolved, so the provider sweep does not look it up
+  song.provider_status = latitune.Song.RESOLVED
+  latitune.db.session.add_all([user, song])
+  latitune.db.session.commit()
+  user_id, song_id = user.id, song.id
+  client = latitune.app.test_client()
+
+  start = time.time()
+  for i in range(args.count):
+    lat, lng = random_point(rng)
+    client.put("/api/blip", data=dict(song_id=song_id, user_id=user_id, password="benchpass",
+                                      latitude=lat, longitude=lng))
+  single = args.count / (time.time() - start)
+
+  start = time.time()
+  for offset in range(0, args.count, args.batch):
+    blips = [dict(zip(["latitude", "longitude"], random_point(rng)), song_id=song_id)
+             for i in range(min(args.batch, args.count - offset))]
+    client.put("/api/blip/batch", data=dict(user_id=user_id, password="benchpass",
+                                            blips=json.dumps(blips)))
+  batched = args.count / (time.time() - start)
+
+  print("%-28s %10.1f blips/s" % ("PUT /api/blip", single))
+  print("%-28s %10.1f blips/s (%.1fx)" % ("PUT /api/blip/batch", batched, batched / single))
+
+  # Blips in one region share their coarse tiles, whose locks serialize
+  # the writes; spread over the globe they mostly do not
+  if args.writers > 1:
+    lat, lng = METROS[0]
+    for label, point in [("spread", lambda rng: (rng.uniform(-60.0, 70.0), rng.uniform(-180.0, 180.0))),
+                         ("one region", lambda rng: (rng.gauss(lat, 0.5), rng.gauss(lng, 0.5)))]:
+      rate = ingest_concurrently(latitune, user_id, song_id, args.writers, args.count, point, args.seed)
+      print("%-28s %10.1f blips/s" % ("PUT /api/blip x%d %s" % (args.writers, label), rate))
+
+def ingest_concurrently(latitune, user_id, song_id, writers, count, point, seed):
+  """Blips/second of `writers` threads creating `count` blips between them
+  one at a time, at points drawn by point(rng)"""
+  def writer(n):
+    client = latitune.app.test_client()
+    rng = random.Random(seed + n)
+    for i in range(count // writers):
+      lat, lng = point(rng)
+      client.put("/api/blip", data=dict(song_id=song_id, user_id=user_id, password="benchpass",
+                                        latitude=lat, longitude=lng))
+  threads = [threading.Thread(target=writer, args=(n,)) for n in range(writers)]
+  start = time.time()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return (count // writers) * writers / (time.time() - start)
+
+##################################################
+# WORKER STARTUP
+##################################################
+
+# Run in a fresh interpreter per sample; prints the phases in seconds
+STARTUP_SCRIPT = """
+import json, time
+start = time.time()
+import latitune
+imported = time.time()
+app = latitune.create_app()
+created = time.time()
+latitune.db.create_all()
+client = app.test_client()
+began = time.time()
+client.get("/api/blip?id=1")
+print json.dumps({"import": imported - start, "create_app": created - imported,
+                  "first request": time.time() - began})
+"""
+
+def bench_startup(args):
+  """Time to boot a worker: interpreter start, importing latitune,
+  create_app, and serving the first request"""
+  samples = dict((phase, []) for phase in ["process", "import", "create_app", "first request"])
+  env = bench_env(args.database)
+  for i in range(args.runs):
+    start = time.time()
+    output = subprocess.check_output([sys.executable, "-c", STARTUP_SCRIPT], env=env,
+                                     cwd=os.path.dirname(os.path.abspath(__file__)))
+    samples["process"].append(time.time() - start)
+    for phase, elapsed in json.loads(output.strip().splitlines()[-1]).items():
+      samples[phase].append(elapsed)
+  for phase in ["import", "create_app", "first request", "process"]:
+    report(phase, samples[phase])
+
+##################################################
+# CONCURRENCY
+##################################################
+
+def wait_for_port(port, server, timeout=30.0):
+  """Wait until something listens on `port`, or the server process exits"""
+  deadline = time.time() + timeout
+  while time.time() < deadline and server.poll() is None:
+    try:
+      socket.create_connection(("127.0.0.1", port), 1.0).close()
+      return
+    except socket.error:
+      time.sleep(0.1)
+  if server.poll() is None:
+    sys.exit("server did not start on port %d" % port)
+
+def drive(url, clients, duration, timeout):
+  """Latencies and error count of `clients` threads requesting `url` in a
+  loop for `duration` seconds"""
+  latencies, errors = [], [0]
+  lock = threading.Lock()
+  deadline = time.time() + duration
+  def client():
+    while time.time() < deadline:
+      start = time.time()
+      try:
+        urllib2.urlopen(url, timeout=timeout).read()
+      except (urllib2.URLError, socket.error):
+        with lock:
+          errors[0] += 1
+        continue
+      with lock:
+        latencies.append(time.time() - start)
+  threads = [threading.Thread(target=client) for i in range(clients)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return latencies, errors[0]
+
+def bench_concurrency(args):
+  """Throughput and latency of serve.py in threaded and gevent mode as
+  concurrent clients are added. The SQLite default shows the CPU-bound
+  case; against Postgres (with psycogreen) gevent overlaps the DB waits."""
+  latitune = load_app(args.database)
+  latitune.db.drop_all()
+  latitune.db.create_all()
+  rng = random.Random(args.seed)
+  seed_blips(latitune, args.blips, rng)
+  latitune.db.session.remove()
+  env = bench_env(args.database)
+  here = os.path.dirname(os.path.abspath(__file__))
+  for mode in ["threaded", "gevent"]:
+    # The server's request log goes to a file; a pipe nobody reads would fill up and stall it
+    log = tempfile.TemporaryFile()
+    server = subprocess.Popen([sys.executable, os.path.join(here, "serve.py"), "--mode", mode,
+                               "--host", "127.0.0.1", "--port", str(args.port)],
+                              env=env, cwd=here, stdout=log, stderr=subprocess.STDOUT)
+    try:
+      wait_for_port(args.port, server)
+      if server.poll() is not None:
+        log.seek(0)
+        print("%s: %s" % (mode, log.read().strip().splitlines()[-1]))
+        continue
+      url = "http://127.0.0.1:%d%s" % (args.port, args.path)
+      for clients in sorted(int(c) for c in args.clients.split(",")):
+        latencies, errors = drive(url, clients, args.duration, args.timeout)
+        if latencies:
+          print("%-9s %5d clients %8.1f req/s  p50 %8.2fms  p99 %8.2fms  errors %d" % (
+            mode, clients, len(latencies) / args.duration, percentile(latencies, 50) * 1000,
+            percentile(latencies, 99) * 1000, errors))
+        else:
+          print("%-9s %5d clients  no successful requests, errors %d" % (mode, clients, errors))
+    finally:
+      if server.poll() is None:
+        server.terminate()
+      server.wait()
+      log.close()
+
+##################################################
+# API SUITE
+##################################################
+
+SUITE_PASSWORD = "benchpass"
+
+# Thresholds written by --write-thresholds leave this much room; p99s of
+# the rarer routes come from few samples, hence the absolute slack
+LATENCY_HEADROOM = 2.0
+LATENCY_SLACK_MS = 25.0
+QUERY_HEADROOM   = 1.25
+MEMORY_HEADROOM  = 1.5
+
+class OfflineEchoNest(object):
+  """Stands in for pyechonest.song so PUT /api/song never leaves the box"""
+
+  class Song(object):
+    def __init__(self, id):
+      self.id = id
+
+    def get_tracks(self, catalog):
+      return [{"foreign_id": "%s:track:%s" % (catalog, self.id)}]
+
+  def profile(self, ids, buckets):
+    return [self.Song(echonest_id) for echonest_id in ids]
+
+def insert(latitune, model, rows):
+  """executemany `rows` into the model's table SEED_CHUNK at a time"""
+  chunk = []
+  for row in rows:
+    chunk.append(row)
+    if len(chunk) == SEED_CHUNK:
+      latitune.db.session.execute(model.__table__.insert(), chunk)
+      chunk = []
+  if chunk:
+    latitune.db.session.execute(model.__table__.insert(), chunk)
+  latitune.db.session.commit()
+
+def seed_graph(latitune, args, rng):
+  """Users, songs with providers, blips spread over the last week, comments
+  and favorites, plus the counters and tiles derived from them"""
+  pw_hash = latitune.User("seed", "seed", SUITE_PASSWORD).pw_hash
+  insert(latitune, latitune.User, ({'name': 'user%d' % i, 'email': 'user%d@example.com' % i,
+                                    'pw_hash': pw_hash} for i in xrange(args.users)))
+  insert(latitune, latitune.Song, ({'artist': 'Artist %d' % (i // 10), 'title': 'Title %d' % i,
+                                    'album': '', 'echonestID': 'SOBENCH%d' % i,
+                                    'provider_status': latitune.Song.RESOLVED} for i in xrange(args.songs)))
+  insert(latitune, latitune.SongProvider, ({'song_id': i // 2 + 1, 'provider': ["Rdio", "Spotify"][i % 2],
+                                            'provider_key': 't%d' % i} for i in xrange(2 * args.songs)))
+  now = datetime.now()
+  def blips():
+    for i in xrange(args.blips):
+      lat, lng = random_point(rng)
+      row = latitune.Blip.row(rng.randint(1, args.songs), rng.randint(1, args.users), lng, lat)
+      row['timestamp'] = now - timedelta(seconds=rng.uniform(0, 7 * 24 * 3600))
+      row['day'] = row['timestamp'].toordinal()
+      yield row
+  insert(latitune, latitune.Blip, blips())
+  insert(latitune, latitune.Comment, ({'blip_id': rng.randint(1, args.blips), 'user_id': rng.randint(1, args.users),
+                                       'comment': 'comment %d' % i, 'timestamp': now} for i in xrange(args.comments)))
+  favorites = set()
+  while len(favorites) < min(args.favorites, args.users * args.blips):
+    favorites.add((rng.randint(1, args.users), rng.randint(1, args.blips)))
+  insert(latitune, latitune.Favorite, ({'user_id': user_id, 'blip_id': blip_id} for user_id, blip_id in favorites))
+  latitune.Blip.reconcile_counts()
+  import tiles
+  tiles.rebuild()
+  return sorted(favorites)
+
+def route_mix(latitune, args, favorites):
+  """[(weight, label, request)] where request(client, rng) makes one request.
+  Unfavorites take from `favorites`, the seeded (user_id, blip_id) pairs."""
+  users   = args.users
+  tokens  = dict((user.id, user.issue_token(24 * 3600)[0]) for user in latitune.User.query)
+  created = {'users': 0}
+
+  def auth(rng, **fields):
+    user_id = rng.randint(1, users)
+    if rng.random() < 0.8:
+      return dict(fields, user_id=user_id, token=tokens[user_id])
+    return dict(fields, user_id=user_id, password=SUITE_PASSWORD)
+
+  def new_user(client, rng):
+    created['users'] += 1
+    return client.put("/api/user", data=dict(username="new%d" % created['users'], password=SUITE_PASSWORD,
+                                             email="new%d@example.com" % created['users']))
+
+  def new_song(rng):
+    title = "Title %d" % rng.randint(1, 2 * args.songs)
+    return {'artist': 'Artist %d' % rng.randint(1, args.songs // 10 + 1), 'title': title,
+            'echonest_id': 'SOBENCH' + title[6:], 'album': ''}
+
+  def unfavorite(client, rng):
+    user_id, blip_id = favorites.pop(rng.randrange(len(favorites)))
+    return client.delete("/api/blip/favorite", query_string=dict(user_id=user_id, blip_id=blip_id,
+                                                                 token=tokens[user_id]))
+
+  def stream(client, rng):
+    """The last ~1000 blips through GET /api/blip?stream=true, read to the end"""
+    response = client.get("/api/blip?stream=true&cursor=%d" % max(0, args.blips - 1000))
+    response.data
+    return response
+
+  def live(client, rng):
+    """Subscribe, read the blips since an id near the end, and hang up"""
+    response = client.get("/api/blip/live?latitude=%r&longitude=%r&radius=50&last_event_id=%d" % (
+      random_point(rng) + (max(0, args.blips - 100),)))
+    for chunk in response.response:
+      if chunk.startswith(": keepalive"):
+        break
+    response.close()
+    return response
+
+  blip = lambda rng: rng.randint(1, args.blips)
+  metrics = dict(metrics_token=latitune.app.config['METRICS_TOKEN'])
+  return [
+    (20, "GET /api/blip nearest",   lambda c, rng: c.get("/api/blip?latitude=%r&longitude=%r" % random_point(rng))),
+    (8,  "GET /api/blip radius",    lambda c, rng: c.get("/api/blip?latitude=%r&longitude=%r&radius=10" % random_point(rng))),
+    (6,  "GET /api/blip bbox",      lambda c, rng: c.get("/api/blip?south=%r&west=%r&north=%r&east=%r" % (
+                                      lambda lat, lng: (lat - 0.5, lng - 0.5, lat + 0.5, lng + 0.5))(*random_point(rng)))),
+    (10, "GET /api/blip feed",      lambda c, rng: c.get("/api/blip?latitude=%r&longitude=%r&hours=24" % random_point(rng))),
+    (10, "GET /api/blip id",        lambda c, rng: c.get("/api/blip?id=%d" % blip(rng))),
+    (3,  "GET /api/blip list",      lambda c, rng: c.get("/api/blip?cursor=%d" % blip(rng))),
+    (1,  "GET /api/blip stream",    stream),
+    (2,  "GET /api/blip/live",      live),
+    (5,  "GET /api/tiles",          lambda c, rng: c.get("/api/tiles?south=%r&west=%r&north=%r&east=%r" % (
+                                      lambda lat, lng: (lat - 10, lng - 10, lat + 10, lng + 10))(*random_point(rng)))),
+    (8,  "GET /api/blip/comment blip_id", lambda c, rng: c.get("/api/blip/comment?blip_id=%d" % blip(rng))),
+    (2,  "GET /api/blip/comment id", lambda c, rng: c.get("/api/blip/comment?id=%d" % rng.randint(1, args.comments))),
+    (5,  "GET /api/blip/favorite blip_id", lambda c, rng: c.get("/api/blip/favorite?blip_id=%d" % blip(rng))),
+    (5,  "GET /api/blip/favorite user_id", lambda c, rng: c.get("/api/blip/favorite?user_id=%d" % rng.randint(1, users))),
+    (3,  "GET /api/song",           lambda c, rng: c.get("/api/song?id=%d" % rng.randint(1, args.songs))),
+    (2,  "GET /api/user",           lambda c, rng: c.get("/api/user", query_string=auth(rng, username="user%d" % rng.randint(0, users - 1)))),
+    (5,  "PUT /api/blip",           lambda c, rng: c.put("/api/blip", data=auth(rng, song_id=rng.randint(1, args.songs),
+                                      **dict(zip(["latitude", "longitude"], random_point(rng)))))),
+    (1,  "PUT /api/blip/batch",     lambda c, rng: c.put("/api/blip/batch", data=auth(rng, blips=json.dumps([
+                                      dict(zip(["latitude", "longitude"], random_point(rng)), song_id=rng.randint(1, args.songs))
+                                      for i in range(50)])))),
+    (3,  "PUT /api/blip/comment",   lambda c, rng: c.put("/api/blip/comment", data=auth(rng, blip_id=blip(rng), comment="nice"))),
+    (3,  "PUT /api/blip/favorite",  lambda c, rng: c.put("/api/blip/favorite", data=auth(rng, blip_id=blip(rng)))),
+    (2,  "DELETE /api/blip/favorite", unfavorite),
+    (1,  "PUT /api/song",           lambda c, rng: c.put("/api/song", data=new_song(rng))),
+    (1,  "PUT /api/song/batch",     lambda c, rng: c.put("/api/song/batch", data=dict(songs=json.dumps([new_song(rng) for i in range(20)])))),
+    (1,  "PUT /api/user",           new_user),
+    (1,  "PUT /api/user/token",     lambda c, rng: c.put("/api/user/token", data=dict(user_id=rng.randint(1, users), password=SUITE_PASSWORD))),
+    (1,  "GET /api/cache/stats",    lambda c, rng: c.get("/api/cache/stats")),
+    (1,  "GET /api/metrics",        lambda c, rng: c.get("/api/metrics", query_string=metrics)),
+    (1,  "GET /api/metrics/profile", lambda c, rng: c.get("/api/metrics/profile", query_string=metrics)),
+  ]
+
+def rss_mb():
+  """Peak resident set size of this process (ru_maxrss is in KB on Linux)"""
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def bench_suite(args):
+  latitune = load_app(args.database)
+  import providers
+  from sqlalchemy import event
+  latitune.db.drop_all()
+  latitune.db.create_all()
+  latitune.app.config['JOBS_EAGER'] = True
+  # Live streams are read up to their first keepalive
+  latitune.app.config['LIVE_KEEPALIVE'] = 0.001
+  providers.client = OfflineEchoNest()
+  rng = random.Random(args.seed)
+
+  start = time.time()
+  favorites = seed_graph(latitune, args, rng)
+  print("seeded %d users, %d songs, %d blips, %d comments, %d favorites in %.1fs (rss %.0fMB)" % (
+    args.users, args.songs, args.blips, args.comments, args.favorites, time.time() - start, rss_mb()))
+
+  queries = [0]
+  def count(*args):
+    queries[0] += 1
+  event.listen(latitune.db.engine, "before_cursor_execute", count)
+
+  mix = route_mix(latitune, args, favorites)
+  latitune.db.session.remove()
+  weights = [weight for weight, label, make in mix]
+  client = latitune.app.test_client()
+  results = dict((label, {'latency': [], 'queries': [], 'errors': 0}) for weight, label, make in mix)
+  start = time.time()
+  for i in xrange(args.requests):
+    weight, label, make = mix[weighted_choice(rng, weights)]
+    queries[0] = 0
+    began = time.time()
+    response = make(client, rng)
+    results[label]['latency'].append(time.time() - began)
+    results[label]['queries'].append(queries[0])
+    if response.mimetype == 'application/json' and json.loads(response.data)['meta']['status'] != 20:
+      results[label]['errors'] += 1
+  elapsed = time.time() - start
+
+  summary = {}
+  print("%-32s %6s %10s %10s %8s %7s" % ("route", "n", "p50 ms", "p99 ms", "queries", "errors"))
+  for weight, label, make in mix:
+    result = results[label]
+    if not result['latency']:
+      continue
+    summary[label] = {'p50_ms'  : percentile(result['latency'], 50) * 1000,
+                      'p99_ms'  : percentile(result['latency'], 99) * 1000,
+                      'queries' : float(sum(result['queries'])) / len(result['queries'])}
+    print("%-32s %6d %10.2f %10.2f %8.1f %7d" % (label, len(result['latency']), summary[label]['p50_ms'],
+                                                summary[label]['p99_ms'], summary[label]['queries'], result['errors']))
+  summary['process'] = {'rss_mb': rss_mb()}
+  print("%d requests in %.1fs (%.0f req/s), peak rss %.0fMB" % (args.requests, elapsed,
+                                                                args.requests / elapsed, summary['process']['rss_mb']))
+
+  if args.write_thresholds:
+    thresholds = dict((label, {'p99_ms'  : round(max(result['p99_ms'] * LATENCY_HEADROOM,
+                                                     result['p99_ms'] + LATENCY_SLACK_MS), 1),
+                               'queries' : math.ceil(result['queries'] * QUERY_HEADROOM)})
+                      for label, result in summary.items() if label != 'process')
+    thresholds['process'] = {'rss_mb': math.ceil(summary['process']['rss_mb'] * MEMORY_HEADROOM)}
+    with open(args.write_thresholds, "w") as f:
+      json.dump(thresholds, f, indent=2, sort_keys=True, separators=(",", ": "))
+      f.write("\n")
+  if args.thresholds:
+    with open(args.thresholds) as f:
+      thresholds = json.load(f)
+    failures = ["%s %s %.2f > %.2f" % (label, metric, summary[label][metric], limit)
+                for label, limits in sorted(thresholds.items()) if label in summary
+                for metric, limit in sorted(limits.items()) if summary[label][metric] > limit]
+    for failure in failures:
+      print("REGRESSION " + failure)
+    if failures:
+      sys.exit(1)
+
+def weighted_choice(rng, weights):
+  point = rng.uniform(0, sum(weights))
+  for index, weight in enumerate(weights):
+    point -= weight
+    if point <= 0:
+      return index
+  return len(weights) - 1
+
+def main(argv):
+  parser = argparse.ArgumentParser(description="latitune benchmarks")
+  parser.add_argument("--database", default=DEFAULT_DATABASE)
+  parser.add_argument("--seed", type=int, default=1)
+  commands = parser.add_subparsers()
+
+  nearest = commands.add_parser("nearest", help="GET /api/blip?latitude=&longitude= lookups")
+  nearest.add_argument("--scales", default="10000,100000,1000000")
+  nearest.add_argument("--queries", type=int, default=200)
+  nearest.set_defaults(run=bench_nearest)
+
+  engines = commands.add_parser("engines", help="SQL vs in-memory nearest/radius lookups in GET /api/blip")
+  engines.add_argument("--scales", default="10000,100000,1000000")
+  engines.add_argument("--queries", type=int, default=200)
+  engines.add_argument("--radius", type=float, default=10.0)
+  engines.set_defaults(run=bench_engines)
+
+  ingest = commands.add_parser("ingest", help="per-blip PUT vs batch ingestion throughput")
+  ingest.add_argument("--count", type=int, default=500)
+  ingest.add_argument("--batch", type=int, default=100)
+  ingest.add_argument("--writers", type=int, default=1,
+                      help="also compare concurrent writers in one region and spread out")
+  ingest.set_defaults(run=bench_ingest)
+
+  startup = commands.add_parser("startup", help="worker boot: import, create_app and first request")
+  startup.add_argument("--runs", type=int, default=10)
+  startup.set_defaults(run=bench_startup)
+
+  concurrency = commands.add_parser("concurrency", help="serve.py threaded vs gevent under concurrent clients")
+  concurrency.add_argument("--blips", type=int, default=10000)
+  concurrency.add_argument("--clients", default="1,10,50,200")
+  concurrency.add_argument("--duration", type=float, default=5.0)
+  concurrency.add_argument("--timeout", type=float, default=10.0)
+  concurrency.add_argument("--port", type=int, default=5099)
+  concurrency.add_argument("--path", default="/api/blip?latitude=40.7&longitude=-74.0&radius=5")
+  concurrency.set_defaults(run=bench_concurrency)
+
+  suite = commands.add_parser("suite", help="every route under a weighted request mix")
+  suite.add_argument("--users", type=int, default=200)
+  suite.add_argument("--songs", type=int, default=500)
+  suite.add_argument("--blips", type=int, default=20000)
+  suite.add_argument("--comments", type=int, default=20000)
+  suite.add_argument("--favorites", type=int, default=20000)
+  suite.add_argument("--requests", type=int, default=2000)
+  suite.add_argument("--thresholds", help="fail if a route exceeds the p99_ms/queries limits in this file")
+  suite.add_argument("--write-thresholds", help="write limits with headroom from this run to this file")
+  suite.set_defaults(run=bench_suite)
+
+  args = parser.parse_args(argv)
+  args.run(args)
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
@@ -0,0 +1,307 @@
+##################################################
+# CACHES
+##################################################
+
+import os
+import mmap
+import time
+import uuid
+import struct
+import sqlite3
+import hashlib
+import cPickle
+import threading
+import multiprocessing
+from collections import OrderedDict
+
+class LRUCache(object):
+  """Thread-safe in-process cache that evicts the least recently used entry
+  beyond `maxsize` and expires entries `ttl` seconds after they are set.
+
+  With a `store` (see DiskStore) every set and delete is written through,
+  and warm() reloads the unexpired entries, e.g. after a restart."""
+
+  def __init__(self, maxsize=1024, ttl=None, store=None, clock=time.time):
+    self.maxsize = maxsize
+    self.ttl     = ttl
+    self.store   = store
+    self.clock   = clock
+    self.entries = OrderedDict()
+    self.lock    = threading.RLock()
+    self.hits    = 0
+    self.misses  = 0
+
+  def get(self, key, default=None):
+    with self.lock:
+      entry = self.entries.pop(key, None)
+      if entry is None or self._expired(entry):
+        if entry is not None:
+          self._forget(key)
+        self.misses += 1
+        return default
+      self.entries[key] = entry
+      self.hits += 1
+      return entry[1]
+
+  def set(self, key, value):
+    with self.lock:
+      entry = (self.ttl and self.clock() + self.ttl, value)
+      self.entries.pop(key, None)
+      self.entries[key] = entry
+      if self.store is not None:
+        self.store.set(key, entry)
+      while len(self.entries) > self.maxsize:
+        self._forget(next(iter(self.entries)))
+
+  def delete(self, key):
+    with self.lock:
+      self.entries.pop(key, None)
+      self._forget(key)
+
+  def clear(self):
+    with self.lock:
+      for key in list(self.entries):
+        self.delete(key)
+
+  def warm(self):
+    """Load unexpired entries from the store, soonest to expire treated as
+    least recently used"""
+    if self.store is None:
+      return
+    with self.lock:
+      for key, entry in sorted(self.store.items(), key=lambda item: item[1][0]):
+        if self._expired(entry):
+          self.store.delete(key)
+        elif key not in self.entries:
+          self.entries[key] = entry
+      while len(self.entries) > self.maxsize:
+        self._forget(next(iter(self.entries)))
+
+  @property
+  def stats(self):
+    return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+  def __len__(self):
+    return len(self.entries)
+
+  def _expired(self, entry):
+    return entry[0] is not None and entry[0] <= self.clock()
+
+  def _forget(self, key):
+    self.entries.pop(key, None)
+    if self.store is not None:
+      self.store.delete(key)
+
+class DiskStore(object):
+  """Persistent store for LRUCache entries in an SQLite file, which the
+  processes sharing it (e.g. prefork.py's workers) can all write. Each
+  process opens its own connection on first use, and a writer waits up to
+  `timeout` seconds for another to finish. Keys must be ASCII str."""
+
+  def __init__(self, path, timeout=10.0):
+    self.path    = path
+    self.timeout = timeout
+    self.lock    = threading.Lock()
+    self.conn    = None
+    self.pid     = None
+
+  def set(self, key, entry):
+    with self.lock:
+      self._connection().execute("INSERT OR REPLACE INTO entries (key, entry) VALUES (?, ?)",
+                                 (key, buffer(cPickle.dumps(entry, cPickle.HIGHEST_PROTOCOL))))
+
+  def delete(self, key):
+    with self.lock:
+      self._connection().execute("DELETE FROM entries WHERE key = ?", (key,))
+
+  def items(self):
+    with self.lock:
+      return [(str(key), cPickle.loads(str(entry)))
+              for key, entry in self._connection().execute("SELECT key, entry FROM entries")]
+
+  def close(self):
+    with self.lock:
+      if self.conn is not None and self.pid == os.getpid():
+        self.conn.close()
+      self.conn = None
+
+  def _connection(self):
+    # A connection inherited across a fork is left to the parent
+    if self.conn is None or self.pid != os.getpid():
+      self.conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                                  check_same_thread=False)
+      self.conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, entry BLOB NOT NULL)")
+      self.pid = os.getpid()
+    return self.conn
+
+class SharedMemoryCache(object):
+  """Cache in an anonymous shared mmap, created before forking so every
+  worker sees the same entries (see prefork.py).
+
+  The map is split into `size` / `slot_size` slots. A key hashes to one
+  slot, and a set overwrites whatever was there, so colliding keys evict
+  each other; values that do not fit a slot are not cached. Entries expire
+  `ttl` seconds after they are set. Slots are guarded by a fixed set of
+  process-shared locks."""
+
+  HEADER = struct.Struct("<8sId")
+  LOCKS  = 64
+
+  def __init__(self, size=64 * 1024 * 1024, slot_size=4096, ttl=None, clock=time.time):
+    self.slot_size = slot_size
+    self.slots     = size // slot_size
+    self.ttl       = ttl
+    self.clock     = clock
+    self.map       = mmap.mmap(-1, self.slots * slot_size)
+    self.locks     = [multiprocessing.Lock() for i in range(self.LOCKS)]
+    self.hits      = 0
+    self.misses    = 0
+
+  def get(self, key, default=None):
+    digest, offset, lock = self._slot(key)
+    with lock:
+      stored, length, expires = self.HEADER.unpack_from(self.map, offset)
+      if stored != digest or not length or (expires and expires <= self.clock()):
+        self.misses += 1
+        return default
+      start = offset + self.HEADER.size
+      stored_key, value = cPickle.loads(self.map[start:start + length])
+    if stored_key != key:
+      self.misses += 1
+      return default
+    self.hits += 1
+    return value
+
+  def set(self, key, value):
+    payload = cPickle.dumps((key, value), cPickle.HIGHEST_PROTOCOL)
+    if len(payload) > self.slot_size - self.HEADER.size:
+      return False
+    digest, offset, lock = self._slot(key)
+    with lock:
+      self.HEADER.pack_into(self.map, offset, digest, len(payload), self.ttl and self.clock() + self.ttl or 0)
+      start = offset + self.HEADER.size
+      self.map[start:start + len(payload)] = payload
+    return True
+
+  def delete(self, key):
+    digest, offset, lock = self._slot(key)
+    with lock:
+      if self.HEADER.unpack_from(self.map, offset)[0] == digest:
+        self.HEADER.pack_into(self.map, offset, "\0" * 8, 0, 0)
+
+  def clear(self):
+    for lock in self.locks:
+      lock.acquire()
+    try:
+      self.map.seek(0)
+      self.map.write("\0" * len(self.map))
+    finally:
+      for lock in self.locks:
+        lock.release()
+
+  @property
+  def stats(self):
+    return {'hits': self.hits, 'misses': self.misses, 'slots': self.slots}
+
+  def _slot(self, key):
+    """(digest, offset, lock) of the slot `key` lives in"""
+    digest = hashlib.md5(key.encode('utf-8') if isinstance(key, unicode) else key).digest()[:8]
+    index = struct.unpack("<Q", digest)[0] % self.slots
+    return digest, index * self.slot_size, self.locks[index % self.LOCKS]
+
+# Pseudo-tag whose generation changes on every invalidation
+EPOCH = "*"
+
+class ResponseCache(object):
+  """Cache for rendered responses, grouped under tags that name the data
+  they were built from (e.g. "comments:12").
+
+  Every tag has a generation token that is part of its entries' keys, so
+  invalidate(tag) drops all of the tag's entries (every page and parameter
+  variant) at once by issuing a new token. An entry can also depend on
+  further tags (e.g. the blips embedded in it); it is only served while
+  their generations match the ones recorded when it was set.
+
+  A response that was being rendered while a write invalidated its data
+  may hold the old rows, so it is reserved before it is rendered and only
+  stored if no invalidation happened in between (see reserve).
+
+  Entries live in an in-process LRUCache. A `shared` backend, anything with
+  get(key) and set(key, value) such as a memcache client or an LRUCache
+  standing in for one, additionally holds the generations and entries so
+  invalidations are seen by every process using it."""
+
+  def __init__(self, maxsize=1024, ttl=None, shared=None):
+    self.local         = LRUCache(maxsize, ttl)
+    self.generations   = LRUCache(maxsize)
+    self.shared        = shared
+    self.hits          = 0
+    self.misses        = 0
+    self.invalidations = 0
+
+  def get(self, tag, key):
+    full_key = self._key(tag, key)
+    entry = self.local.get(full_key)
+    if entry is None and self.shared is not None:
+      entry = self.shared.get(full_key)
+      if entry is not None:
+        self.local.set(full_key, entry)
+    if entry is None or any(self._generation(dependency) != generation
+                            for dependency, generation in entry[0]):
+      self.misses += 1
+      return None
+    self.hits += 1
+    return entry[1]
+
+  def reserve(self, tag, key):
+    """Taken before rendering the value to store(): the entry's key under
+    the tag's current generation, and the epoch every invalidation renews"""
+    return self._key(tag, key), self._generation(EPOCH)
+
+  def store(self, reserved, value, depends=()):
+    """Store a value rendered after reserve(); False, leaving it uncached,
+    if anything was invalidated meanwhile"""
+    full_key, epoch = reserved
+    entry = ([(dependency, self._generation(dependency)) for dependency in depends], value)
+    # Read after the dependencies' generations, which invalidate renews
+    # after the epoch
+    if self._generation(EPOCH) != epoch:
+      return False
+    self.local.set(full_key, entry)
+    if self.shared is not None:
+      self.shared.set(full_key, entry)
+    return True
+
+  def set(self, tag, key, value, depends=()):
+    return self.store(self.reserve(tag, key), value, depends)
+
+  def invalidate(self, *tags):
+    self._generations().set("generation:" + EPOCH, uuid.uuid4().hex)
+    for tag in tags:
+      self._generations().set("generation:" + tag, uuid.uuid4().hex)
+      self.invalidations += 1
+
+  def clear(self):
+    """Drop this process's entries and generations"""
+    self.local.clear()
+    self.generations.clear()
+
+  @property
+  def stats(self):
+    return {'hits'          : self.hits,
+            'misses'        : self.misses,
+            'invalidations' : self.invalidations,
+            'size'          : len(self.local)}
+
+  def _generations(self):
+    return self.generations if self.shared is None else self.shared
+
+  def _generation(self, tag):
+    generation = self._generations().get("generation:" + tag)
+    if generation is None:
+      generation = uuid.uuid4().hex
+      self._generations().set("generation:" + tag, generation)
+    return generation
+
+  def _key(self, tag, key):
+    return "response:%s:%s:%s" % (tag, self._generation(tag), key)
@@ -1,13 +1,26 @@
 ##################################################
 # CONTROLLERS
 ##################################################
-from flask import Flask, jsonify, request
+import sys
+import json
+import urllib
+import traceback
+from collections import OrderedDict
+from flask import Blueprint, Response, g, request, stream_with_context
 from sqlalchemy.exc import IntegrityError
 from settings import *
 from models import *
-from pyechonest import song
+from cache import ResponseCache
+import providers
+import instrumentation
+import tiles
+import nearest
+import serialization
+import realtime
+import database
 
 MISSING_PARAMETERS      = 10
+INVALID_PARAMETERS      = 11
 SUCCESS                 = 20
 EMAIL_EXISTS            = 30
 USERNAME_EXISTS         = 31
@@ -20,6 +33,7 @@ FAVORITE_DOES_NOT_EXIST = 70
 
 STATUS_CODE_MESSAGES = {
   MISSING_PARAMETERS      : "Missing Required Parameters",
+  INVALID_PARAMETERS      : "Invalid Parameters",
   SUCCESS                 : "Success",
   EMAIL_EXISTS            : "Email already exists",
   USERNAME_EXISTS         : "Username already exists",
@@ -33,28 +47,153 @@ STATUS_CODE_MESSAGES = {
 }
 
 ##
-# Helper to build json responses for API endpoints
+# Helper to build json responses for API endpoints. `objs` may hold
+# serialization.Fragments; `included` adds top-level lists such as the
+# songs of a normalized response.
 ##
 class API_Response:
-  def __init__(self,status=SUCCESS, objs=[], error=""):
-   self.status = status
-   self.error  = STATUS_CODE_MESSAGES[status]
-   self.objs   = objs
+  def __init__(self,status=SUCCESS, objs=[], error="", meta={}, included={}):
+   self.status   = status
+   self.error    = STATUS_CODE_MESSAGES[status]
+   self.objs     = objs
+   self.meta     = meta
+   self.included = included
 
   def as_dict(self):
     if self.status != SUCCESS:
-      return {"meta"    : {"status":self.status,"error":self.error},
-              "objects" : self.objs}
+      return dict(self.included, meta=dict(self.meta, status=self.status, error=self.error),
+                  objects=self.objs)
     else:
-      return {"meta"    : {"status":self.status},"objects":self.objs}
+      return dict(self.included, meta=dict(self.meta, status=self.status), objects=self.objs)
 
   def as_json(self):
-    return jsonify(self.as_dict())
+    with instrumentation.timed("json"):
+      response = Response(serialization.dumps(self.as_dict()), mimetype='application/json')
+    response.api_status = self.status
+    return response
+
+DEFAULT_PAGE_SIZE = 25
+MAX_PAGE_SIZE     = 100
+STREAM_BATCH_SIZE = 500
+
+# Feed defaults: radius in miles, window in hours
+FEED_RADIUS    = 25.0
+FEED_MAX_HOURS = 7 * 24
+# Feed cursors carry the time the feed was ranked as of, comment cursors
+# the time of the last comment
+FEED_CURSOR_TIME = "%Y%m%d%H%M%S%f"
+
+def page_size():
+  return max(1, min(int(request.args.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE))
+
+def normalized():
+  return request.values.get('shape') == 'normalized'
+
+def blips_response(blips, meta={}):
+  """API_Response of `blips`, their songs sent once under "songs" when the
+  request asks for shape=normalized"""
+  included = OrderedDict() if normalized() else None
+  objects = serialization.blips(blips, included)
+  return API_Response(SUCCESS, objects, meta=meta,
+                      included={'songs': included.values()} if included is not None else {})
+
+def comments_response(comments, meta={}):
+  included = OrderedDict() if normalized() else None
+  objects = serialization.comments(comments, included)
+  return API_Response(SUCCESS, objects, meta=meta,
+                      included={'songs': included.values()} if included is not None else {})
+
+def thread_response(blip, comments, meta={}):
+  """API_Response of a page of `blip`'s comments: the blip is sent once,
+  under "blip", and the comments reference it by blip_id"""
+  included = OrderedDict() if normalized() else None
+  thread = {'blip': serialization.blips([blip], included)[0]}
+  if included is not None:
+    thread['songs'] = included.values()
+  return API_Response(SUCCESS, serialization.thread(comments), meta=meta, included=thread)
+
+def stream_blips(query, after=0):
+  """Stream every blip matching `query` as one API_Response-shaped JSON
+  document, fetching and serializing STREAM_BATCH_SIZE blips at a time"""
+  def generate():
+    last_id = after
+    separator = ""
+    yield '{"meta": {"status": %d}, "objects": [' % SUCCESS
+    while True:
+      page = query.filter(Blip.id > last_id).order_by(Blip.id).limit(STREAM_BATCH_SIZE).all()
+      for blip in serialization.blips(page):
+        yield separator + blip.json
+        separator = ", "
+      if len(page) < STREAM_BATCH_SIZE:
+        break
+      last_id = page[-1].id
+      db.session.expunge_all()
+    yield ']}'
+  return Response(stream_with_context(generate()), mimetype='application/json')
+
+# Routes are registered on the app by latitune.create_app
+api = Blueprint('api', __name__)
+
+# Reschedules provider lookups lost by workers that exited (see providers.py)
+@api.before_app_request
+def sweep_providers():
+  providers.sweep_due()
 
 # Decorator declarations
 
 import functools
 
+response_cache = ResponseCache(app.config['RESPONSE_CACHE_SIZE'], app.config['RESPONSE_CACHE_TTL'])
+
+##
+# Serves a GET view's successful responses from response_cache. `tag` maps
+# the request args to the cache tag the response depends on, or None to
+# skip the cache; writes call response_cache.invalidate with the same tag.
+# A view can list further tags its response embeds in response.cache_depends.
+##
+def cached_response(tag):
+  def wrap(fn):
+    @functools.wraps(fn)
+    def wrapped_fn():
+      name = tag(request.args)
+      if name is None or not app.config['RESPONSE_CACHE_ENABLED']:
+        return fn()
+      key = request.path.encode('utf-8') + "?" + urllib.urlencode(sorted(
+        (arg.encode('utf-8'), value.encode('utf-8')) for arg, value in request.args.items(multi=True)))
+      body = response_cache.get(name, key)
+      if body is not None:
+        return Response(body, mimetype='application/json')
+      reserved = response_cache.reserve(name, key)
+      # A replica that has not caught up with the write that invalidated
+      # the entry would have its stale rows cached until RESPONSE_CACHE_TTL
+      database.read_from_primary()
+      response = fn()
+      if getattr(response, 'api_status', None) == SUCCESS:
+        response_cache.store(reserved, response.data, getattr(response, 'cache_depends', ()))
+      return response
+    return wrapped_fn
+  return wrap
+
+##
+# Runs a step that follows a write's commit, such as invalidating caches.
+# The write has happened whatever the step does, so a failure is logged
+# rather than reported to the client, who would retry the write.
+##
+def after_commit(fn, *args):
+  try:
+    fn(*args)
+  except Exception:
+    traceback.print_exc(file=sys.stderr)
+
+def id_tag(prefix, value):
+  """Cache tag of the object whose id is `value` from the request, spelled
+  as the writes that invalidate it spell it; None, so the response is not
+  cached, if it is not a number"""
+  try:
+    return '%s:%d' % (prefix, int(value))
+  except ValueError:
+    return None
+
 def check_arguments(names):
   def wrap(fn):
     @functools.wraps(fn)
@@ -66,6 +205,12 @@ def check_arguments(names):
     return wrapped_fn
   return wrap
 
+##
+# Authenticates the user named by user_id or username with either their
+# password or a token from PUT /api/user/token. Tokens are checked with an
+# HMAC instead of the deliberately slow password hash. The user is left in
+# g.user for the view.
+##
 def require_authentication(fn):
   @functools.wraps(fn)
   def wrap():
@@ -73,7 +218,7 @@ def require_authentication(fn):
     if len([u_f for u_f in user_fields if u_f in request.values]) == 0:
       return API_Response(MISSING_PARAMETERS).as_json()
     u_field = [u_f for u_f in user_fields if u_f in request.values][0]
-    if u_field and not all ([arg in request.values for arg in [u_field, 'password']]):
+    if u_field and not any ([arg in request.values for arg in ['password', 'token']]):
       return API_Response(MISSING_PARAMETERS).as_json()
     else:
       if u_field == 'user_id':
@@ -82,25 +227,50 @@ def require_authentication(fn):
         user = User.query.filter_by(name=request.values[u_field]).first()
         if not user:
           return API_Response(USERNAME_DOES_NOT_EXIST).as_json()
-      if not user or not user.check_password(request.values['password']):
+      if 'password' in request.values:
+        authenticated = user and user.check_password(request.values['password'])
+      else:
+        authenticated = user and user.check_token(request.values['token'])
+      if not authenticated:
         return API_Response(INVALID_AUTH).as_json()
+      g.user = user
       return fn()
   return wrap
 
+##
+# Operational endpoints take the METRICS_TOKEN as `metrics_token`, or are
+# only open on a local development server when no token is configured.
+##
+def require_metrics_token(fn):
+  @functools.wraps(fn)
+  def wrap():
+    token = app.config['METRICS_TOKEN']
+    if token:
+      allowed = safe_str_cmp(request.values.get('metrics_token', '').encode('utf-8'), token)
+    else:
+      allowed = os.environ.get('LATITUNE_LOCAL') == "true"
+    if not allowed:
+      return API_Response(INVALID_AUTH).as_json()
+    return fn()
+  return wrap
+
 # DEVELOPMENT ONLY
 
-@app.route("/api/tabularasa", methods=['GET'])
+@api.route("/api/tabularasa", methods=['GET'])
 def destroy():
   if os.environ.get('LATITUNE_LOCAL') == "true":
     db.session.remove()
     db.drop_all()
     db.create_all()
+    response_cache.clear()
+    serialization.fragment_cache.clear()
+    nearest.index = None
     return "OK"
   return "WHO DO YOU THINK YOU ARE?"
 
 # USER
 
-@app.route("/api/user", methods=['PUT'])
+@api.route("/api/user", methods=['PUT'])
 @check_arguments(['username','email','password'], )
 def create_user():
   try:
@@ -117,7 +287,7 @@ def create_user():
     if User.query.filter_by(name=request.form['username']).first() is not None:
       return API_Response(USERNAME_EXISTS).as_json()
 
-@app.route("/api/user", methods=['GET'])
+@api.route("/api/user", methods=['GET'])
 @require_authentication
 def get_user_id():
   try:
@@ -126,41 +296,93 @@ def get_user_id():
   except Exception as e:
     return API_Response("ERR", [], str(e)).as_json()
 
+@api.route("/api/user/token", methods=['PUT'])
+@check_arguments(['password'])
+@require_authentication
+def create_token():
+  token, expires = g.user.issue_token(app.config['AUTH_TOKEN_TTL'])
+  return API_Response(SUCCESS, [{'user_id': g.user.id, 'token': token, 'expires': expires}]).as_json()
+
 # BLIPS
 
-@app.route("/api/blip", methods=['GET'])
+@api.route("/api/blip", methods=['GET'])
+@cached_response(lambda args: id_tag('blip', args['id']) if set(args) == set(['id']) else None)
 def get_blip():
   try:
-    if all([arg in request.args for arg in ['latitude','longitude']]):
-      lat = request.args['latitude']
-      lng = request.args['longitude']
-      db.session.commit()
-      query = """
-        SELECT id, longitude, latitude,
-          (3959*ACOS(COS(RADIANS(%(lat)i))*COS(RADIANS(latitude))*COS(RADIANS(longitude)-RADIANS(%(lng)i))+SIN(RADIANS(%(lat)i))*SIN(RADIANS(latitude))))
-        AS distance from blip
-        order by distance asc limit 25""" % {'lat': float(lat), 'lng': float(lng)}
-      blips = Blip.query.from_statement(query).all()
-      return API_Response(SUCCESS,[blip.serialize for blip in blips]).as_json()
+    if all([arg in request.args for arg in ['latitude','longitude','hours']]):
+      limit = page_size()
+      hours = min(float(request.args['hours']), FEED_MAX_HOURS)
+      now, after = None, None
+      if 'cursor' in request.args:
+        as_of, score, blip_id = request.args['cursor'].split(':')
+        now, after = datetime.strptime(as_of, FEED_CURSOR_TIME), (float(score), int(blip_id))
+      now = now or datetime.now()
+      ranked, blips = Blip.feed(float(request.args['latitude']),
+                                float(request.args['longitude']),
+                                float(request.args.get('radius', FEED_RADIUS)),
+                                hours, limit, after, now)
+      meta = {}
+      if len(ranked) == limit:
+        meta['cursor'] = '%s:%r:%d' % ((now.strftime(FEED_CURSOR_TIME),) + ranked[-1])
+      return blips_response(blips, meta).as_json()
+    elif all([arg in request.args for arg in ['latitude','longitude','radius']]):
+      limit = page_size()
+      after = None
+      if 'cursor' in request.args:
+        distance, blip_id = request.args['cursor'].split(':')
+        after = (float(distance), int(blip_id))
+      index = nearest.get_index()
+      if index:
+        ranked = index.within(float(request.args['latitude']),
+                              float(request.args['longitude']),
+                              float(request.args['radius']),
+                              limit, after)
+        blips = Blip.by_ids([blip_id for distance, blip_id in ranked])
+      else:
+        ranked, blips = Blip.within_radius(float(request.args['latitude']),
+                                           float(request.args['longitude']),
+                                           float(request.args['radius']),
+                                           limit, after)
+      meta = {'cursor': '%r:%d' % ranked[-1]} if len(ranked) == limit else {}
+      return blips_response(blips, meta).as_json()
+    elif all([arg in request.args for arg in ['north','south','east','west']]):
+      limit = page_size()
+      box = [float(request.args[arg]) for arg in ['south','west','north','east']]
+      blips = Blip.query.filter(Blip.box_filter(box))
+      if 'cursor' in request.args:
+        blips = blips.filter(Blip.id > int(request.args['cursor']))
+      blips = blips.order_by(Blip.id).limit(limit).all()
+      meta = {'cursor': str(blips[-1].id)} if len(blips) == limit else {}
+      return blips_response(blips, meta).as_json()
+    elif all([arg in request.args for arg in ['latitude','longitude']]):
+      lat = float(request.args['latitude'])
+      lng = float(request.args['longitude'])
+      index = nearest.get_index()
+      blips = Blip.by_ids(index.nearest(lat, lng)) if index else Blip.nearest(lat, lng)
+      return blips_response(blips).as_json()
     elif 'id' in request.args:
       blip_id = request.args['id']
       blip = Blip.query.filter_by(id=blip_id).first()
       if blip:
-        return API_Response(SUCCESS, [blip.serialize]).as_json()
+        return blips_response([blip]).as_json()
       else:
         return API_Response("ERR", []).as_json()
     else:
-      blips = Blip.query.all()
-      return API_Response(SUCCESS,[blip.serialize for blip in blips]).as_json()
+      after = int(request.args.get('cursor', 0))
+      if request.args.get('stream') == 'true':
+        return stream_blips(Blip.query, after)
+      limit = page_size()
+      blips = Blip.query.filter(Blip.id > after).order_by(Blip.id).limit(limit).all()
+      meta = {'cursor': str(blips[-1].id)} if len(blips) == limit else {}
+      return blips_response(blips, meta).as_json()
   except Exception as e:
     return API_Response("ERR", [], str(e)).as_json()
 
-@app.route("/api/blip", methods=['PUT'])
-@check_arguments(['song_id','longitude', 'latitude','user_id','password'])
+@api.route("/api/blip", methods=['PUT'])
+@check_arguments(['song_id','longitude', 'latitude','user_id'])
 @require_authentication
 def create_blip():
   try:
-    usr  = User.query.get(request.form['user_id'])
     song = Song.query.get(request.form['song_id'])
     if not song:
       return API_Response(SONG_DOES_NOT_EXIST).as_json()
@@ -169,72 +391,209 @@ def create_blip():
                     request.form['longitude'],
                     request.form['latitude'])
 
-    db.session.add(new_blip)
-    db.session.commit()
-    return API_Response(SUCCESS, [new_blip.serialize]).as_json()
+    def write():
+      db.session.add(new_blip)
+      db.session.flush()
+    tiles.record([(new_blip.geohash, song.id, new_blip.timestamp)], write)
+  except Exception as e:
+    db.session.rollback()
+    return API_Response("ERR", [], str(e)).as_json()
+  after_commit(response_cache.invalidate, 'blip:%d' % new_blip.id)
+  after_commit(nearest.blips_added)
+  try:
+    response = blips_response([new_blip])
+  except Exception as e:
+    return API_Response("ERR", [], str(e)).as_json()
+  after_commit(realtime.publish, new_blip)
+  return response.as_json()
+
+##
+# Server-sent events of the blips created within `radius` miles (default
+# FEED_RADIUS) of a point from now on, instead of polling GET /api/blip. A
+# client reconnecting with Last-Event-ID (or last_event_id) is first sent
+# up to MAX_PAGE_SIZE nearby blips it missed. See realtime.py.
+##
+@api.route("/api/blip/live", methods=['GET'])
+@check_arguments(['latitude','longitude'])
+def stream_nearby_blips():
+  try:
+    subscription = realtime.Subscription(float(request.args['latitude']),
+                                         float(request.args['longitude']),
+                                         float(request.args.get('radius', FEED_RADIUS)),
+                                         app.config['LIVE_QUEUE_SIZE'])
+    realtime.get_broker()
+    # Subscribed before the backlog is read, so no blip falls in between
+    realtime.registry.subscribe(subscription)
+    try:
+      last_id = request.headers.get('Last-Event-ID', request.args.get('last_event_id'))
+      # From the primary, or a blip published before the subscription but
+      # not yet replicated would never be sent
+      database.read_from_primary()
+      backlog = realtime.missed(subscription, int(last_id), MAX_PAGE_SIZE) if last_id else []
+    except Exception:
+      realtime.registry.unsubscribe(subscription)
+      raise
+  except Exception as e:
+    return API_Response("ERR", [], str(e)).as_json()
+  response = Response(realtime.stream(subscription, backlog, app.config['LIVE_KEEPALIVE']),
+                      mimetype='text/event-stream')
+  response.headers['Cache-Control'] = 'no-cache'
+  # Stops nginx (and Heroku's router) buffering the stream
+  response.headers['X-Accel-Buffering'] = 'no'
+  return response
+
+##
+# Bulk ingestion for clients replaying buffered blips. `blips` is a JSON
+# array of {song_id, longitude, latitude} objects posted for one user. Every
+# song id is checked with one query and the valid blips are written with
+# a single executemany insert and commit. Each object gets back the
+# meta block it would have had from PUT /api/blip.
+##
+@api.route("/api/blip/batch", methods=['PUT'])
+@check_arguments(['user_id','blips'])
+@require_authentication
+def create_blips():
+  try:
+    items = json.loads(request.form['blips'])
+    # Each item's row, or the status reporting why it has none
+    parsed = [blip_row(item) for item in items]
+    song_ids = set(row['song_id'] for row in parsed if isinstance(row, dict))
+    known = set(row.id for row in db.session.query(Song.id).filter(Song.id.in_(song_ids))) if song_ids else set()
+    rows = []
+    statuses = []
+    for row in parsed:
+      if not isinstance(row, dict):
+        statuses.append(row)
+      elif row['song_id'] not in known:
+        statuses.append(SONG_DOES_NOT_EXIST)
+      else:
+        rows.append(row)
+        statuses.append(SUCCESS)
+    if rows:
+      tiles.record([(row['geohash'], row['song_id'], row['timestamp']) for row in rows],
+                   lambda: db.session.execute(Blip.__table__.insert(), rows))
+  except Exception as e:
+    db.session.rollback()
+    return API_Response("ERR", [], str(e)).as_json()
+  if rows:
+    after_commit(nearest.blips_added)
+  return API_Response(SUCCESS, [API_Response(status).as_dict()['meta'] for status in statuses]).as_json()
+
+def blip_row(item):
+  """Blip.row for an item of a batch, or MISSING_PARAMETERS or
+  INVALID_PARAMETERS when it has no song_id and numeric coordinates"""
+  if not isinstance(item, dict) or not all([field in item for field in ['song_id','longitude','latitude']]):
+    return MISSING_PARAMETERS
+  try:
+    return Blip.row(item['song_id'], g.user.id, item['longitude'], item['latitude'])
+  except (TypeError, ValueError):
+    return INVALID_PARAMETERS
+
+# TILES
+
+@api.route("/api/tiles", methods=['GET'])
+@check_arguments(['north','south','east','west'])
+def get_tiles():
+  try:
+    box = [float(request.args[arg]) for arg in ['south','west','north','east']]
+    precision = int(request.args['precision']) if 'precision' in request.args else None
+    precision, found = tiles.viewport(box, precision)
+    return API_Response(SUCCESS, [tile.serialize for tile in found],
+                        meta={'precision': precision}).as_json()
   except Exception as e:
     return API_Response("ERR", [], str(e)).as_json()
-  return None
 
 # SONG
 
-@app.route("/api/song",methods=['PUT'])
+@api.route("/api/song",methods=['PUT'])
 @check_arguments(['artist','title','echonest_id','album'])
 def create_song():
   try:
-    new_song = Song.query.filter_by(artist=request.form['artist'],
-                                    title=request.form['title']).first()
-    if not new_song:
-      new_song = Song(request.form['artist'], request.form['title'], request.form['echonest_id'],request.form['album'])
-      db.session.add(new_song)
-      db.session.commit()
-      ss_results = song.profile(ids=new_song.echonestID, buckets=['id:rdio-US','id:spotify-WW'])
-      for ensong in ss_results:
-        for rdioTrack in ensong.get_tracks('rdio-US'):
-          trackID = rdioTrack["foreign_id"].split(":")[2]
-          new_songprovider = SongProvider(new_song.id, "Rdio", trackID)
-          db.session.add(new_songprovider)
-        for spotifyTrack in ensong.get_tracks('spotify-WW'):
-          trackID = spotifyTrack["foreign_id"].split(":")[2]
-          new_songprovider = SongProvider(new_song.id, "Spotify", trackID)
-          db.session.add(new_songprovider)
-      db.session.commit()
-    return API_Response(SUCCESS, [new_song.serialize]).as_json()
+    songs, created = Song.upsert_many([request.form])
+    if created:
+      providers.schedule(created)
+    new_song = songs[(request.form['artist'], request.form['title'])]
+    return API_Response(SUCCESS, serialization.songs([new_song])).as_json()
   except Exception as e:
     print e
     return API_Response("ERR", [], request.form).as_json()
   return None
 
-@app.route("/api/blip/comment",methods=['PUT'])
-@check_arguments(['user_id','blip_id','password','comment'])
+##
+# Bulk upsert. `songs` is a JSON array of {artist, title, echonest_id, album}
+# objects; duplicates are collapsed on (artist, title) and the providers of
+# every new song are resolved by one background job.
+##
+@api.route("/api/song/batch",methods=['PUT'])
+@check_arguments(['songs'])
+def create_songs():
+  try:
+    items = json.loads(request.form['songs'])
+    if not all([all([field in item for field in ['artist','title','echonest_id']]) for item in items]):
+      return API_Response(MISSING_PARAMETERS).as_json()
+    songs, created = Song.upsert_many(items)
+    if created:
+      providers.schedule(created)
+    return API_Response(SUCCESS, serialization.songs([songs[(item['artist'], item['title'])] for item in items])).as_json()
+  except Exception as e:
+    db.session.rollback()
+    return API_Response("ERR", [], str(e)).as_json()
+
+@api.route("/api/song",methods=['GET'])
+@check_arguments(['id'])
+def get_song():
+  song = Song.query.get(request.args['id'])
+  if not song:
+    return API_Response(SONG_DOES_NOT_EXIST).as_json()
+  return API_Response(SUCCESS, serialization.songs([song])).as_json()
+
+@api.route("/api/blip/comment",methods=['PUT'])
+@check_arguments(['user_id','blip_id','comment'])
 @require_authentication
 def create_comment():
-  user = User.query.get(request.form['user_id'])
   blip = Blip.query.get(request.form['blip_id'])
   if not blip:
     return API_Response(BLIP_DOES_NOT_EXIST).as_json()
   new_comment = Comment(request.form['user_id'],request.form['blip_id'],request.form['comment'])
   db.session.add(new_comment)
+  Blip.adjust_counts(blip.id, comments=1)
   db.session.commit()
-  return API_Response(SUCCESS,[new_comment.serialize]).as_json()
+  response_cache.invalidate('comments:%d' % blip.id, 'blip:%d' % blip.id)
+  return comments_response([new_comment]).as_json()
 
-@app.route("/api/blip/comment",methods=['GET'])
+@api.route("/api/blip/comment",methods=['GET'])
+@cached_response(lambda args: id_tag('comments', args['blip_id']) if 'blip_id' in args and 'id' not in args else None)
 def get_comment():
   if 'id' in request.args:
     comment = Comment.query.filter_by(id=request.args['id']).first()
     if not comment:
       return API_Response(COMMENT_DOES_NOT_EXIST).as_json()
-    return API_Response(SUCCESS,[comment.serialize]).as_json()
+    return comments_response([comment]).as_json()
   if 'blip_id' in request.args:
-    comments = Comment.query.filter_by(blip_id=request.args['blip_id']).order_by(db.desc('comment.timestamp')).all()
-    return API_Response(SUCCESS,[comment.serialize for comment in comments]).as_json()
+    try:
+      blip = Blip.query.get(int(request.args['blip_id']))
+      limit = page_size()
+      after = None
+      if 'cursor' in request.args:
+        timestamp, comment_id = request.args['cursor'].split(':')
+        after = (datetime.strptime(timestamp, FEED_CURSOR_TIME), int(comment_id))
+    except Exception as e:
+      return API_Response("ERR", [], str(e)).as_json()
+    if not blip:
+      return API_Response(BLIP_DOES_NOT_EXIST).as_json()
+    comments = Comment.thread(blip.id, limit, after)
+    meta = {}
+    if len(comments) == limit:
+      meta['cursor'] = '%s:%d' % (comments[-1].timestamp.strftime(FEED_CURSOR_TIME), comments[-1].id)
+    response = thread_response(blip, comments, meta).as_json()
+    response.cache_depends = ['blip:%d' % blip.id]
+    return response
   return API_Response(MISSING_PARAMETERS).as_json()
 
-@app.route("/api/blip/favorite",methods=['PUT'])
-@check_arguments(['user_id','blip_id','password'])
+@api.route("/api/blip/favorite",methods=['PUT'])
+@check_arguments(['user_id','blip_id'])
 @require_authentication
 def create_favorite():
-  user = User.query.get(request.form['user_id'])
   blip = Blip.query.get(request.form['blip_id'])
   if not blip:
     return API_Response(BLIP_DOES_NOT_EXIST).as_json()
@@ -242,29 +601,81 @@ def create_favorite():
   if not existing:
     new_favorite = Favorite(request.form['user_id'],request.form['blip_id'])
     db.session.add(new_favorite)
-    db.session.commit()
-    existing = new_favorite
+    Blip.adjust_counts(blip.id, favorites=1)
+    try:
+      db.session.commit()
+      existing = new_favorite
+    except IntegrityError:
+      # A concurrent request favorited it first
+      db.session.rollback()
+      existing = Favorite.query.filter_by(user_id=request.form['user_id'],blip_id=request.form['blip_id']).first()
+    invalidate_favorites(g.user.id, blip.id)
   return API_Response(SUCCESS,[existing.serialize]).as_json()
 
-@app.route("/api/blip/favorite",methods=["GET"])
+def favorites_tag(args):
+  if 'user_id' in args:
+    return id_tag('favorites:user', args['user_id'])
+  if 'blip_id' in args:
+    return id_tag('favorites:blip', args['blip_id'])
+  return None
+
+def invalidate_favorites(user_id, blip_id):
+  response_cache.invalidate('favorites:user:%d' % int(user_id), 'favorites:blip:%d' % int(blip_id),
+                            'blip:%d' % int(blip_id))
+
+@api.route("/api/blip/favorite",methods=["GET"])
+@cached_response(favorites_tag)
 def get_favorites():
-  if "blip_id" in request.args:
-    favorites = Favorite.query.filter_by(blip_id=request.args['blip_id']).order_by(db.desc("user_id")).all()
-    objects = map(lambda x:User.query.get(x.user_id),favorites)
+  if "user_id" not in request.args and "blip_id" not in request.args:
+    return API_Response(MISSING_PARAMETERS).as_json()
+  try:
+    limit = page_size()
+    owner = int(request.args['user_id'] if "user_id" in request.args else request.args['blip_id'])
+    cursor = int(request.args['cursor']) if 'cursor' in request.args else None
+  except Exception as e:
+    return API_Response("ERR", [], str(e)).as_json()
   if "user_id" in request.args:
-    favorites = Favorite.query.filter_by(user_id=request.args['user_id']).order_by(db.asc("blip_id")).all()
-    objects = map(lambda x:Blip.query.get(x.blip_id),favorites)
-  return API_Response(SUCCESS,[] if objects == [] else [object.serialize for object in objects]).as_json()
+    blips = db.session.query(Blip).join(Favorite, Favorite.blip_id == Blip.id).filter(
+      Favorite.user_id == owner)
+    if cursor is not None:
+      blips = blips.filter(Favorite.blip_id > cursor)
+    blips = blips.order_by(Favorite.blip_id).limit(limit).all()
+    meta = {'cursor': str(blips[-1].id)} if len(blips) == limit else {}
+    response = blips_response(blips, meta).as_json()
+    response.cache_depends = ['blip:%d' % blip.id for blip in blips]
+    return response
+  if "blip_id" in request.args:
+    users = db.session.query(User).join(Favorite, Favorite.user_id == User.id).filter(
+      Favorite.blip_id == owner)
+    if cursor is not None:
+      users = users.filter(Favorite.user_id < cursor)
+    users = users.order_by(db.desc(Favorite.user_id)).limit(limit).all()
+    meta = {'cursor': str(users[-1].id)} if len(users) == limit else {}
+    return API_Response(SUCCESS,[user.serialize for user in users],meta=meta).as_json()
 
-@app.route("/api/blip/favorite",methods=["DELETE"])
-@check_arguments(['user_id','blip_id','password'])
+@api.route("/api/blip/favorite",methods=["DELETE"])
+@check_arguments(['user_id','blip_id'])
 @require_authentication
 def delete_favorite():
   favorite = Favorite.query.filter_by(blip_id=request.args['blip_id'],user_id=request.args['user_id'])
-  user = User.query.get(request.args['user_id'])
   if favorite.first() is None:
     return API_Response(FAVORITE_DOES_NOT_EXIST).as_json()
-  favorite.delete()
+  Blip.adjust_counts(request.args['blip_id'], favorites=-favorite.delete())
   db.session.commit()
+  invalidate_favorites(request.args['user_id'], request.args['blip_id'])
   return API_Response(SUCCESS).as_json()
 
+@api.route("/api/cache/stats",methods=["GET"])
+def get_cache_stats():
+  return API_Response(SUCCESS,[response_cache.stats]).as_json()
+
+@api.route("/api/metrics",methods=["GET"])
+@require_metrics_token
+def get_metrics():
+  return API_Response(SUCCESS,[instrumentation.metrics.serialize]).as_json()
+
+@api.route("/api/metrics/profile",methods=["GET"])
+@require_metrics_token
+def get_profile():
+  return Response(instrumentation.profiler.collapsed(), mimetype='text/plain')
+
@@ -0,0 +1,113 @@
+##################################################
+# DATABASE ENGINES AND SESSIONS
+##################################################
+#
+# Flask-SQLAlchemy with
+#
+# * pool sizing from SQLALCHEMY_POOL_SIZE, SQLALCHEMY_MAX_OVERFLOW,
+#   SQLALCHEMY_POOL_TIMEOUT and SQLALCHEMY_POOL_RECYCLE (SQLite keeps the
+#   pools Flask-SQLAlchemy picks for it)
+# * SQLALCHEMY_POOL_PRE_PING: connections are tested with "SELECT 1" as
+#   they are checked out, and one that fails is replaced instead of handing
+#   the request a dead connection
+# * read-only sessions for GET requests. They refuse to flush changes, and
+#   when SQLALCHEMY_BINDS has a "replica" URL every query they make goes to
+#   that engine instead of the primary, unless the request has called
+#   read_from_primary() because what it reads is cached or has to include
+#   the latest writes.
+
+import weakref
+from flask import g, request, has_request_context
+from flask.ext.sqlalchemy import SQLAlchemy, _SignallingSession
+from sqlalchemy import event, exc, orm
+from functools import partial
+
+READ_ONLY_METHODS = ('GET', 'HEAD')
+REPLICA_BIND      = 'replica'
+
+class ReadOnlySessionError(exc.InvalidRequestError):
+  pass
+
+def read_from_primary():
+  """Send the current request's remaining queries to the primary, which
+  has every committed write, rather than the replica"""
+  g.read_from_primary = True
+
+def ping(app, dbapi_connection, connection_record, connection_proxy):
+  if not app.config['SQLALCHEMY_POOL_PRE_PING']:
+    return
+  try:
+    cursor = dbapi_connection.cursor()
+    cursor.execute("SELECT 1")
+    cursor.close()
+  except Exception:
+    # The pool retries the checkout with a fresh connection
+    raise exc.DisconnectionError()
+
+class RoutingSession(_SignallingSession):
+  """Session that is read-only while serving a GET request"""
+
+  def __init__(self, db, **options):
+    self.db = db
+    _SignallingSession.__init__(self, db, **options)
+
+  @property
+  def read_only(self):
+    return has_request_context() and request.method in READ_ONLY_METHODS
+
+  def get_bind(self, mapper=None, clause=None):
+    if (self.read_only and REPLICA_BIND in (self.app.config['SQLALCHEMY_BINDS'] or ())
+        and not getattr(g, 'read_from_primary', False)):
+      return self.db.get_engine(self.app, bind=REPLICA_BIND)
+    return _SignallingSession.get_bind(self, mapper, clause)
+
+  def flush(self, objects=None):
+    if self.read_only and (self.new or self.dirty or self.deleted):
+      raise ReadOnlySessionError("%s %s cannot write to the database" % (request.method, request.path))
+    _SignallingSession.flush(self, objects)
+
+class LatituneSQLAlchemy(SQLAlchemy):
+
+  def __init__(self, *args, **kwargs):
+    # Engines whose pools ping their connections
+    self.pinged = weakref.WeakKeyDictionary()
+    SQLAlchemy.__init__(self, *args, **kwargs)
+
+  def init_app(self, app):
+    SQLAlchemy.init_app(self, app)
+    app.config.setdefault('SQLALCHEMY_MAX_OVERFLOW', None)
+    app.config.setdefault('SQLALCHEMY_POOL_PRE_PING', False)
+
+  def get_engine(self, app, bind=None):
+    """The app's engine for `bind`, its pool pinging connections as they
+    are checked out (the listener carries over when dispose() replaces
+    the pool)"""
+    engine = SQLAlchemy.get_engine(self, app, bind)
+    if engine not in self.pinged:
+      event.listen(engine, 'checkout', partial(ping, app))
+      self.pinged[engine] = True
+    return engine
+
+  def dispose_engines(self, app):
+    """Close every engine's pooled connections, e.g. before forking, so no
+    connection is shared between processes"""
+    for bind in [None] + list(app.config['SQLALCHEMY_BINDS'] or ()):
+      self.get_engine(app, bind).dispose()
+
+  def create_scoped_session(self, options=None):
+    options = dict(options or {})
+    scopefunc = options.pop('scopefunc', None)
+    return orm.scoped_session(partial(RoutingSession, self, **options), scopefunc=scopefunc)
+
+  def apply_pool_defaults(self, app, options):
+    """Pool options are applied per driver in apply_driver_hacks"""
+
+  def apply_driver_hacks(self, app, info, options):
+    if info.drivername != 'sqlite':
+      for option, key in [('pool_size',    'SQLALCHEMY_POOL_SIZE'),
+                          ('max_overflow', 'SQLALCHEMY_MAX_OVERFLOW'),
+                          ('pool_timeout', 'SQLALCHEMY_POOL_TIMEOUT'),
+                          ('pool_recycle', 'SQLALCHEMY_POOL_RECYCLE')]:
+        if app.config[key] is not None:
+          options[option] = app.config[key]
+    SQLAlchemy.apply_driver_hacks(self, app, info, options)
@@ -0,0 +1,134 @@
+##################################################
+# GEO HELPERS
+##################################################
+
+import math
+
+EARTH_RADIUS_MILES = 3959.0
+MILES_PER_DEGREE   = 2 * math.pi * EARTH_RADIUS_MILES / 360.0
+
+GEOHASH_PRECISION  = 9
+GEOHASH_ALPHABET   = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+def haversine(lat1, lng1, lat2, lng2):
+  """Great-circle distance in miles between two points given in degrees"""
+  lat1, lng1, lat2, lng2 = map(math.radians, [lat1, lng1, lat2, lng2])
+  a = (math.sin((lat2 - lat1) / 2) ** 2 +
+       math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2)
+  return 2 * EARTH_RADIUS_MILES * math.asin(min(1.0, math.sqrt(a)))
+
+def geohash_encode(latitude, longitude, precision=GEOHASH_PRECISION):
+  """Standard base32 geohash of a point"""
+  lat_range = [-90.0, 90.0]
+  lng_range = [-180.0, 180.0]
+  chars = []
+  bit = 0
+  ch = 0
+  even = True
+  while len(chars) < precision:
+    rng, value = (lng_range, longitude) if even else (lat_range, latitude)
+    mid = (rng[0] + rng[1]) / 2
+    ch <<= 1
+    if value >= mid:
+      ch |= 1
+      rng[0] = mid
+    else:
+      rng[1] = mid
+    even = not even
+    bit += 1
+    if bit == 5:
+      chars.append(GEOHASH_ALPHABET[ch])
+      bit = 0
+      ch = 0
+  return "".join(chars)
+
+def geohash_bounds(cell):
+  """(south, west, north, east) of a geohash cell"""
+  lat_range = [-90.0, 90.0]
+  lng_range = [-180.0, 180.0]
+  even = True
+  for char in cell:
+    bits = GEOHASH_ALPHABET.index(char)
+    for shift in range(4, -1, -1):
+      rng = lng_range if even else lat_range
+      mid = (rng[0] + rng[1]) / 2
+      if bits >> shift & 1:
+        rng[0] = mid
+      else:
+        rng[1] = mid
+      even = not even
+  return lat_range[0], lng_range[0], lat_range[1], lng_range[1]
+
+def cell_size(precision):
+  """(height, width) in degrees of a geohash cell at the given precision"""
+  bits = 5 * precision
+  lng_bits = (bits + 1) // 2
+  lat_bits = bits // 2
+  return 180.0 / (2 ** lat_bits), 360.0 / (2 ** lng_bits)
+
+def neighbourhood(latitude, longitude, precision):
+  """Geohash of the cell containing the point plus its (up to) 8 neighbours"""
+  height, width = cell_size(precision)
+  cells = set()
+  for dlat in (-height, 0, height):
+    lat = latitude + dlat
+    if lat < -90.0 or lat > 90.0:
+      continue
+    for dlng in (-width, 0, width):
+      lng = (longitude + dlng + 180.0) % 360.0 - 180.0
+      cells.add(geohash_encode(lat, lng, precision))
+  return sorted(cells)
+
+def bounding_box(latitude, longitude, radius):
+  """(south, west, north, east) of the circle of `radius` miles around a point.
+  west > east means the box wraps across the antimeridian."""
+  angular = radius / EARTH_RADIUS_MILES
+  south = latitude - math.degrees(angular)
+  north = latitude + math.degrees(angular)
+  if south <= -90.0 or north >= 90.0:
+    return max(south, -90.0), -180.0, min(north, 90.0), 180.0
+  spread = math.sin(angular) / math.cos(math.radians(latitude))
+  if spread >= 1.0:
+    return south, -180.0, north, 180.0
+  dlng = math.degrees(math.asin(spread))
+  west = (longitude - dlng + 180.0) % 360.0 - 180.0
+  east = (longitude + dlng + 180.0) % 360.0 - 180.0
+  return south, west, north, east
+
+def cover(box, max_cells=32, max_precision=GEOHASH_PRECISION):
+  """Geohash cells at the finest precision, up to `max_precision`, that
+  covers `box` (as returned by bounding_box) with at most `max_cells` cells"""
+  south, west, north, east = box
+  spans = [(west, east)] if west <= east else [(west, 180.0), (-180.0, east)]
+  for precision in range(max_precision, 0, -1):
+    height, width = cell_size(precision)
+    rows = _grid(south + 90.0, north + 90.0, height, 180.0)
+    cols = [_grid(w + 180.0, e + 180.0, width, 360.0) for w, e in spans]
+    if len(rows) * sum(map(len, cols)) <= max_cells or precision == 1:
+      return sorted(set(geohash_encode(row * height - 90.0 + height / 2,
+                                       col * width - 180.0 + width / 2, precision)
+                        for row in rows for span in cols for col in span))
+
+def _grid(low, high, step, limit):
+  """Indexes of the grid cells of size `step` overlapping [low, high]"""
+  return xrange(int(low // step), int(min(high, limit - step / 2) // step) + 1)
+
+def cell_ranges(cells):
+  """Merged half-open [low, high) string ranges matching every geohash under
+  the given cells, so a cell lookup is an index range scan instead of a LIKE"""
+  ranges = []
+  for cell in sorted(cells):
+    high = _successor(cell)
+    if ranges and ranges[-1][1] == cell:
+      ranges[-1] = (ranges[-1][0], high)
+    else:
+      ranges.append((cell, high))
+  return ranges
+
+def _successor(cell):
+  """Smallest geohash greater than every geohash under `cell`"""
+  while cell and cell[-1] == GEOHASH_ALPHABET[-1]:
+    cell = cell[:-1]
+  if not cell:
+    return "~"
+  return cell[:-1] + GEOHASH_ALPHABET[GEOHASH_ALPHABET.index(cell[-1]) + 1]
@@ -0,0 +1,253 @@
+##################################################
+# REQUEST INSTRUMENTATION
+##################################################
+#
+# install(app) records, for every route, the wall time of each request and
+# how much of it went to SQL (statement count and time, from engine events),
+# password hashing, outbound HTTP and JSON encoding, as histograms served by
+# GET /api/metrics. Code marks the time it spends with
+#
+#   with timed("password"):
+#     ...
+#
+# which adds to the current request's breakdown and to a histogram of its
+# own, so work off the request threads (e.g. provider lookups) is measured
+# too.
+#
+# With PROFILE_ENABLED a sampling profiler snapshots the stacks of the
+# threads serving requests every PROFILE_INTERVAL seconds and keeps them for
+# the PROFILE_KEEP slowest requests. GET /api/metrics/profile returns those
+# in the collapsed "frame;frame;frame count" format flamegraph.pl reads.
+
+import sys
+import time
+import heapq
+import atexit
+import threading
+from contextlib import contextmanager
+from collections import defaultdict
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds (ms) of the histogram buckets; the last one is unbounded
+BUCKETS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+# Statement counts are bucketed by these upper bounds instead
+COUNT_BUCKETS = [1, 2, 3, 5, 10, 20, 50, 100, 200, 500]
+
+# Parts of a request broken out besides sql: timed() names
+COMPONENTS = ["password", "http", "json"]
+
+class Histogram(object):
+  """Counts of observations per bucket, plus their count and sum"""
+
+  def __init__(self, bounds=BUCKETS):
+    self.bounds = bounds
+    self.counts = [0] * (len(bounds) + 1)
+    self.count  = 0
+    self.sum    = 0.0
+
+  def observe(self, value):
+    index = 0
+    while index < len(self.bounds) and value > self.bounds[index]:
+      index += 1
+    self.counts[index] += 1
+    self.count += 1
+    self.sum += value
+
+  def percentile(self, pct):
+    """Upper bound of the bucket holding the pct-th percentile"""
+    rank = self.count * pct / 100.0
+    seen = 0
+    for bound, count in zip(self.bounds + [None], self.counts):
+      seen += count
+      if count and seen >= rank:
+        return bound
+    return None
+
+  @property
+  def serialize(self):
+    return {'count'   : self.count,
+            'sum'     : round(self.sum, 3),
+            'p50'     : self.percentile(50),
+            'p99'     : self.percentile(99),
+            'buckets' : [[bound, count] for bound, count in zip(self.bounds + [None], self.counts)]}
+
+class Metrics(object):
+  def __init__(self):
+    self.lock       = threading.Lock()
+    self.histograms = {}
+
+  def observe(self, name, value, bounds=BUCKETS):
+    with self.lock:
+      histogram = self.histograms.get(name)
+      if histogram is None:
+        histogram = self.histograms[name] = Histogram(bounds)
+      histogram.observe(value)
+
+  def clear(self):
+    with self.lock:
+      self.histograms.clear()
+
+  @property
+  def serialize(self):
+    with self.lock:
+      return dict((name, histogram.serialize) for name, histogram in self.histograms.items())
+
+class RequestStats(object):
+  """What one request spent its time on, in ms"""
+
+  def __init__(self, route):
+    self.route     = route
+    self.start     = time.time()
+    self.sql_count = 0
+    self.spent     = defaultdict(float)
+    self.stacks    = defaultdict(int)
+
+metrics = Metrics()
+current = threading.local()
+
+@contextmanager
+def timed(component):
+  start = time.time()
+  try:
+    yield
+  finally:
+    elapsed = (time.time() - start) * 1000
+    metrics.observe(component, elapsed)
+    stats = getattr(current, 'stats', None)
+    if stats is not None:
+      stats.spent[component] += elapsed
+
+##################################################
+# SQL
+##################################################
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  conn.info.setdefault('instrumentation_start', []).append(time.time())
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  elapsed = (time.time() - conn.info['instrumentation_start'].pop()) * 1000
+  metrics.observe("sql", elapsed)
+  stats = getattr(current, 'stats', None)
+  if stats is not None:
+    stats.sql_count += 1
+    stats.spent['sql'] += elapsed
+
+##################################################
+# SAMPLING PROFILER
+##################################################
+
+class Profiler(object):
+  """Samples the stacks of the threads serving requests and keeps them for
+  the `keep` slowest requests. The sampling thread is stopped when the
+  interpreter exits, before the modules it uses are torn down."""
+
+  def __init__(self, interval, keep):
+    self.interval = interval
+    self.keep     = keep
+    self.lock     = threading.Lock()
+    self.active   = {}
+    self.slowest  = []
+    self.thread   = None
+    self.stopping = threading.Event()
+    atexit.register(self.stop)
+
+  def start(self, stats):
+    with self.lock:
+      self.active[threading.current_thread().ident] = stats
+      if self.thread is None:
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._sample, args=(self.stopping,), name="profiler")
+        self.thread.daemon = True
+        self.thread.start()
+
+  def stop(self):
+    """End the sampling thread; the next request starts another"""
+    with self.lock:
+      thread, self.thread = self.thread, None
+      self.stopping.set()
+    if thread is not None and thread is not threading.current_thread():
+      thread.join()
+
+  def finish(self, stats, wall):
+    with self.lock:
+      self.active.pop(threading.current_thread().ident, None)
+      if stats.stacks:
+        entry = (wall, stats.start, stats.route, dict(stats.stacks))
+        if len(self.slowest) < self.keep:
+          heapq.heappush(self.slowest, entry)
+        elif entry > self.slowest[0]:
+          heapq.heapreplace(self.slowest, entry)
+
+  def collapsed(self):
+    """Samples of the slowest requests, rooted at "route (wall ms)" frames"""
+    with self.lock:
+      slowest = sorted(self.slowest, reverse=True)
+    lines = []
+    for wall, start, route, stacks in slowest:
+      root = "%s (%dms)" % (route, wall)
+      for stack, count in sorted(stacks.items()):
+        lines.append("%s;%s %d" % (root, stack, count))
+    return "\n".join(lines) + "\n" if lines else ""
+
+  def clear(self):
+    with self.lock:
+      self.slowest = []
+
+  def _sample(self, stopping):
+    own = threading.current_thread().ident
+    while not stopping.wait(self.interval):
+      frames = sys._current_frames()
+      with self.lock:
+        for ident, stats in self.active.items():
+          frame = frames.get(ident)
+          if frame is None or ident == own:
+            continue
+          stack = []
+          while frame is not None:
+            code = frame.f_code
+            stack.append("%s:%s" % (code.co_filename.rsplit("/", 1)[-1], code.co_name))
+            frame = frame.f_back
+          stats.stacks[";".join(reversed(stack))] += 1
+
+profiler = None
+
+##################################################
+# FLASK HOOKS
+##################################################
+
+def install(app):
+  """Instrument every request to `app` and SQL run through any engine"""
+  global profiler
+  app.config.setdefault('INSTRUMENTATION_ENABLED', True)
+  app.config.setdefault('PROFILE_ENABLED', False)
+  app.config.setdefault('PROFILE_INTERVAL', 0.005)
+  app.config.setdefault('PROFILE_KEEP', 20)
+  profiler = Profiler(app.config['PROFILE_INTERVAL'], app.config['PROFILE_KEEP'])
+
+  event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+  event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+
+  @app.before_request
+  def start_request():
+    if not app.config['INSTRUMENTATION_ENABLED']:
+      return
+    rule = request.url_rule.rule if request.url_rule else "unmatched"
+    current.stats = RequestStats("%s %s" % (request.method, rule))
+    if app.config['PROFILE_ENABLED']:
+      profiler.start(current.stats)
+
+  @app.teardown_request
+  def finish_request(exception=None):
+    stats = getattr(current, 'stats', None)
+    if stats is None:
+      return
+    current.stats = None
+    wall = (time.time() - stats.start) * 1000
+    profiler.finish(stats, wall)
+    metrics.observe(stats.route + " wall", wall)
+    metrics.observe(stats.route + " sql_count", stats.sql_count, COUNT_BUCKETS)
+    for component in ["sql"] + COMPONENTS:
+      metrics.observe("%s %s" % (stats.route, component), stats.spent[component])
@@ -0,0 +1,93 @@
+##################################################
+# BACKGROUND JOBS
+##################################################
+
+import sys
+import time
+import Queue
+import threading
+import traceback
+
+class JobQueue(object):
+  """Runs callables on a pool of daemon worker threads.
+
+  A job that raises is retried up to `retries` times, waiting
+  backoff * 2**attempt seconds (capped at max_backoff) before each retry
+  without holding a worker. When the retries run out `on_failure` is called
+  with the job's arguments. `teardown` runs on the worker thread after every
+  job. With eager=True jobs run inline on enqueue, retrying immediately."""
+
+  def __init__(self, workers=4, retries=3, backoff=1.0, max_backoff=60.0,
+               eager=False, teardown=None):
+    self.workers     = workers
+    self.retries     = retries
+    self.backoff     = backoff
+    self.max_backoff = max_backoff
+    self.eager       = eager
+    self.teardown    = teardown
+    self.jobs        = Queue.Queue()
+    self.pending     = 0
+    self.idle        = threading.Condition()
+    self.threads     = []
+
+  def enqueue(self, fn, args=(), on_failure=None):
+    job = (fn, args, on_failure, 0)
+    if self.eager:
+      while job:
+        job = self._run(job)
+      return
+    self._start()
+    with self.idle:
+      self.pending += 1
+    self.jobs.put(job)
+
+  def wait(self, timeout=None):
+    """Block until every enqueued job, including scheduled retries, is done"""
+    deadline = timeout and time.time() + timeout
+    with self.idle:
+      while self.pending:
+        remaining = deadline and deadline - time.time()
+        if remaining is not None and remaining <= 0:
+          return False
+        self.idle.wait(remaining)
+    return True
+
+  def _start(self):
+    while len(self.threads) < self.workers:
+      thread = threading.Thread(target=self._work, name="job-worker-%d" % len(self.threads))
+      thread.daemon = True
+      thread.start()
+      self.threads.append(thread)
+
+  def _work(self):
+    while True:
+      retry = self._run(self.jobs.get())
+      if self.teardown:
+        self.teardown()
+      if retry:
+        timer = threading.Timer(self._delay(retry[3]), self.jobs.put, [retry])
+        timer.daemon = True
+        timer.start()
+      else:
+        with self.idle:
+          self.pending -= 1
+          self.idle.notify_all()
+
+  def _run(self, job):
+    """Run a job, returning the job to retry if it failed and may be retried"""
+    fn, args, on_failure, attempt = job
+    try:
+      fn(*args)
+    except Exception:
+      traceback.print_exc(file=sys.stderr)
+      if attempt < self.retries:
+        return (fn, args, on_failure, attempt + 1)
+      if on_failure:
+        try:
+          on_failure(*args)
+        except Exception:
+          traceback.print_exc(file=sys.stderr)
+    return None
+
+  def _delay(self, attempt):
+    return min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
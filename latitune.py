@@ -1,12 +1,44 @@
 import os
+import sys
 from settings import *
 from models import *
-from controllers import *
+
+##
+# Application factory: applies `config` overrides to the app and, on the
+# first call, imports the controllers and registers their routes and the
+# request instrumentation. Importing this module only loads the settings and
+# models; external SDKs are imported when first used. Serve it with e.g.
+#
+#   gunicorn 'latitune:create_app()'
+##
+def create_app(**config):
+  app.config.update(config)
+  if 'api' not in app.blueprints:
+    import controllers
+    import instrumentation
+    instrumentation.install(app)
+    app.register_blueprint(controllers.api)
+  return app
 
 # MAIN RUN
 
 if __name__ == "__main__":
+  if sys.argv[1:] == ["reconcile_counts"]:
+    # Rebuild Blip.favorite_count / comment_count from the source tables
+    Blip.reconcile_counts()
+    sys.exit(0)
+  if sys.argv[1:] == ["sweep_providers"]:
+    # Schedule the provider lookups of songs left pending, and wait for them
+    import providers
+    while providers.sweep():
+      pass
+    providers.get_queue().wait()
+    sys.exit(0)
+  if sys.argv[1:] == ["rebuild_tiles"]:
+    # Recompute the tile aggregates behind GET /api/tiles
+    import tiles
+    tiles.rebuild()
+    sys.exit(0)
   # Bind to PORT if defined, otherwise default to 5000.
   port = int(os.environ.get('PORT', 5000))
-  app.run(host='0.0.0.0', port=port)
-
+  create_app().run(host='0.0.0.0', port=port)
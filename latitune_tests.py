@@ -1,9 +1,91 @@
 import os
+import sys
+import socket
+import signal
+import subprocess
+os.environ.setdefault('LATITUNE_SECRET_KEY', 'latitune tests')
 import latitune
+import controllers
+import providers
+import migrations
+import tiles
+import nearest
+import database
+import instrumentation
+import serialization
+import realtime
+import time
+import jobs
+import cache
+import shutil
 import unittest
 import tempfile
-from datetime import datetime
+from datetime import datetime, timedelta
 import ast
+import json
+import random
+import sqlalchemy
+from sqlalchemy import event
+
+latitune.create_app()
+
+class QueryCounter(object):
+  def __init__(self):
+    self.count = 0
+    self.statements = []
+
+  def __call__(self, conn, cursor, statement, parameters, context, executemany):
+    self.count += 1
+    self.statements.append((statement, parameters))
+
+query_counter = QueryCounter()
+event.listen(latitune.db.engine, "before_cursor_execute", query_counter)
+
+# The schema from before migrations.py, as latitune first created it
+ORIGINAL_SCHEMA = [
+  "CREATE TABLE user (id INTEGER PRIMARY KEY, name VARCHAR(80) UNIQUE, email VARCHAR(120) UNIQUE, pw_hash VARCHAR(120))",
+  "CREATE TABLE song (id INTEGER PRIMARY KEY, artist VARCHAR(80), title VARCHAR(120), album VARCHAR(80), echonestID VARCHAR(20))",
+  "CREATE TABLE song_provider (id INTEGER PRIMARY KEY, song_id INTEGER, provider VARCHAR(7), provider_key VARCHAR(50))",
+  "CREATE TABLE blip (id INTEGER PRIMARY KEY, song_id INTEGER, user_id INTEGER, longitude FLOAT, latitude FLOAT, timestamp DATETIME)",
+  "CREATE TABLE comment (id INTEGER PRIMARY KEY, blip_id INTEGER, user_id INTEGER, comment TEXT, timestamp DATETIME)",
+  "CREATE TABLE favorite (id INTEGER PRIMARY KEY, user_id INTEGER, blip_id INTEGER)"]
+
+class FakeEchoNestSong(object):
+  def __init__(self, id, tracks):
+    self.id     = id
+    self.tracks = tracks
+
+  def get_tracks(self, catalog):
+    return [{"foreign_id": "%s:track:%s" % (catalog, key)} for key in self.tracks.get(catalog, [])]
+
+class FakeEchoNest(object):
+  """Local stand-in for pyechonest.song"""
+  def __init__(self):
+    self.tracks   = {}
+    self.calls    = []
+    self.failures = 0
+    self.delay    = 0
+
+  def profile(self, ids, buckets):
+    self.calls.append(ids)
+    time.sleep(self.delay)
+    if self.failures:
+      self.failures -= 1
+      raise IOError("Echo Nest unavailable")
+    return [FakeEchoNestSong(echonest_id, self.tracks.get(echonest_id, {}))
+            for echonest_id in (ids if isinstance(ids, list) else [ids])]
+
+class RecordingQueue(object):
+  """Job queue that holds jobs until the test runs them"""
+  def __init__(self):
+    self.jobs = []
+
+  def enqueue(self, fn, args=(), on_failure=None):
+    self.jobs.append((fn, args))
+
+  def run(self):
+    for fn, args in self.jobs:
+      fn(*args)
 
 class latituneTestCase(unittest.TestCase):
 
@@ -23,10 +105,12 @@ class latituneTestCase(unittest.TestCase):
     userDict = ast.literal_eval(userResponse.data)['objects'][0]
     return userDict
 
-  def createSong(self,artist,title):
+  def createSong(self,artist,title,echonest_id="SOGTSKJ12A58A7B3A8",album=""):
     return self.app.put("/api/song",data=dict(
-        artist = artist,
-        title  = title,
+        artist      = artist,
+        title       = title,
+        echonest_id = echonest_id,
+        album       = album,
       ))
 
   def generateSong(self,artist="The Kinks",title="Big Sky"):
@@ -51,6 +135,12 @@ class latituneTestCase(unittest.TestCase):
     blipDict = ast.literal_eval(blipResponse.data)['objects'][0]
     return userDict, songDict, blipDict
 
+  def insertSong(self,artist="The Kinks",title="Big Sky",echonest_id="SOGTSKJ12A58A7B3A8"):
+    song = latitune.Song(artist,title,echonest_id)
+    latitune.db.session.add(song)
+    latitune.db.session.commit()
+    return song.id
+
   def createComment(self,user_id,password,blip_id,comment):
     return self.app.put("/api/blip/comment",data=dict(
         blip_id  = blip_id,
@@ -75,12 +165,63 @@ class latituneTestCase(unittest.TestCase):
       blip_id  = blip_id
     ))
 
+  def countQueries(self, url):
+    latitune.db.session.remove()
+    query_counter.count = 0
+    query_counter.statements = []
+    rv = self.app.get(url)
+    assert json.loads(rv.data)['meta']['status'] == 20
+    return query_counter.count
+
+  def fullScans(self, statement, parameters):
+    """Steps of the statement's query plan that read a whole table"""
+    conn = latitune.db.engine.raw_connection()
+    try:
+      cursor = conn.cursor()
+      if latitune.db.engine.dialect.name == "postgresql":
+        cursor.execute("SET enable_seqscan = off")
+        cursor.execute("EXPLAIN " + statement, parameters)
+        return [row[0] for row in cursor.fetchall() if "Seq Scan" in row[0]]
+      cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+      return [row[-1] for row in cursor.fetchall()
+              if row[-1].startswith("SCAN") and "USING" not in row[-1]]
+    finally:
+      conn.close()
+
+  def seedGraph(self, blips):
+    users = [latitune.User("user%d" % i, "user%d@example.com" % i, "testpass") for i in range(3)]
+    songs = [latitune.Song("Artist %d" % i, "Title %d" % i, "SO%d" % i) for i in range(2)]
+    latitune.db.session.add_all(users + songs)
+    latitune.db.session.commit()
+    for song in songs:
+      latitune.db.session.add(latitune.SongProvider(song.id, "Rdio", "t%d" % song.id))
+      latitune.db.session.add(latitune.SongProvider(song.id, "Spotify", "s%d" % song.id))
+    for i in range(blips):
+      latitune.db.session.add(latitune.Blip(songs[i % 2].id, users[0].id, 50.0 + i / 100.0, 50.0))
+    latitune.db.session.commit()
+    for i in range(blips):
+      latitune.db.session.add(latitune.Comment(users[i % 3].id, 1, "comment %d" % i))
+      latitune.db.session.add(latitune.Favorite(users[0].id, i + 1))
+    for user in users[1:]:
+      latitune.db.session.add(latitune.Favorite(user.id, 1))
+    latitune.db.session.commit()
+
   """
   Test stuff
   """
 
   def setUp(self):
     latitune.db.create_all()
+    latitune.app.config['JOBS_EAGER'] = True
+    latitune.app.config['METRICS_TOKEN'] = "metrics secret"
+    providers.queue  = None
+    providers.track_cache = None
+    controllers.response_cache.clear()
+    serialization.fragment_cache.clear()
+    nearest.index = None
+    realtime.broker = None
+    realtime.registry = realtime.Registry()
+    providers.client = self.echonest = FakeEchoNest()
     self.app = latitune.app.test_client()
 
   def tearDown(self):
@@ -161,6 +302,24 @@ class latituneTestCase(unittest.TestCase):
                          "longitude":50.0, "latitude":50.0,
                          "timestamp":now.isoformat()}
 
+  def test_blip_constructor_sets_geohash(self):
+    blip = latitune.Blip(1, 1, "-0.1278", "51.5074")
+    assert blip.geohash == "gcpvj0duq"
+
+  def test_blip_nearest_matches_full_scan(self):
+    rng = random.Random(42)
+    points = [(rng.uniform(40.0, 41.0), rng.uniform(-74.5, -73.5)) for i in range(300)]
+    points += [(rng.uniform(-90.0, 90.0), rng.uniform(-180.0, 180.0)) for i in range(100)]
+    for lat, lng in points:
+      latitune.db.session.add(latitune.Blip(1, 1, lng, lat))
+    latitune.db.session.commit()
+
+    for lat, lng in [(40.5, -74.0), (40.0, -73.5), (0.0, 179.99), (89.9, 0.0)]:
+      distance = lambda b: latitune.geo.haversine(lat, lng, b.latitude, b.longitude)
+      expected = sorted(latitune.Blip.query.all(), key=distance)[:25]
+      nearest = latitune.Blip.nearest(lat, lng)
+      assert [distance(b) for b in nearest] == [distance(b) for b in expected]
+
   """ Comment """
 
   def test_comment_constructor_applies_fields(self):
@@ -235,6 +394,237 @@ class latituneTestCase(unittest.TestCase):
   View Tests
   """
 
+  """ Query counts """
+
+  def test_read_endpoints_use_fixed_number_of_queries(self):
+    expected = {"/api/blip"                                  : 3,
+                "/api/blip?id=1"                             : 3,
+                "/api/blip?latitude=50&longitude=50"         : 10,
+                "/api/blip?latitude=50&longitude=50&radius=50": 4,
+                "/api/blip?latitude=50&longitude=50&hours=24": 4,
+                "/api/blip?north=51&south=49&east=51&west=49": 3,
+                "/api/blip/comment?id=1"                     : 4,
+                "/api/blip/comment?blip_id=1"                : 4,
+                "/api/blip/favorite?blip_id=1"               : 1,
+                "/api/blip/favorite?user_id=1"               : 3,
+                "/api/tiles?north=51&south=49&east=51&west=49": 1}
+    for size in [2, 12]:
+      latitune.db.drop_all()
+      latitune.db.create_all()
+      controllers.response_cache.clear()
+      self.seedGraph(size)
+      counts = {}
+      for url in expected:
+        serialization.fragment_cache.clear()
+        counts[url] = self.countQueries(url)
+      assert counts == expected, (size, counts)
+
+  def test_read_endpoint_queries_use_indexes(self):
+    self.seedGraph(30)
+    urls = ["/api/blip", "/api/blip?cursor=5", "/api/blip?id=1", "/api/song?id=1",
+            "/api/blip?latitude=50&longitude=50",
+            "/api/blip?latitude=50&longitude=50&radius=50",
+            "/api/blip?latitude=50&longitude=50&hours=24",
+            "/api/blip?north=51&south=49&east=51&west=49",
+            "/api/blip/comment?id=1", "/api/blip/comment?blip_id=1",
+            "/api/blip/favorite?blip_id=1", "/api/blip/favorite?user_id=1",
+            "/api/blip/favorite?user_id=1&cursor=5",
+            "/api/tiles?north=51&south=49&east=51&west=49"]
+    for url in urls:
+      self.countQueries(url)
+      for statement, parameters in list(query_counter.statements):
+        scans = self.fullScans(statement, parameters)
+        assert not scans, (url, statement, scans)
+
+  """ Startup """
+
+  def test_create_app_defers_sdk_imports(self):
+    script = ("import sys, latitune; latitune.create_app(); "
+              "print sorted(set(m.split('.')[0] for m in sys.modules) & set(['pyechonest']))")
+    output = subprocess.check_output([sys.executable, "-c", script], env=dict(os.environ, DATABASE_URL="sqlite://"))
+    assert output.strip() == "[]", output
+    assert providers.client is self.echonest
+    providers.client = None
+    assert providers.get_client().__name__ == "pyechonest.song"
+
+  def test_startup_requires_a_secret_key_outside_development(self):
+    env = dict((key, value) for key, value in os.environ.items()
+               if key not in ('LATITUNE_SECRET_KEY', 'LATITUNE_LOCAL'))
+    script = "import settings; print settings.app.secret_key"
+    process = subprocess.Popen([sys.executable, "-c", script], env=dict(env, DATABASE_URL="sqlite://"),
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, error = process.communicate()
+    assert process.returncode == 1 and "LATITUNE_SECRET_KEY" in error, error
+    output = subprocess.check_output([sys.executable, "-c", script], env=dict(env, LATITUNE_LOCAL="true"))
+    assert output.splitlines()[-1] == "latitune development secret", output
+
+  """ Database """
+
+  def test_pool_options_apply_to_server_databases(self):
+    options = {}
+    latitune.db.apply_driver_hacks(latitune.app, sqlalchemy.engine.url.make_url("postgresql://localhost/latitune"), options)
+    assert options['pool_size'] == latitune.app.config['SQLALCHEMY_POOL_SIZE']
+    assert options['max_overflow'] == latitune.app.config['SQLALCHEMY_MAX_OVERFLOW']
+    assert options['pool_recycle'] == latitune.app.config['SQLALCHEMY_POOL_RECYCLE']
+    options = {}
+    latitune.db.apply_driver_hacks(latitune.app, sqlalchemy.engine.url.make_url("sqlite://"), options)
+    assert 'pool_size' not in options and 'max_overflow' not in options
+
+  def test_pre_ping_replaces_dead_connections(self):
+    def kill(engine):
+      conn = engine.connect()
+      raw = conn.connection.connection
+      conn.close()
+      raw.close()
+    latitune.app.config['SQLALCHEMY_BINDS'] = {'pinged': 'sqlite://'}
+    try:
+      engine = latitune.db.get_engine(latitune.app, 'pinged')
+      for pool in range(2):
+        kill(engine)
+        assert engine.execute("SELECT 1").scalar() == 1
+        # Disposing replaces the pool; the new one pings too
+        latitune.db.dispose_engines(latitune.app)
+      latitune.app.config['SQLALCHEMY_POOL_PRE_PING'] = False
+      kill(engine)
+      self.assertRaises(sqlalchemy.exc.ProgrammingError, engine.execute, "SELECT 1")
+    finally:
+      latitune.app.config['SQLALCHEMY_POOL_PRE_PING'] = True
+      latitune.app.config['SQLALCHEMY_BINDS'] = None
+    # Only the app's engines are pinged
+    engine = sqlalchemy.create_engine("sqlite://", poolclass=sqlalchemy.pool.QueuePool, pool_size=1)
+    kill(engine)
+    self.assertRaises(sqlalchemy.exc.ProgrammingError, engine.execute, "SELECT 1")
+
+  def test_get_requests_cannot_write(self):
+    with latitune.app.test_request_context("/api/user", method="GET"):
+      latitune.db.session.add(latitune.User("ben","benweitzman@gmail.com","testpass"))
+      self.assertRaises(database.ReadOnlySessionError, latitune.db.session.commit)
+      latitune.db.session.rollback()
+    with latitune.app.test_request_context("/api/user", method="PUT"):
+      latitune.db.session.add(latitune.User("ben","benweitzman@gmail.com","testpass"))
+      latitune.db.session.commit()
+    assert latitune.User.query.count() == 1
+
+  def test_get_requests_read_from_replica(self):
+    latitune.app.config['SQLALCHEMY_BINDS'] = {'replica': 'sqlite://'}
+    try:
+      replica = latitune.db.get_engine(latitune.app, 'replica')
+      latitune.db.Model.metadata.create_all(replica)
+      replica.execute(latitune.Song.__table__.insert(), artist="Replica", title="Only", provider_status="resolved")
+      found = lambda: [song['artist'] for song in json.loads(self.app.get("/api/song?id=1").data)['objects']]
+      assert found() == ["Replica"]
+      self.createSong("The Kinks","Big Sky")
+      assert found() == ["Replica"]
+      assert [song.artist for song in latitune.Song.query] == ["The Kinks"]
+      # Responses that go into the cache are read from the primary
+      replica.execute(latitune.Blip.__table__.insert(), song_id=1, user_id=1, latitude=50.0, longitude=50.0,
+                      favorite_count=0, comment_count=0)
+      assert json.loads(self.app.get("/api/blip?id=1").data)['meta']['status'] == "ERR"
+    finally:
+      latitune.db.session.remove()
+      latitune.db.Model.metadata.drop_all(replica)
+      latitune.app.config['SQLALCHEMY_BINDS'] = None
+
+  """ Instrumentation """
+
+  def test_metrics_break_requests_down(self):
+    instrumentation.metrics.clear()
+    self.createUser("ben","testpass","benweitzman@gmail.com")
+    self.createSong("The Kinks","Big Sky")
+    self.seedGraph(2)
+    self.app.get("/api/blip?id=1")
+    self.app.get("/api/blip?id=2")
+    metrics = json.loads(self.app.get("/api/metrics?metrics_token=metrics%20secret").data)['objects'][0]
+    assert metrics["PUT /api/user wall"]['count'] == 1
+    assert metrics["PUT /api/user password"]['sum'] > 0
+    assert metrics["PUT /api/song http"]['count'] == 1
+    assert metrics["GET /api/blip sql_count"]['count'] == 2
+    assert metrics["GET /api/blip sql_count"]['sum'] == 6
+    assert metrics["GET /api/blip json"]['count'] == 2
+    assert metrics["sql"]['count'] >= 6
+    assert metrics["GET /api/blip wall"]['p99'] is not None
+
+  def test_metrics_require_the_metrics_token(self):
+    for path in ["/api/metrics", "/api/metrics?metrics_token=guess", "/api/metrics/profile"]:
+      assert json.loads(self.app.get(path).data)['meta']['status'] == 32, path
+    latitune.app.config['METRICS_TOKEN'] = None
+    assert json.loads(self.app.get("/api/metrics?metrics_token=").data)['meta']['status'] == 32
+
+  def test_profiler_keeps_slowest_requests(self):
+    profiler = instrumentation.profiler
+    instrumentation.profiler = instrumentation.Profiler(0.001, 1)
+    latitune.app.config['PROFILE_ENABLED'] = True
+    try:
+      self.echonest.delay = 0.05
+      self.createSong("The Kinks","Big Sky")
+      self.echonest.delay = 0
+      self.app.get("/api/song?id=1")
+      stacks = self.app.get("/api/metrics/profile?metrics_token=metrics%20secret").data.splitlines()
+    finally:
+      latitune.app.config['PROFILE_ENABLED'] = False
+      instrumentation.profiler.stop()
+      assert instrumentation.profiler.thread is None
+      instrumentation.profiler = profiler
+    assert stacks
+    assert all(line.startswith("PUT /api/song (") for line in stacks)
+    assert any("providers.py:lookup_tracks;" in line for line in stacks)
+    assert sum(int(line.rsplit(" ", 1)[1]) for line in stacks) >= 10
+
+  """ Migrations """
+
+  def test_migrations_upgrade_original_schema(self):
+    directory = tempfile.mkdtemp()
+    try:
+      engine = sqlalchemy.create_engine("sqlite:///" + os.path.join(directory, "old.db"))
+      for ddl in ORIGINAL_SCHEMA + [
+          "INSERT INTO user (id, name) VALUES (1, 'ben')",
+          "INSERT INTO song (id, artist, title) VALUES (1, 'The Kinks', 'Big Sky')",
+          "INSERT INTO song (id, artist, title) VALUES (2, 'The Kinks', 'Big Sky')",
+          "INSERT INTO song_provider (song_id, provider, provider_key) VALUES (1, 'Rdio', 't2')",
+          "INSERT INTO song_provider (song_id, provider, provider_key) VALUES (2, 'Rdio', 't2')",
+          "INSERT INTO song_provider (song_id, provider, provider_key) VALUES (2, 'Spotify', 's2')",
+          "INSERT INTO blip (id, song_id, user_id, longitude, latitude, timestamp) VALUES (1, 2, 1, -74.0, 40.71, '2013-01-05 12:00:00.000000')",
+          "INSERT INTO comment (blip_id, user_id, comment) VALUES (1, 1, 'hi')",
+          "INSERT INTO favorite (user_id, blip_id) VALUES (1, 1)",
+          "INSERT INTO favorite (user_id, blip_id) VALUES (1, 1)"]:
+        engine.execute(ddl)
+      assert migrations.upgrade(engine) == migrations.latest_version()
+      assert migrations.current_version(engine.connect()) == migrations.latest_version()
+      assert migrations.upgrade(engine) == migrations.latest_version()
+
+      assert engine.execute("SELECT id, provider_status FROM song").fetchall() == [(1, "resolved")]
+      assert engine.execute("SELECT song_id, provider, provider_key FROM song_provider ORDER BY id").fetchall() == \
+        [(1, "Rdio", "t2"), (1, "Spotify", "s2")]
+      assert engine.execute("SELECT song_id, geohash, day, favorite_count, comment_count FROM blip").fetchall() == \
+        [(1, latitune.geo.geohash_encode(40.71, -74.0), datetime(2013, 1, 5).toordinal(), 1, 1)]
+      assert engine.execute("SELECT count(*) FROM favorite").scalar() == 1
+      self.assertRaises(sqlalchemy.exc.IntegrityError, engine.execute,
+                        "INSERT INTO favorite (user_id, blip_id) VALUES (1, 1)")
+      expected = set(index.name for table in latitune.db.metadata.sorted_tables for index in table.indexes)
+      found = set(index['name'] for table in ['blip', 'song', 'song_provider', 'comment', 'favorite']
+                  for index in sqlalchemy.engine.reflection.Inspector.from_engine(engine).get_indexes(table))
+      assert expected <= found, expected - found
+    finally:
+      shutil.rmtree(directory)
+
+  def test_migrations_extend_comment_index(self):
+    engine = sqlalchemy.create_engine("sqlite://")
+    migrations.upgrade(engine)
+    engine.execute("DROP INDEX ix_comment_blip_timestamp")
+    engine.execute("CREATE INDEX ix_comment_blip_timestamp ON comment (blip_id, timestamp)")
+    migrations.stamp(engine.connect(), 4)
+    assert migrations.upgrade(engine) == migrations.latest_version()
+    indexes = sqlalchemy.engine.reflection.Inspector.from_engine(engine).get_indexes('comment')
+    assert [index['column_names'] for index in indexes if index['name'] == 'ix_comment_blip_timestamp'] == \
+      [['blip_id', 'timestamp', 'id']]
+
+  def test_migrations_create_and_stamp_empty_database(self):
+    engine = sqlalchemy.create_engine("sqlite://")
+    assert migrations.upgrade(engine) == migrations.latest_version()
+    conn = engine.connect()
+    assert migrations.current_version(conn) == migrations.latest_version()
+    assert set(latitune.db.metadata.tables) < set(engine.table_names())
+
   """ User """
 
   def test_new_user_creates_user_with_valid_data(self):
@@ -268,6 +658,44 @@ class latituneTestCase(unittest.TestCase):
     rv = self.app.get('/api/user?username=ben2&password=testpass')
     assert ast.literal_eval(rv.data) == {"meta":{"status":33,"error":"Username does not exist"},"objects":[]}
 
+  def createToken(self,username="ben",password="testpass"):
+    rv = self.app.put("/api/user/token",data=dict(username=username,password=password))
+    return json.loads(rv.data)['objects'][0]['token']
+
+  def test_token_authenticates_in_place_of_password(self):
+    user_dict = self.generateUser()
+    song_id = self.insertSong()
+    token = self.createToken()
+    rv = self.app.put("/api/blip",data=dict(song_id=song_id,longitude="50.0",latitude="50.0",
+                                             user_id=user_dict['id'],token=token))
+    assert json.loads(rv.data)['meta'] == {"status": 20}
+
+  def test_token_is_not_issued_for_bad_password(self):
+    self.generateUser()
+    rv = self.app.put("/api/user/token",data=dict(username="ben",password="testpa"))
+    assert json.loads(rv.data) == {"meta":{"status":32,"error":"Invalid Authentication"},"objects":[]}
+
+  def test_token_is_not_issued_for_token(self):
+    self.generateUser()
+    rv = self.app.put("/api/user/token",data=dict(username="ben",token=self.createToken()))
+    assert json.loads(rv.data) == {"meta":{"status":10,"error":"Missing Required Parameters"},"objects":[]}
+
+  def test_token_fails_for_other_user(self):
+    self.generateUser()
+    other_dict = self.generateUser(username="ben2",email="ben2@gmail.com")
+    rv = self.app.get('/api/user?user_id=%d&token=%s' % (other_dict['id'], self.createToken()))
+    assert json.loads(rv.data) == {"meta":{"status":32,"error":"Invalid Authentication"},"objects":[]}
+
+  def test_token_expires_and_is_revoked_by_password_change(self):
+    self.generateUser()
+    user = latitune.User.query.first()
+    assert user.check_token(user.issue_token(60)[0])
+    assert not user.check_token(user.issue_token(-1)[0])
+    assert not user.check_token("garbage")
+    token = user.issue_token(60)[0]
+    user.set_password("newpass")
+    assert not user.check_token(token)
+
   """ Song """
 
   def test_new_song_creates_song_with_valid_data(self):
@@ -282,6 +710,201 @@ class latituneTestCase(unittest.TestCase):
     ))
     assert ast.literal_eval(rv.data) == {"meta": {"status": 10, "error": "Missing Required Parameters"}, "objects": []}
 
+  def test_new_song_returns_before_providers_resolve(self):
+    self.echonest.tracks["SOGTSKJ12A58A7B3A8"] = {"rdio-US": ["t1"], "spotify-WW": ["s1"]}
+    providers.queue = RecordingQueue()
+    song_dict = json.loads(self.createSong("The Kinks","Big Sky").data)['objects'][0]
+    assert song_dict['provider_status'] == "pending"
+    assert song_dict['providers'] == []
+    assert self.echonest.calls == []
+
+    providers.queue.run()
+    song_dict = json.loads(self.app.get("/api/song?id=%d" % song_dict['id']).data)['objects'][0]
+    assert song_dict['provider_status'] == "resolved"
+    assert song_dict['providers'] == [{"provider": "Rdio", "provider_key": "t1"},
+                                      {"provider": "Spotify", "provider_key": "s1"}]
+
+  def test_provider_sweep_reschedules_lost_lookups(self):
+    self.echonest.tracks["SO1"] = {"rdio-US": ["t1"]}
+    providers.queue = RecordingQueue()
+    now = datetime.now()
+    songs = latitune.Song.__table__
+    latitune.db.session.execute(songs.insert(), [
+      {"artist": "A", "title": "Lost", "echonestID": "SO1", "provider_status": "pending",
+       "provider_scheduled": now - timedelta(hours=1)},
+      {"artist": "B", "title": "From before migration 6", "echonestID": "SO1", "provider_status": "pending",
+       "provider_scheduled": None},
+      {"artist": "C", "title": "In flight", "echonestID": "SO1", "provider_status": "pending",
+       "provider_scheduled": now},
+      {"artist": "D", "title": "Failed", "echonestID": "SO1", "provider_status": "failed",
+       "provider_scheduled": None}])
+    latitune.db.session.commit()
+    assert providers.sweep() == [1, 2]
+    assert providers.sweep() == []
+    providers.queue.run()
+    statuses = [song.provider_status for song in latitune.Song.query.order_by(latitune.Song.id)]
+    assert statuses == ["resolved", "resolved", "pending", "failed"]
+
+  def test_provider_sweep_is_enqueued_once_per_interval(self):
+    providers.queue = RecordingQueue()
+    latitune.app.config['JOBS_EAGER'] = False
+    providers.last_sweep = 0
+    try:
+      self.app.get("/api/song?id=1")
+      self.app.get("/api/song?id=1")
+    finally:
+      latitune.app.config['JOBS_EAGER'] = True
+    assert providers.queue.jobs == [(providers.run_sweep, ())]
+
+  def test_prefork_worker_drains_provider_lookups(self):
+    import prefork
+    done = []
+    providers.queue = jobs.JobQueue(workers=1)
+    providers.queue.enqueue(lambda: (time.sleep(0.2), done.append(1)))
+    prefork.Worker(latitune.app, None, "threaded", 1, 5).drain()
+    assert done == [1]
+
+  def test_new_song_retries_provider_lookup(self):
+    self.echonest.tracks["SOGTSKJ12A58A7B3A8"] = {"rdio-US": ["t1"]}
+    self.echonest.failures = 2
+    song_dict = self.generateSong()
+    assert song_dict['provider_status'] == "resolved"
+    assert song_dict['providers'] == [{"provider": "Rdio", "provider_key": "t1"}]
+    assert len(self.echonest.calls) == 3
+
+  def test_new_song_marks_failed_provider_lookup(self):
+    self.echonest.failures = 10
+    song_dict = self.generateSong()
+    assert song_dict['provider_status'] == "failed"
+    assert len(self.echonest.calls) == latitune.app.config['PROVIDER_RETRIES'] + 1
+
+  def test_provider_lookups_are_cached_by_echonest_id(self):
+    self.echonest.tracks["SOGTSKJ12A58A7B3A8"] = {"spotify-WW": ["s1"]}
+    first = self.generateSong(artist="The Kinks", title="Big Sky")
+    second = self.generateSong(artist="Kinks", title="Big Sky (Remastered)")
+    assert first['id'] != second['id']
+    assert second['providers'] == [{"provider": "Spotify", "provider_key": "s1"}]
+    assert self.echonest.calls == [["SOGTSKJ12A58A7B3A8"]]
+
+  def test_new_songs_batch_upserts_and_resolves_in_one_lookup(self):
+    existing_id = self.insertSong("The Kinks","Big Sky","SO1")
+    self.echonest.tracks = {"SO2": {"rdio-US": ["t2"]}, "SO3": {"spotify-WW": ["s3"]}}
+    songs = [{"artist": "The Kinks", "title": "Big Sky", "echonest_id": "SO1"},
+             {"artist": "The Kinks", "title": "Waterloo Sunset", "echonest_id": "SO2", "album": "Something Else"},
+             {"artist": "The Zombies", "title": "Time of the Season", "echonest_id": "SO3"},
+             {"artist": "The Kinks", "title": "Waterloo Sunset", "echonest_id": "SO2"}]
+    rv_dict = json.loads(self.app.put("/api/song/batch",data=dict(songs=json.dumps(songs))).data)
+    objects = rv_dict['objects']
+    assert [song['id'] for song in objects] == [existing_id, 2, 3, 2]
+    assert objects[1]['album'] == "Something Else"
+    assert objects[1]['providers'] == [{"provider": "Rdio", "provider_key": "t2"}]
+    assert objects[2]['providers'] == [{"provider": "Spotify", "provider_key": "s3"}]
+    assert self.echonest.calls == [["SO2", "SO3"]]
+    assert latitune.Song.query.count() == 3
+
+  def test_new_songs_batch_with_invalid_data(self):
+    rv = self.app.put("/api/song/batch",data=dict(songs=json.dumps([{"artist": "The Kinks"}])))
+    assert json.loads(rv.data) == {"meta": {"status": 10, "error": "Missing Required Parameters"}, "objects": []}
+
+  def test_song_upsert_many_looks_up_large_batches_in_chunks(self):
+    self.insertSong("Artist 0","Title 0","SO0")
+    songs = [{"artist": "Artist %d" % i, "title": "Title %d" % i, "echonest_id": "SO%d" % i} for i in range(1100)]
+    found, created = latitune.Song.upsert_many(songs)
+    assert len(found) == 1100
+    assert len(created) == 1099
+    assert latitune.Song.query.count() == 1100
+
+  def test_song_upsert_survives_concurrent_insert(self):
+    original = latitune.Song.__dict__['by_keys']
+    by_keys = latitune.Song.by_keys
+    calls = []
+    def racing_by_keys(keys):
+      found = by_keys(keys)
+      if not calls:
+        latitune.db.session.execute(latitune.Song.__table__.insert(),
+                                    [{"artist": "The Kinks", "title": "Big Sky", "echonestID": "SO1"}])
+        latitune.db.session.commit()
+      calls.append(keys)
+      return found
+    latitune.Song.by_keys = staticmethod(racing_by_keys)
+    try:
+      songs, created = latitune.Song.upsert_many([{"artist": "The Kinks", "title": "Big Sky", "echonest_id": "SO1"}])
+    finally:
+      latitune.Song.by_keys = original
+    assert created == []
+    assert latitune.Song.query.count() == 1
+
+  def test_lru_cache_evicts_and_expires(self):
+    now = [0]
+    lru = cache.LRUCache(maxsize=2, ttl=10, clock=lambda: now[0])
+    lru.set("a", 1)
+    lru.set("b", 2)
+    lru.get("a")
+    lru.set("c", 3)
+    assert lru.get("b") is None
+    assert lru.get("a") == 1
+    now[0] = 10
+    assert lru.get("a") is None
+    assert lru.stats == {"hits": 2, "misses": 2, "size": 1}
+
+  def test_lru_cache_warms_from_disk(self):
+    directory = tempfile.mkdtemp()
+    try:
+      path = os.path.join(directory, "tracks")
+      lru = cache.LRUCache(store=cache.DiskStore(path))
+      lru.set("SO1", {"rdio-US": ["t1"]})
+      lru.store.close()
+      lru = cache.LRUCache(store=cache.DiskStore(path))
+      lru.warm()
+      assert lru.get("SO1") == {"rdio-US": ["t1"]}
+      lru.store.close()
+    finally:
+      shutil.rmtree(directory)
+
+  def test_disk_store_is_shared_by_forked_writers(self):
+    directory = tempfile.mkdtemp()
+    try:
+      path = os.path.join(directory, "tracks")
+      store = cache.DiskStore(path)
+      store.set("SO0", (None, "parent"))
+      children = []
+      for n in range(1, 4):
+        pid = os.fork()
+        if not pid:
+          code = 0
+          try:
+            for i in range(20):
+              store.set("SO%d-%d" % (n, i), (None, n))
+          except Exception:
+            code = 1
+          os._exit(code)
+        children.append(pid)
+      for pid in children:
+        assert os.waitpid(pid, 0)[1] == 0
+      store.set("SO4", (None, "parent"))
+      store.close()
+      entries = dict(cache.DiskStore(path).items())
+      assert len(entries) == 62
+      assert entries["SO3-19"] == (None, 3) and entries["SO4"] == (None, "parent")
+    finally:
+      shutil.rmtree(directory)
+
+  def test_job_queue_retries_on_worker_threads(self):
+    attempts = []
+    failed = []
+    def flaky(n):
+      attempts.append(n)
+      if len(attempts) < 3:
+        raise IOError("try again")
+    def broken(n):
+      raise IOError("never works")
+    queue = jobs.JobQueue(workers=2, retries=2, backoff=0.01)
+    queue.enqueue(flaky, (1,), on_failure=failed.append)
+    queue.enqueue(broken, (2,), on_failure=failed.append)
+    assert queue.wait(5)
+    assert attempts == [1, 1, 1]
+    assert failed == [2]
+
   """ Blip """
 
   def test_new_blip_creates_blip_with_valid_data(self):
@@ -299,7 +922,9 @@ class latituneTestCase(unittest.TestCase):
                                     "user_id"   : user_dict['id'],
                                     "longitude" : 50.0,
                                     "latitude"  : 50.0,
-                                    "timestamp" : now}]}
+                                    "timestamp" : now,
+                                    "favorite_count" : 0,
+                                    "comment_count"  : 0}]}
 
   def test_new_blip_creates_blip_with_invalid_data(self):
     rv = self.app.put("/api/blip",data=dict(
@@ -334,6 +959,120 @@ class latituneTestCase(unittest.TestCase):
 
     assert ast.literal_eval(rv.data) == {"meta": {"status":32, "error": "Invalid Authentication"}, "objects": []}
 
+  def test_new_blips_batch_reports_status_per_blip(self):
+    user_dict = self.generateUser()
+    song_id = self.insertSong()
+    blips = [{"song_id": song_id, "latitude": 50.0, "longitude": 50.0},
+             {"song_id": 123, "latitude": 50.0, "longitude": 50.0},
+             {"song_id": song_id, "latitude": 50.0},
+             {"song_id": song_id, "latitude": 51.5, "longitude": -0.1}]
+    latitune.db.session.remove()
+    query_counter.count = 0
+    rv = self.app.put("/api/blip/batch",data=dict(user_id=user_dict['id'],password="testpass",
+                                                   blips=json.dumps(blips)))
+    # user, songs, blips insert, then the tiles: lookup of tiles and songs, tile and song inserts
+    assert query_counter.count == 7
+    assert json.loads(rv.data) == {"meta": {"status": 20},
+                                   "objects": [{"status": 20},
+                                               {"status": 40, "error": "Song ID does not exist"},
+                                               {"status": 10, "error": "Missing Required Parameters"},
+                                               {"status": 20}]}
+    stored = latitune.Blip.query.order_by(latitune.Blip.id).all()
+    assert [(b.latitude, b.longitude, b.user_id) for b in stored] == [(50.0, 50.0, 1), (51.5, -0.1, 1)]
+    assert stored[1].geohash == latitune.geo.geohash_encode(51.5, -0.1)
+
+  def test_new_blips_batch_reports_invalid_blips_without_failing_the_rest(self):
+    user_dict = self.generateUser()
+    song_id = self.insertSong()
+    blips = [{"song_id": "one", "latitude": 50.0, "longitude": 50.0},
+             {"song_id": song_id, "latitude": "north", "longitude": 50.0},
+             {"song_id": song_id, "latitude": None, "longitude": 50.0},
+             "not a blip",
+             {"song_id": str(song_id), "latitude": "51.5", "longitude": "-0.1"}]
+    rv = self.app.put("/api/blip/batch",data=dict(user_id=user_dict['id'],password="testpass",
+                                                   blips=json.dumps(blips)))
+    assert json.loads(rv.data) == {"meta": {"status": 20},
+                                   "objects": [{"status": 11, "error": "Invalid Parameters"},
+                                               {"status": 11, "error": "Invalid Parameters"},
+                                               {"status": 11, "error": "Invalid Parameters"},
+                                               {"status": 10, "error": "Missing Required Parameters"},
+                                               {"status": 20}]}
+    assert [(b.latitude, b.longitude) for b in latitune.Blip.query.all()] == [(51.5, -0.1)]
+
+  """ Tiles """
+
+  def tileState(self):
+    return ([(t.cell, t.count, t.latest, t.top_songs) for t in latitune.Tile.query.order_by(latitune.Tile.cell)],
+            [(s.cell, s.song_id, s.count) for s in latitune.TileSong.query.order_by(latitune.TileSong.cell, latitune.TileSong.song_id)])
+
+  def test_tiles_follow_created_blips(self):
+    user_dict = self.generateUser()
+    songs = [self.insertSong(title="Song %d" % i) for i in range(4)]
+    self.createBlip("50.0","50.0",songs[0],user_dict['id'],"testpass")
+    blips = [{"song_id": songs[i % 3 + 1], "latitude": 50.0, "longitude": 50.0} for i in range(5)]
+    blips.append({"song_id": songs[0], "latitude": 40.0, "longitude": -74.0})
+    self.app.put("/api/blip/batch",data=dict(user_id=user_dict['id'],password="testpass",blips=json.dumps(blips)))
+
+    rv_dict = json.loads(self.app.get('/api/tiles?north=50.001&south=49.999&east=50.001&west=49.999').data)
+    assert rv_dict['meta'] == {'status': 20, 'precision': 6}
+    assert len(rv_dict['objects']) == 1
+    tile = rv_dict['objects'][0]
+    assert tile['cell'] == latitune.geo.geohash_encode(50.0, 50.0, 6)
+    assert abs(tile['latitude'] - 50.0) < 0.01 and abs(tile['longitude'] - 50.0) < 0.01
+    assert tile['count'] == 6
+    assert tile['songs'] == [[songs[1], 2], [songs[2], 2], [songs[0], 1]]
+    assert tile['latest'] == max(b.timestamp for b in latitune.Blip.query.filter_by(latitude=50.0)).isoformat()
+
+    rv_dict = json.loads(self.app.get('/api/tiles?north=90&south=-90&east=180&west=-180').data)
+    assert rv_dict['meta']['precision'] == 1
+    assert sorted(t['count'] for t in rv_dict['objects']) == [1, 6]
+    rv_dict = json.loads(self.app.get('/api/tiles?north=90&south=-90&east=180&west=-180&precision=3').data)
+    assert rv_dict['meta']['precision'] == 1
+
+  def test_blips_are_not_saved_when_their_tiles_cannot_be(self):
+    user_dict = self.generateUser()
+    song_id = self.insertSong()
+    top_songs = tiles.top_songs
+    def conflict(songs):
+      raise sqlalchemy.exc.IntegrityError("tile", None, None)
+    tiles.top_songs = conflict
+    try:
+      rv = self.createBlip("50.0","50.0",song_id,user_dict['id'],"testpass")
+      assert json.loads(rv.data)['meta']['status'] == "ERR"
+      blips = json.dumps([{"song_id": song_id, "latitude": 50.0, "longitude": 50.0}])
+      rv = self.app.put("/api/blip/batch",data=dict(user_id=user_dict['id'],password="testpass",blips=blips))
+      assert json.loads(rv.data)['meta']['status'] == "ERR"
+    finally:
+      tiles.top_songs = top_songs
+    assert latitune.Blip.query.count() == 0 and latitune.Tile.query.count() == 0
+    rv = self.createBlip("50.0","50.0",song_id,user_dict['id'],"testpass")
+    assert json.loads(rv.data)["objects"][0]["id"] == 1
+    assert [tile.count for tile in latitune.Tile.query] == [1] * len(tiles.TILE_PRECISIONS)
+
+  def test_tiles_rebuild_matches_incremental_updates(self):
+    user_dict = self.generateUser()
+    songs = [self.insertSong(title="Song %d" % i) for i in range(6)]
+    rng = random.Random(4)
+    for batch in range(4):
+      blips = [{"song_id": rng.choice(songs), "latitude": rng.gauss(50.0, 1), "longitude": rng.gauss(50.0, 1)}
+               for i in range(50)]
+      self.app.put("/api/blip/batch",data=dict(user_id=user_dict['id'],password="testpass",blips=json.dumps(blips)))
+    incremental = self.tileState()
+    assert incremental[0][0][1] == 200
+    numpy = tiles.numpy
+    try:
+      for tiles.numpy in set([None, numpy]):
+        tiles.rebuild()
+        latitune.db.session.remove()
+        assert self.tileState() == incremental
+    finally:
+      tiles.numpy = numpy
+
+  def test_new_blips_batch_requires_authentication(self):
+    user_dict = self.generateUser()
+    rv = self.app.put("/api/blip/batch",data=dict(user_id=user_dict['id'],password="testpa",blips="[]"))
+    assert json.loads(rv.data) == {"meta": {"status": 32, "error": "Invalid Authentication"}, "objects": []}
+
   def test_get_blip_by_id_with_valid_data(self):
     user_dict = self.generateUser()
     song_dict = self.generateSong()
@@ -351,7 +1090,9 @@ class latituneTestCase(unittest.TestCase):
                                    "user_id"   : user_dict['id'],
                                    "longitude" : 50.0,
                                    "latitude"  : 50.0,
-                                   "timestamp" : now}]}
+                                   "timestamp" : now,
+                                   "favorite_count" : 0,
+                                   "comment_count"  : 0}]}
 
   def test_get_nearby_blips_with_valid_data(self):
     user_dict = self.generateUser()
@@ -371,13 +1112,91 @@ class latituneTestCase(unittest.TestCase):
                                      "user_id"   : user_dict['id'],
                                      "longitude" : 50.0,
                                      "latitude"  : 50.0,
-                                     "timestamp" : now},
+                                     "timestamp" : now,
+                                     "favorite_count" : 0,
+                                     "comment_count"  : 0},
                                     {"id"        : 2,
                                      "song"      : song_dict,
                                      "user_id"   : user_dict['id'],
                                      "longitude" : 51.0,
                                      "latitude"  : 51.0,
-                                     "timestamp" : now}]}
+                                     "timestamp" : now,
+                                     "favorite_count" : 0,
+                                     "comment_count"  : 0}]}
+
+  def useNearestEngine(self, engine):
+    latitune.db.session.remove()
+    latitune.app.config['NEAREST_ENGINE'] = engine
+
+  @unittest.skipIf(nearest.numpy is None, "NumPy is not installed")
+  def test_memory_nearest_engine_matches_sql(self):
+    self.seedGraph(0)
+    rng = random.Random(7)
+    latitune.db.session.execute(latitune.Blip.__table__.insert(), [
+      latitune.Blip.row(1, 1, rng.gauss(50.0, 0.5), rng.gauss(50.0, 0.5)) for i in range(400)])
+    latitune.db.session.commit()
+    urls = ["/api/blip?latitude=50.0&longitude=50.0",
+            "/api/blip?latitude=50.7&longitude=49.1",
+            "/api/blip?latitude=-20.0&longitude=120.0",
+            "/api/blip?latitude=50.0&longitude=50.0&radius=20&limit=30",
+            "/api/blip?latitude=49.5&longitude=50.5&radius=5"]
+    results = {}
+    try:
+      for engine in ["sql", "memory"]:
+        self.useNearestEngine(engine)
+        for url in urls:
+          pages = []
+          page = json.loads(self.app.get(url).data)
+          pages.append([blip['id'] for blip in page['objects']])
+          while 'cursor' in page['meta']:
+            page = json.loads(self.app.get(url + "&cursor=" + page['meta']['cursor']).data)
+            pages.append([blip['id'] for blip in page['objects']])
+          results[(engine, url)] = pages
+    finally:
+      latitune.app.config['NEAREST_ENGINE'] = "sql"
+    for url in urls:
+      assert results[("memory", url)] == results[("sql", url)], url
+    assert len(results[("memory", urls[3])]) > 2
+    assert len(nearest.index) == 400
+
+  @unittest.skipIf(nearest.numpy is None, "NumPy is not installed")
+  def test_memory_nearest_engine_follows_inserts(self):
+    user_dict = self.generateUser()
+    song_id = self.insertSong()
+    self.createBlip("10.0","10.0",song_id,user_dict['id'],"testpass")
+    interval = latitune.app.config['NEAREST_SYNC_INTERVAL']
+    try:
+      self.useNearestEngine("memory")
+      latitune.app.config['NEAREST_SYNC_INTERVAL'] = 3600
+      ids = lambda url: [blip['id'] for blip in json.loads(self.app.get(url).data)['objects']]
+      assert ids("/api/blip?latitude=50.0&longitude=50.0") == [1]
+      self.createBlip("50.0","50.0",song_id,user_dict['id'],"testpass")
+      self.app.put("/api/blip/batch",data=dict(user_id=user_dict['id'],password="testpass",blips=json.dumps(
+        [{"song_id": song_id, "latitude": 50.1, "longitude": 50.0}])))
+      assert ids("/api/blip?latitude=50.0&longitude=50.0") == [2, 3, 1]
+      assert ids("/api/blip?latitude=50.0&longitude=50.0&radius=10") == [2, 3]
+    finally:
+      latitune.app.config['NEAREST_ENGINE'] = "sql"
+      latitune.app.config['NEAREST_SYNC_INTERVAL'] = interval
+
+  def test_index_refresh_failure_does_not_fail_saved_blips(self):
+    user_dict = self.generateUser()
+    song_id = self.insertSong()
+    blips_added = nearest.blips_added
+    def broken():
+      raise RuntimeError("index refresh failed")
+    nearest.blips_added = broken
+    stderr, sys.stderr = sys.stderr, tempfile.TemporaryFile()
+    try:
+      rv = self.createBlip("50.0","50.0",song_id,user_dict['id'],"testpass")
+      assert json.loads(rv.data)['meta']['status'] == 20
+      blips = json.dumps([{"song_id": song_id, "latitude": 50.0, "longitude": 50.0}])
+      rv = self.app.put("/api/blip/batch",data=dict(user_id=user_dict['id'],password="testpass",blips=blips))
+      assert json.loads(rv.data)['objects'] == [{"status": 20}]
+    finally:
+      nearest.blips_added = blips_added
+      sys.stderr = stderr
+    assert latitune.Blip.query.count() == 2
 
   def test_get_all_blips_with_valid_data(self):
     user_dict = self.generateUser()
@@ -397,13 +1216,227 @@ class latituneTestCase(unittest.TestCase):
                                      "user_id"   : user_dict['id'],
                                      "longitude" : 50.0,
                                      "latitude"  : 50.0,
-                                     "timestamp" : now},
+                                     "timestamp" : now,
+                                     "favorite_count" : 0,
+                                     "comment_count"  : 0},
                                     {"id"        : 2,
                                      "song"      : song_dict,
                                      "user_id"   : user_dict['id'],
                                      "longitude" : 51.0,
                                      "latitude"  : 51.0,
-                                     "timestamp" : now}]}
+                                     "timestamp" : now,
+                                     "favorite_count" : 0,
+                                     "comment_count"  : 0}]}
+
+  def test_get_blips_within_radius_pages_by_distance(self):
+    user_dict = self.generateUser()
+    song_id = self.insertSong()
+    for lat in ["50.3","50.0","50.1","50.2","52.0"]:
+      self.createBlip(lat,"50.0",song_id,user_dict['id'],"testpass")
+
+    rv_dict = json.loads(self.app.get('/api/blip?latitude=50.0&longitude=50.0&radius=50&limit=2').data)
+    assert [b['latitude'] for b in rv_dict['objects']] == [50.0, 50.1]
+    cursor = rv_dict['meta']['cursor']
+    rv_dict = json.loads(self.app.get('/api/blip?latitude=50.0&longitude=50.0&radius=50&limit=2&cursor='+cursor).data)
+    assert [b['latitude'] for b in rv_dict['objects']] == [50.2, 50.3]
+    cursor = rv_dict['meta']['cursor']
+    rv_dict = json.loads(self.app.get('/api/blip?latitude=50.0&longitude=50.0&radius=50&limit=2&cursor='+cursor).data)
+    assert rv_dict == {"meta": {"status": 20}, "objects": []}
+
+  def test_get_blip_feed_ranks_recent_nearby_blips(self):
+    user_dict = self.generateUser()
+    song_id = self.insertSong()
+    for lat in ["50.0","50.0","50.1","50.0","52.0"]:
+      self.createBlip(lat,"50.0",song_id,user_dict['id'],"testpass")
+    for blip_id, hours in [(2, 10), (4, 72)]:
+      blip = latitune.Blip.query.get(blip_id)
+      blip.timestamp = blip.timestamp - timedelta(hours=hours)
+      blip.day = blip.timestamp.toordinal()
+    latitune.db.session.commit()
+
+    rv_dict = json.loads(self.app.get('/api/blip?latitude=50.0&longitude=50.0&hours=24&limit=2').data)
+    assert [b['id'] for b in rv_dict['objects']] == [1, 3]
+    cursor = rv_dict['meta']['cursor']
+    rv_dict = json.loads(self.app.get('/api/blip?latitude=50.0&longitude=50.0&hours=24&limit=2&cursor='+cursor).data)
+    assert [b['id'] for b in rv_dict['objects']] == [2]
+    assert 'cursor' not in rv_dict['meta']
+    rv_dict = json.loads(self.app.get('/api/blip?latitude=50.0&longitude=50.0&hours=96').data)
+    assert [b['id'] for b in rv_dict['objects']] == [1, 3, 2, 4]
+
+  def test_get_blips_within_radius_keeps_fractional_coordinates(self):
+    user_dict = self.generateUser()
+    song_id = self.insertSong()
+    self.createBlip("50.9","50.9",song_id,user_dict['id'],"testpass")
+    self.createBlip("50.0","50.0",song_id,user_dict['id'],"testpass")
+    rv_dict = json.loads(self.app.get('/api/blip?latitude=50.9&longitude=50.9&radius=5').data)
+    assert [b['latitude'] for b in rv_dict['objects']] == [50.9]
+
+  def test_get_blips_in_bounding_box_across_antimeridian(self):
+    user_dict = self.generateUser()
+    song_id = self.insertSong()
+    for lng in ["179.5","-179.5","0.0","178.0"]:
+      self.createBlip("10.0",lng,song_id,user_dict['id'],"testpass")
+
+    rv_dict = json.loads(self.app.get('/api/blip?south=9&north=11&west=179&east=-179&limit=1').data)
+    assert [b['longitude'] for b in rv_dict['objects']] == [179.5]
+    rv_dict = json.loads(self.app.get('/api/blip?south=9&north=11&west=179&east=-179&limit=1&cursor='+rv_dict['meta']['cursor']).data)
+    assert [b['longitude'] for b in rv_dict['objects']] == [-179.5]
+
+  def test_get_all_blips_pages_by_cursor(self):
+    self.seedGraph(3)
+    rv_dict = json.loads(self.app.get('/api/blip?limit=2').data)
+    assert [b['id'] for b in rv_dict['objects']] == [1, 2]
+    rv_dict = json.loads(self.app.get('/api/blip?limit=2&cursor='+rv_dict['meta']['cursor']).data)
+    assert [b['id'] for b in rv_dict['objects']] == [3]
+    assert rv_dict['meta'] == {"status": 20}
+
+  def test_get_all_blips_streams_in_batches(self):
+    self.seedGraph(5)
+    batch_size = controllers.STREAM_BATCH_SIZE
+    controllers.STREAM_BATCH_SIZE = 2
+    try:
+      rv = self.app.get('/api/blip?stream=true')
+      streamed = json.loads(rv.data)
+    finally:
+      controllers.STREAM_BATCH_SIZE = batch_size
+    assert rv.mimetype == 'application/json'
+    assert streamed == json.loads(self.app.get('/api/blip').data)
+
+  def test_get_blip_by_id_is_served_from_cache(self):
+    self.seedGraph(2)
+    hits = controllers.response_cache.stats['hits']
+    assert self.countQueries('/api/blip?id=1') == 3
+    assert self.countQueries('/api/blip?id=1') == 0
+    assert self.countQueries('/api/blip?id=2') == 3
+    assert controllers.response_cache.stats['hits'] == hits + 1
+
+  def test_blip_fragments_are_reused_until_counts_change(self):
+    self.seedGraph(4)
+    latitune.app.config['RESPONSE_CACHE_ENABLED'] = False
+    try:
+      first = json.loads(self.app.get('/api/blip').data)
+      assert self.countQueries('/api/blip') == 2
+      assert json.loads(self.app.get('/api/blip').data) == first
+      user = latitune.User.query.get(2)
+      self.app.put("/api/blip/favorite", data=dict(user_id=user.id, password="testpass", blip_id=2))
+      blips = json.loads(self.app.get('/api/blip').data)['objects']
+    finally:
+      latitune.app.config['RESPONSE_CACHE_ENABLED'] = True
+    assert blips[1]['favorite_count'] == first['objects'][1]['favorite_count'] + 1
+    assert blips[0] == first['objects'][0]
+
+  def test_get_blip_normalized_sends_songs_once(self):
+    self.seedGraph(4)
+    nested = json.loads(self.app.get('/api/blip').data)
+    normalized = json.loads(self.app.get('/api/blip?shape=normalized').data)
+    assert [song['id'] for song in normalized['songs']] == [1, 2]
+    songs = dict((song['id'], song) for song in normalized['songs'])
+    for blip, reference in zip(nested['objects'], normalized['objects']):
+      song = blip.pop('song')
+      assert songs[reference.pop('song_id')] == song
+      assert reference == blip
+    comments = json.loads(self.app.get('/api/blip/comment?blip_id=1&shape=normalized').data)
+    assert [song['id'] for song in comments['songs']] == [1]
+    assert comments['blip']['song_id'] == 1
+
+  def test_live_registry_delivers_only_inside_the_circle(self):
+    registry = realtime.Registry()
+    near = realtime.Subscription(50.0, 50.0, 10)
+    far = realtime.Subscription(40.0, -70.0, 10)
+    registry.subscribe(near)
+    registry.subscribe(far)
+    assert len(registry) == 2
+    registry.deliver(50.05, 50.05, 1, '{"id":1}')
+    # In one of the circle's cells, but 14 miles away
+    registry.deliver(50.2, 50.0, 2, '{"id":2}')
+    assert near.get(0) == (1, '{"id":1}') and near.get(0) is None
+    assert far.get(0) is None
+    registry.unsubscribe(near)
+    registry.unsubscribe(far)
+    assert len(registry) == 0 and registry.cells == {}
+
+  def test_live_subscription_closes_when_it_falls_behind(self):
+    subscription = realtime.Subscription(50.0, 50.0, 10, size=2)
+    realtime.registry.subscribe(subscription)
+    for blip_id in range(1, 4):
+      realtime.registry.deliver(50.0, 50.0, blip_id, "{}")
+    assert subscription.closed and len(realtime.registry) == 0
+    events = list(realtime.stream(subscription, keepalive=0))
+    assert [event.split("\n")[0] for event in events] == ["id: 1", "id: 2"]
+
+  def test_live_stream_pushes_new_nearby_blips(self):
+    user_dict, song_dict, blip_dict = self.generateBlip()
+    rv = self.app.get('/api/blip/live?latitude=50.0&longitude=50.0&radius=10')
+    assert rv.mimetype == 'text/event-stream'
+    assert len(realtime.registry) == 1
+    self.createBlip("40.0","-70.0",song_dict['id'],user_dict['id'],"testpass")
+    near = json.loads(self.createBlip("50.01","50.01",song_dict['id'],user_dict['id'],"testpass").data)
+    event = iter(rv.response).next()
+    assert event.startswith("id: 3\nevent: blip\ndata: ")
+    assert json.loads(event.split("data: ", 1)[1]) == near['objects'][0]
+    rv.response.close()
+    assert len(realtime.registry) == 0
+
+  def test_live_stream_replays_missed_blips(self):
+    user_dict, song_dict, blip_dict = self.generateBlip()
+    for latitude in ["50.01", "40.0", "50.02"]:
+      self.createBlip(latitude,"50.0",song_dict['id'],user_dict['id'],"testpass")
+    rv = self.app.get('/api/blip/live?latitude=50.0&longitude=50.0&radius=10',
+                      headers={'Last-Event-ID': '1'})
+    self.createBlip("50.03","50.0",song_dict['id'],user_dict['id'],"testpass")
+    events = iter(rv.response)
+    assert [events.next().split("\n")[0] for i in range(3)] == ["id: 2", "id: 4", "id: 5"]
+    rv.response.close()
+
+  def test_live_socket_broker_fans_out_to_other_processes(self):
+    directory = tempfile.mkdtemp()
+    try:
+      ready, done = os.pipe(), os.pipe()
+      pid = os.fork()
+      if not pid:
+        registry = realtime.Registry()
+        subscription = realtime.Subscription(50.0, 50.0, 10)
+        registry.subscribe(subscription)
+        realtime.SocketBroker(registry, directory)
+        os.write(ready[1], "x")
+        os._exit(0 if subscription.get(5) == (7, '{"id":7}') else 1)
+      os.read(ready[0], 1)
+      broker = realtime.SocketBroker(realtime.registry, directory)
+      # A process that exited leaves its socket behind
+      stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+      stale.bind(os.path.join(directory, "1.sock"))
+      stale.close()
+      broker.publish(50.01, 50.0, 7, '{"id":7}')
+      assert os.waitpid(pid, 0)[1] == 0
+      assert sorted(os.listdir(directory)) == sorted(["%d.sock" % os.getpid(), "%d.sock" % pid])
+    finally:
+      shutil.rmtree(directory)
+
+  def test_live_publish_failure_does_not_fail_saved_blips(self):
+    user_dict = self.generateUser()
+    song_id = self.insertSong()
+    class BrokenBroker(object):
+      def publish(self, *event):
+        raise IOError("broker unreachable")
+    realtime.broker = BrokenBroker()
+    stderr, sys.stderr = sys.stderr, tempfile.TemporaryFile()
+    try:
+      rv = self.createBlip("50.0","50.0",song_id,user_dict['id'],"testpass")
+    finally:
+      sys.stderr = stderr
+    assert json.loads(rv.data)['meta']['status'] == 20
+    assert latitune.Blip.query.count() == 1
+
+  def test_encoders_match_stdlib_json(self):
+    value = {"meta": {"status": 20}, "objects": [serialization.Fragment('{"a":[1,2]}'), u"\u00e9 \"quoted\"", 1.5, None]}
+    expected = {"meta": {"status": 20}, "objects": [{"a": [1, 2]}, u"\u00e9 \"quoted\"", 1.5, None]}
+    for name, dumps in serialization.ENCODERS:
+      if dumps is not None:
+        assert json.loads(dumps(value)) == expected, name
+        assert serialization.embeds_fragments(dumps), name
+    self.assertRaises(ValueError, serialization.get_encoder, "yaml")
+    # A ujson that ignores the hook encodes the fragment's attributes instead
+    assert not serialization.embeds_fragments(lambda value: json.dumps([{"json": f.json} for f in value]))
 
   """ Comment """
 
@@ -416,7 +1449,7 @@ class latituneTestCase(unittest.TestCase):
     assert rv_dict == {"meta": {"status"    : 20}, 
                        "objects":
                               [{"id"        : 1,
-                                "blip"      : blip_dict,
+                                "blip"      : dict(blip_dict, comment_count=1),
                                 "user_id"   : user_dict['id'],
                                 "comment"   : "This is a comment",
                                 "timestamp" : now}]}
@@ -452,7 +1485,7 @@ class latituneTestCase(unittest.TestCase):
     assert rv_dict == {"meta": {"status"    : 20}, 
                        "objects":
                               [{"id"        : 1,
-                                "blip"      : blip_dict,
+                                "blip"      : dict(blip_dict, comment_count=1),
                                 "user_id"   : user_dict['id'],
                                 "comment"   : "This is a comment",
                                 "timestamp" : now}]}
@@ -471,10 +1504,55 @@ class latituneTestCase(unittest.TestCase):
     comment3 = self.createComment(user_dict['id'],"testpass",blip2_dict['id'],"This is a comment part 2")
     comment3_dict = ast.literal_eval(comment3.data)['objects'][0]
 
+    thread_blip = comment2_dict.pop('blip')
+    del comment1_dict['blip']
+    comment1_dict['blip_id'] = comment2_dict['blip_id'] = blip_dict['id']
     rv = self.app.get('/api/blip/comment?blip_id={0}'.format(blip_dict['id']))
-    assert ast.literal_eval(rv.data) == {"meta"   : {"status":20}, 
+    assert ast.literal_eval(rv.data) == {"meta"   : {"status":20},
+                                         "blip"   : thread_blip,
                                          "objects": [comment2_dict,comment1_dict]}
 
+  def test_get_comment_by_blip_id_pages_by_cursor(self):
+    user_dict, song_dict, blip_dict = self.generateBlip()
+    for i in range(5):
+      self.createComment(user_dict['id'],"testpass",blip_dict['id'],"comment %d" % i)
+    # Comments made in the same instant are ordered by id
+    latitune.Comment.query.filter(latitune.Comment.id.in_([2, 3])).update(
+      {"timestamp": datetime(2013, 1, 1)}, synchronize_session=False)
+    latitune.db.session.commit()
+    url = '/api/blip/comment?blip_id=%d&limit=2' % blip_dict['id']
+    ids = []
+    rv_dict = json.loads(self.app.get(url).data)
+    while True:
+      assert rv_dict['blip']['comment_count'] == 5
+      assert all(comment['blip_id'] == blip_dict['id'] for comment in rv_dict['objects'])
+      ids += [comment['id'] for comment in rv_dict['objects']]
+      if 'cursor' not in rv_dict['meta']:
+        break
+      rv_dict = json.loads(self.app.get(url + '&cursor=' + rv_dict['meta']['cursor']).data)
+    assert ids == [5, 4, 1, 3, 2]
+    assert self.countQueries(url) == 0
+    latitune.db.session.remove()
+    controllers.response_cache.clear()
+    assert self.countQueries(url) == 3
+
+  def test_get_comment_by_blip_id_with_nonexistent_blip(self):
+    rv = self.app.get('/api/blip/comment?blip_id=1')
+    assert json.loads(rv.data)['meta']['status'] == 50
+
+  def test_get_favorites_with_invalid_arguments(self):
+    self.generateBlip()
+    for query in ['user_id=1&limit=abc', 'user_id=1&cursor=abc', 'blip_id=1&cursor=abc', 'user_id=one']:
+      rv = self.app.get('/api/blip/favorite?' + query)
+      assert rv.status_code == 200 and json.loads(rv.data)['meta']['status'] == "ERR", query
+    assert json.loads(self.app.get('/api/blip/favorite').data)['meta']['status'] == 10
+
+  def test_get_comment_by_blip_id_with_invalid_arguments(self):
+    self.generateComment()
+    for query in ['blip_id=one', 'blip_id=1&cursor=bogus', 'blip_id=1&cursor=2013:x', 'blip_id=1&limit=x']:
+      rv = self.app.get('/api/blip/comment?' + query)
+      assert json.loads(rv.data)['meta']['status'] == "ERR", query
+
   def test_get_comment_with_invalid_data(self):
     rv = self.app.get('/api/blip/comment')
     assert ast.literal_eval(rv.data) == {"meta":{"status":10,"error":"Missing Required Parameters"},"objects":[]}
@@ -483,6 +1561,14 @@ class latituneTestCase(unittest.TestCase):
     rv = self.app.get('/api/blip/comment?id=1')
     assert ast.literal_eval(rv.data) == {"meta":{"status":60,"error":"Comment ID does not exist"},"objects":[]}
 
+  def test_new_comment_invalidates_cached_comments(self):
+    user_dict, song_dict, blip_dict, comment_dict = self.generateComment()
+    url = '/api/blip/comment?blip_id=%d' % blip_dict['id']
+    assert len(json.loads(self.app.get(url).data)['objects']) == 1
+    self.createComment(user_dict['id'],"testpass",blip_dict['id'],"Another comment")
+    assert len(json.loads(self.app.get(url).data)['objects']) == 2
+    assert self.countQueries(url) == 0
+
   """ Favorites """
 
   def test_new_favorite_creates_favorite_with_valid_data(self):
@@ -554,7 +1640,25 @@ class latituneTestCase(unittest.TestCase):
     self.createFavorite(1,"testpass",2)
     rv = self.app.get("/api/blip/favorite?user_id=1")
     assert ast.literal_eval(rv.data) == {"meta":{"status":20},
-                                         "objects":[blip_dict,blip_dict2]}
+                                         "objects":[dict(blip_dict, favorite_count=2),
+                                                    dict(blip_dict2, favorite_count=2)]}
+
+  def test_get_favorites_pages_by_cursor(self):
+    self.seedGraph(3)
+    rv_dict = json.loads(self.app.get("/api/blip/favorite?blip_id=1&limit=2").data)
+    assert [user['id'] for user in rv_dict['objects']] == [3, 2]
+    rv_dict = json.loads(self.app.get("/api/blip/favorite?blip_id=1&limit=2&cursor="+rv_dict['meta']['cursor']).data)
+    assert [user['id'] for user in rv_dict['objects']] == [1]
+    assert rv_dict['meta'] == {"status": 20}
+
+    rv_dict = json.loads(self.app.get("/api/blip/favorite?user_id=1&limit=2").data)
+    assert [blip['id'] for blip in rv_dict['objects']] == [1, 2]
+    rv_dict = json.loads(self.app.get("/api/blip/favorite?user_id=1&limit=2&cursor="+rv_dict['meta']['cursor']).data)
+    assert [blip['id'] for blip in rv_dict['objects']] == [3]
+
+  def test_get_favorites_with_invalid_data(self):
+    rv = self.app.get("/api/blip/favorite")
+    assert json.loads(rv.data) == {"meta":{"status":10,"error":"Missing Required Parameters"},"objects":[]}
 
   def test_refavorite_does_nothing(self):
     user_dict, song_dict, blip_dict = self.generateBlip()
@@ -563,7 +1667,7 @@ class latituneTestCase(unittest.TestCase):
     rv = self.app.get("/api/blip/favorite?user_id=1")
     rv_dict = ast.literal_eval(rv.data)
     assert rv_dict == {"meta": {"status":20},
-                       "objects":[blip_dict]}
+                       "objects":[dict(blip_dict, favorite_count=1)]}
 
   def test_delete_favorite_with_valid_data(self):
     user_dict, song_dict, blip_dict = self.generateBlip()
@@ -575,6 +1679,153 @@ class latituneTestCase(unittest.TestCase):
     assert ast.literal_eval(rv.data) == {"meta":{"status":20},
                                          "objects":[]}
 
+  def test_favorite_writes_invalidate_cached_favorites(self):
+    user_dict, song_dict, blip_dict = self.generateBlip()
+    assert json.loads(self.app.get("/api/blip/favorite?blip_id=1").data)['objects'] == []
+    assert json.loads(self.app.get("/api/blip/favorite?user_id=1").data)['objects'] == []
+    self.createFavorite(1,"testpass",1)
+    assert json.loads(self.app.get("/api/blip/favorite?blip_id=1").data)['objects'] == [user_dict]
+    assert len(json.loads(self.app.get("/api/blip/favorite?user_id=1").data)['objects']) == 1
+    self.app.delete("/api/blip/favorite?user_id=1&blip_id=1&password=testpass")
+    assert json.loads(self.app.get("/api/blip/favorite?blip_id=1").data)['objects'] == []
+    assert json.loads(self.app.get("/api/blip/favorite?user_id=1").data)['objects'] == []
+
+  def test_response_cache_shares_invalidations_through_backend(self):
+    shared = cache.LRUCache()
+    first = cache.ResponseCache(shared=shared)
+    second = cache.ResponseCache(shared=shared)
+    first.set("comments:1", "/api/blip/comment?blip_id=1", "body")
+    assert second.get("comments:1", "/api/blip/comment?blip_id=1") == "body"
+    second.invalidate("comments:1")
+    assert first.get("comments:1", "/api/blip/comment?blip_id=1") is None
+    assert first.stats == {"hits": 0, "misses": 1, "invalidations": 0, "size": 1}
+
+  def test_shared_memory_cache_is_shared_with_forked_workers(self):
+    now = [1000.0]
+    shared = cache.SharedMemoryCache(64 * 1024, 1024, ttl=10, clock=lambda: now[0])
+    assert shared.set("blip:1", {"id": 1})
+    assert shared.get("blip:1") == {"id": 1}
+    assert not shared.set("blip:2", "x" * 2048)
+    assert shared.get("blip:2") is None
+    pid = os.fork()
+    if not pid:
+      shared.set("blip:3", shared.get("blip:1"))
+      os._exit(0)
+    os.waitpid(pid, 0)
+    assert shared.get("blip:3") == {"id": 1}
+    shared.delete("blip:1")
+    assert shared.get("blip:1") is None
+    now[0] += 11
+    assert shared.get("blip:3") is None
+
+  def test_response_cache_shares_invalidations_through_shared_memory(self):
+    # Enough slots that the entry and its tag's generation, whose keys are
+    # random, do not land in the same one and evict each other
+    shared = cache.SharedMemoryCache(16 * 1024 * 1024, 1024)
+    first = cache.ResponseCache(shared=shared)
+    first.set("comments:1", "/api/blip/comment?blip_id=1", "body")
+    pid = os.fork()
+    if not pid:
+      second = cache.ResponseCache(shared=shared)
+      os._exit(0 if second.get("comments:1", "/api/blip/comment?blip_id=1") == "body" and
+               second.invalidate("comments:1") is None else 1)
+    assert os.waitpid(pid, 0)[1] == 0
+    assert first.get("comments:1", "/api/blip/comment?blip_id=1") is None
+
+  def test_prefork_refuses_local_live_broker_with_several_workers(self):
+    master = subprocess.Popen([sys.executable, "prefork.py", "--mode", "threaded", "--workers", "2"],
+                              env=dict(os.environ, DATABASE_URL="sqlite://", LATITUNE_LIVE_BROKER="local"),
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, error = master.communicate()
+    assert master.returncode == 1 and "LIVE_BROKER local" in error, error
+
+  def test_prefork_recycles_reloads_and_stops_workers(self):
+    import urllib2
+    probe = socket.socket()
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    log = tempfile.TemporaryFile()
+    master = subprocess.Popen([sys.executable, "prefork.py", "--mode", "threaded", "--host", "127.0.0.1",
+                               "--port", str(port), "--workers", "2", "--max-requests", "5"],
+                              env=dict(os.environ, DATABASE_URL="sqlite://"), stdout=log, stderr=log)
+    def workers():
+      return set(subprocess.check_output(["pgrep", "-P", str(master.pid)]).split())
+    def get():
+      return json.loads(urllib2.urlopen("http://127.0.0.1:%d/api/cache/stats" % port).read())['meta']['status']
+    try:
+      for attempt in range(100):
+        try:
+          get()
+          break
+        except IOError:
+          time.sleep(0.1)
+      first = workers()
+      assert [get() for i in range(30)] == [20] * 30
+      time.sleep(0.5)
+      recycled = workers()
+      assert len(recycled) == 2 and recycled != first
+      master.send_signal(signal.SIGHUP)
+      assert [get() for i in range(10)] == [20] * 10
+      time.sleep(2)
+      assert len(workers()) == 2 and not workers() & recycled
+      master.send_signal(signal.SIGTERM)
+      assert master.wait() == 0
+    finally:
+      if master.poll() is None:
+        master.kill()
+
+  def test_response_cache_skips_responses_rendered_across_an_invalidation(self):
+    responses = cache.ResponseCache()
+    reserved = responses.reserve("comments:1", "/api/blip/comment?blip_id=1")
+    responses.invalidate("blip:2")
+    assert not responses.store(reserved, "OLD BODY", ["blip:1"])
+    assert responses.get("comments:1", "/api/blip/comment?blip_id=1") is None
+    reserved = responses.reserve("comments:1", "/api/blip/comment?blip_id=1")
+    assert responses.store(reserved, "NEW BODY", ["blip:1"])
+    assert responses.get("comments:1", "/api/blip/comment?blip_id=1") == "NEW BODY"
+
+  def test_cached_views_take_non_ascii_arguments(self):
+    user_dict, song_dict, blip_dict = self.generateBlip()
+    for url in ['/api/blip/comment?blip_id=1&shape=%C3%A9', '/api/blip/favorite?user_id=1&x=%C3%A9']:
+      for attempt in range(2):
+        rv = self.app.get(url)
+        assert rv.status_code == 200 and json.loads(rv.data)['meta']['status'] == 20, url
+
+  def test_cache_tags_match_however_the_id_is_written(self):
+    user_dict, song_dict, blip_dict = self.generateBlip()
+    urls = ['/api/blip?id=01', '/api/blip/comment?blip_id=01', '/api/blip/favorite?user_id=01']
+    for url in urls:
+      self.app.get(url)
+    self.createFavorite(1,"testpass",1)
+    self.createComment(1,"testpass",1,"This is a comment")
+    assert json.loads(self.app.get(urls[0]).data)['objects'][0]['favorite_count'] == 1
+    assert len(json.loads(self.app.get(urls[1]).data)['objects']) == 1
+    assert len(json.loads(self.app.get(urls[2]).data)['objects']) == 1
+    assert json.loads(self.app.get('/api/blip?id=x').data)['meta']['status'] == "ERR"
+
+  def test_blip_counters_follow_favorites_and_comments(self):
+    user_dict, song_dict, blip_dict = self.generateBlip()
+    user_dict2 = self.generateUser(username="ben2",email="ben2@gmail.com")
+    assert len(json.loads(self.app.get("/api/blip/favorite?user_id=1").data)['objects']) == 0
+    self.createFavorite(1,"testpass",1)
+    assert json.loads(self.app.get("/api/blip/favorite?user_id=1").data)['objects'][0]['favorite_count'] == 1
+    self.createFavorite(2,"testpass",1)
+    self.createComment(2,"testpass",1,"This is a comment")
+    rv_dict = json.loads(self.app.get("/api/blip/favorite?user_id=1").data)
+    assert (rv_dict['objects'][0]['favorite_count'], rv_dict['objects'][0]['comment_count']) == (2, 1)
+    self.app.delete("/api/blip/favorite?user_id=2&blip_id=1&password=testpass")
+    rv_dict = json.loads(self.app.get("/api/blip?id=1").data)
+    assert (rv_dict['objects'][0]['favorite_count'], rv_dict['objects'][0]['comment_count']) == (1, 1)
+
+  def test_reconcile_counts_rebuilds_counters(self):
+    self.seedGraph(3)
+    latitune.Blip.query.update({"favorite_count": 7, "comment_count": 7})
+    latitune.db.session.commit()
+    latitune.Blip.reconcile_counts()
+    counts = [(b.favorite_count, b.comment_count) for b in latitune.Blip.query.order_by(latitune.Blip.id)]
+    assert counts == [(3, 3), (1, 0), (1, 0)]
+
   def test_delete_favorite_with_invalid_data(self):
     rv = self.app.delete("/api/blip/favorite")
     assert ast.literal_eval(rv.data) == {"meta":{"status":10,"error":"Missing Required Parameters"},"objects":[]}
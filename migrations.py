@@ -0,0 +1,231 @@
+##################################################
+# SCHEMA MIGRATIONS
+##################################################
+#
+# Brings an existing Postgres or SQLite database up to the schema in
+# models.py. Run against DATABASE_URL as usual:
+#
+#   python migrations.py                # upgrade to the latest version
+#   python migrations.py upgrade 1      # upgrade to a given version
+#   python migrations.py version        # print the current version
+#   python migrations.py stamp 2        # record a version without migrating
+#
+# The version lives in a one-row schema_version table. A database with no
+# tables is created from the models and stamped with the latest version; one
+# with tables but no schema_version is at version 0, the schema from before
+# migrations existed. Migrations check what is already there, so databases
+# created from the models part way through are brought up to date as well.
+# Each migration runs in its own transaction.
+
+import sys
+from settings import *
+from models import *
+import tiles
+from sqlalchemy.engine.reflection import Inspector
+
+MIGRATIONS = []
+
+BACKFILL_CHUNK = 1000
+
+version_metadata = db.MetaData()
+schema_version   = db.Table('schema_version', version_metadata,
+                            db.Column('version', db.Integer, nullable = False))
+
+def migration(version):
+  def register(fn):
+    MIGRATIONS.append((version, fn))
+    MIGRATIONS.sort()
+    return fn
+  return register
+
+def latest_version():
+  return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+def current_version(conn):
+  """Version of the database, None if it has no tables yet"""
+  tables = Inspector.from_engine(conn).get_table_names()
+  if 'schema_version' not in tables:
+    return 0 if Blip.__tablename__ in tables else None
+  return conn.execute(db.select([schema_version.c.version])).scalar() or 0
+
+def stamp(conn, version):
+  version_metadata.create_all(conn)
+  conn.execute(schema_version.delete())
+  conn.execute(schema_version.insert(), version=version)
+
+def upgrade(engine=None, target=None, log=None):
+  """Apply the migrations after the database's version up to `target`
+  (default the latest). Returns the version the database ends up at."""
+  engine = engine or db.engine
+  target = latest_version() if target is None else target
+  with engine.begin() as conn:
+    version = current_version(conn)
+    if version is None:
+      db.metadata.create_all(conn)
+      stamp(conn, latest_version())
+      return latest_version()
+  for number, fn in MIGRATIONS:
+    if version < number <= target:
+      if log:
+        log("migrating to version %d: %s" % (number, fn.__doc__))
+      with engine.begin() as conn:
+        fn(conn)
+        stamp(conn, number)
+      version = number
+  return version
+
+##################################################
+# HELPERS
+##################################################
+
+def columns(conn, table):
+  return set(column['name'] for column in Inspector.from_engine(conn).get_columns(table))
+
+def indexes(conn, table):
+  return set(index['name'] for index in Inspector.from_engine(conn).get_indexes(table))
+
+def add_column(conn, column, default=None):
+  """Add a model column to its table unless it is already there"""
+  table = column.table.name
+  if column.name in columns(conn, table):
+    return
+  if hasattr(column.type, 'create'):
+    # Postgres ENUM types are created separately from the column
+    column.type.create(conn, checkfirst=True)
+  ddl = "ALTER TABLE %s ADD COLUMN %s %s" % (table, column.name,
+                                             column.type.compile(dialect=conn.dialect))
+  if default is not None:
+    ddl += " DEFAULT %s" % default
+  if not column.nullable:
+    ddl += " NOT NULL"
+  conn.execute(ddl)
+
+def create_index(conn, name):
+  """Create an index declared on the models unless it is already there"""
+  for table in db.metadata.sorted_tables:
+    for index in table.indexes:
+      if index.name == name:
+        if name not in indexes(conn, table.name):
+          index.create(conn)
+        return
+  raise KeyError(name)
+
+def create_unique_index(conn, name, table, *column_names):
+  """Enforce a unique constraint declared on the models. A unique index
+  does the same job and, unlike ALTER TABLE ADD CONSTRAINT, SQLite has it."""
+  if name not in indexes(conn, table):
+    conn.execute("CREATE UNIQUE INDEX %s ON %s (%s)" % (name, table, ", ".join(column_names)))
+
+def backfill(conn, column, sources, compute):
+  """Fill in `column` where it is NULL with compute(row) of its row's
+  `sources` columns, BACKFILL_CHUNK rows at a time"""
+  table = column.table
+  while True:
+    rows = conn.execute(db.select([table.c.id] + sources)
+                        .where(db.and_(column == None, *[source != None for source in sources]))
+                        .limit(BACKFILL_CHUNK)).fetchall()
+    if not rows:
+      break
+    conn.execute(table.update().where(table.c.id == db.bindparam('row_id')),
+                 [{'row_id': row.id, column.name: compute(row)} for row in rows])
+
+##################################################
+# MIGRATIONS
+##################################################
+
+@migration(1)
+def add_derived_columns(conn):
+  """blip geohash and counters, song provider_status"""
+  add_column(conn, Blip.__table__.c.geohash)
+  add_column(conn, Blip.__table__.c.favorite_count, default=0)
+  add_column(conn, Blip.__table__.c.comment_count, default=0)
+  add_column(conn, Song.__table__.c.provider_status)
+  blips = Blip.__table__
+  backfill(conn, blips.c.geohash, [blips.c.latitude, blips.c.longitude],
+           lambda row: geo.geohash_encode(row.latitude, row.longitude))
+  conn.execute(Blip.recount())
+  # Songs from before provider_status had their providers looked up inline
+  conn.execute(Song.__table__.update().where(Song.__table__.c.provider_status == None)
+               .values(provider_status=Song.RESOLVED))
+
+@migration(2)
+def add_lookup_indexes(conn):
+  """indexes for the hot lookups, unique songs and favorites"""
+  for name in ['ix_blip_latitude', 'ix_blip_longitude', 'ix_blip_geohash', 'ix_blip_timestamp',
+               'ix_song_provider_song_id', 'ix_comment_blip_timestamp', 'ix_favorite_blip_user']:
+    create_index(conn, name)
+
+  # Fold duplicate songs, their blips and providers, into the oldest copy
+  # before making them unique
+  songs, providers = Song.__table__, SongProvider.__table__
+  duplicates = conn.execute(db.select([songs.c.artist, songs.c.title, db.func.min(songs.c.id)])
+                            .where(db.and_(songs.c.artist != None, songs.c.title != None))
+                            .group_by(songs.c.artist, songs.c.title)
+                            .having(db.func.count(songs.c.id) > 1)).fetchall()
+  for artist, title, keep in duplicates:
+    extra = [row.id for row in conn.execute(db.select([songs.c.id]).where(db.and_(
+      songs.c.artist == artist, songs.c.title == title, songs.c.id != keep)))]
+    conn.execute(Blip.__table__.update().where(Blip.__table__.c.song_id.in_(extra))
+                 .values(song_id=keep))
+    conn.execute(providers.update().where(providers.c.song_id.in_(extra)).values(song_id=keep))
+    conn.execute(songs.delete().where(songs.c.id.in_(extra)))
+  # Providers a kept song now has twice
+  first = db.select([db.func.min(providers.c.id)]).group_by(providers.c.song_id, providers.c.provider,
+                                                           providers.c.provider_key)
+  conn.execute(providers.delete().where(~providers.c.id.in_(first)))
+  create_unique_index(conn, 'uq_song_artist_title', 'song', 'artist', 'title')
+
+  favorites = Favorite.__table__
+  first = db.select([db.func.min(favorites.c.id)]).group_by(favorites.c.user_id, favorites.c.blip_id)
+  conn.execute(favorites.delete().where(~favorites.c.id.in_(first)))
+  create_unique_index(conn, 'uq_favorite_user_blip', 'favorite', 'user_id', 'blip_id')
+  conn.execute(Blip.recount())
+
+@migration(3)
+def add_blip_day(conn):
+  """blip day partitions for the feed"""
+  blips = Blip.__table__
+  add_column(conn, blips.c.day)
+  backfill(conn, blips.c.day, [blips.c.timestamp], lambda row: row.timestamp.toordinal())
+  create_index(conn, 'ix_blip_day_geohash')
+
+@migration(4)
+def add_tiles(conn):
+  """tile aggregates, built from the existing blips"""
+  Tile.__table__.create(conn, checkfirst=True)
+  TileSong.__table__.create(conn, checkfirst=True)
+  tiles.rebuild(conn)
+
+@migration(5)
+def extend_comment_index(conn):
+  """comment index on (blip_id, timestamp, id) for paging threads"""
+  for index in Inspector.from_engine(conn).get_indexes('comment'):
+    if index['name'] == 'ix_comment_blip_timestamp' and index['column_names'] != ['blip_id', 'timestamp', 'id']:
+      conn.execute("DROP INDEX ix_comment_blip_timestamp")
+  create_index(conn, 'ix_comment_blip_timestamp')
+
+@migration(6)
+def add_song_provider_scheduled(conn):
+  """song provider_scheduled, for rescheduling lost provider lookups"""
+  add_column(conn, Song.__table__.c.provider_scheduled)
+  create_index(conn, 'ix_song_provider_pending')
+
+def main(argv):
+  command = argv[0] if argv else "upgrade"
+  if command == "version":
+    with db.engine.begin() as conn:
+      print current_version(conn)
+  elif command == "upgrade":
+    target = int(argv[1]) if len(argv) > 1 else None
+    def log(message):
+      print message
+    print "at version %d" % upgrade(target=target, log=log)
+  elif command == "stamp":
+    with db.engine.begin() as conn:
+      stamp(conn, int(argv[1]))
+  else:
+    print "usage: python migrations.py [upgrade [version] | version | stamp version]"
+    sys.exit(1)
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
@@ -4,9 +4,31 @@
 
 import os
 import sys
+import geo
+import hmac
+import instrumentation
+import time
+import heapq
+import hashlib
 from settings import *
-from datetime import datetime
-from werkzeug.security import generate_password_hash, check_password_hash
+from datetime import datetime, timedelta
+from collections import defaultdict, OrderedDict
+from sqlalchemy.exc import IntegrityError
+from werkzeug.security import generate_password_hash, check_password_hash, safe_str_cmp
+
+# Lookups Song.upsert_many makes before giving up on concurrent inserts
+UPSERT_ATTEMPTS = 3
+
+# (artist, title) pairs per Song.by_keys query; SQLite rejects much deeper
+# OR expressions
+SONG_KEYS_PER_QUERY = 200
+
+# Finest geohash precision (~1.2km cells) the nearest-blip search starts at
+NEAREST_START_PRECISION = 6
+
+# Feed scores halve at this distance (miles) and, separately, this age (hours)
+FEED_DISTANCE_SCALE = 5.0
+FEED_AGE_SCALE      = 6.0
 
 class User(db.Model):
   __tablename__ = 'user'
@@ -23,10 +45,32 @@ class User(db.Model):
     self.set_password(password)
 
   def set_password(self, password):
-    self.pw_hash = generate_password_hash(password)
+    with instrumentation.timed("password"):
+      self.pw_hash = generate_password_hash(password)
 
   def check_password(self, password):
-    return check_password_hash(self.pw_hash, password)
+    with instrumentation.timed("password"):
+      return check_password_hash(self.pw_hash, password)
+
+  def issue_token(self, ttl):
+    """Signed token that stands in for the password until it expires.
+    The password hash is part of the signature, so changing the password
+    revokes every outstanding token."""
+    expires = int(time.time()) + ttl
+    return "%d.%d.%s" % (self.id, expires, self._token_signature(expires)), expires
+
+  def check_token(self, token):
+    try:
+      user_id, expires, signature = token.split(".")
+      user_id, expires = int(user_id), int(expires)
+    except ValueError:
+      return False
+    return (user_id == self.id and expires > time.time() and
+            safe_str_cmp(signature, self._token_signature(expires)))
+
+  def _token_signature(self, expires):
+    message = "%d.%d.%s" % (self.id, expires, self.pw_hash)
+    return hmac.new(str(app.secret_key), message, hashlib.sha256).hexdigest()
 
   @property
   def serialize(self):
@@ -39,12 +83,23 @@ class User(db.Model):
 
 class Song(db.Model):
   __tablename__ = 'song'
+  __table_args__ = (db.UniqueConstraint('artist', 'title', name='uq_song_artist_title'),
+                    # providers.sweep's lookup of songs left pending
+                    db.Index('ix_song_provider_pending', 'provider_status', 'provider_scheduled'))
+
+  PENDING  = "pending"
+  RESOLVED = "resolved"
+  FAILED   = "failed"
 
   id               = db.Column(db.Integer, primary_key = True)
   artist           = db.Column(db.String(80))
   title            = db.Column(db.String(120))
   album            = db.Column(db.String(80))
   echonestID       = db.Column(db.String(20))
+  provider_status  = db.Column(db.Enum(PENDING, RESOLVED, FAILED, name="provider_status"),
+                               default = PENDING)
+  # When the provider lookup was last scheduled
+  provider_scheduled = db.Column(db.DateTime)
   blip             = db.relationship("Blip", backref="song")
   providers        = db.relationship("SongProvider")
 
@@ -54,22 +109,76 @@ class Song(db.Model):
     self.album  = album
     self.echonestID = echonest_id
 
+  @classmethod
+  def upsert_many(cls, songs):
+    """Get or create songs from dicts with artist, title, echonest_id and
+    optionally album, deduplicated on (artist, title).
+
+    Existing songs are found with one query and the rest are inserted with
+    one executemany. If a concurrent request inserts one of the same songs
+    first, the unique constraint rejects the insert and the lookup is
+    retried. Returns ({(artist, title): song}, [ids of songs created])."""
+    wanted = OrderedDict()
+    for song in songs:
+      wanted.setdefault((song['artist'], song['title']), song)
+    for attempt in range(UPSERT_ATTEMPTS):
+      existing = cls.by_keys(wanted.keys())
+      missing = [key for key in wanted if key not in existing]
+      if not missing:
+        return existing, []
+      try:
+        db.session.execute(cls.__table__.insert(), [
+          {'artist'          : artist,
+           'title'           : title,
+           'album'           : wanted[(artist, title)].get('album', ""),
+           'echonestID'      : wanted[(artist, title)]['echonest_id'],
+           'provider_status' : cls.PENDING,
+           'provider_scheduled' : datetime.now()} for artist, title in missing])
+        db.session.commit()
+      except IntegrityError:
+        db.session.rollback()
+        continue
+      songs = cls.by_keys(wanted.keys())
+      return songs, [songs[key].id for key in missing]
+    raise IntegrityError("song upsert", None, None)
+
+  @classmethod
+  def by_keys(cls, keys):
+    """{(artist, title): song} for the given keys that exist, looked up
+    SONG_KEYS_PER_QUERY at a time"""
+    keys = list(keys)
+    found = {}
+    for start in range(0, len(keys), SONG_KEYS_PER_QUERY):
+      songs = cls.query.filter(db.or_(*[db.and_(cls.artist == artist, cls.title == title)
+                                        for artist, title in keys[start:start + SONG_KEYS_PER_QUERY]]))
+      found.update(((song.artist, song.title), song) for song in songs)
+    return found
+
   @property
   def serialize(self):
+    return serialize_songs([self])[0]
+
+  @property
+  def fragment_version(self):
+    """What can change in a song's serialization after it is created"""
+    return self.provider_status or Song.RESOLVED
+
+  def serialize_with(self, providers):
     return {
       'id'               : self.id,
       'artist'           : self.artist,
       'title'            : self.title,
       'album'            : self.album,
       'echonestID'       : self.echonestID,
-      'providers'        : [p.serialize for p in self.providers]
+      'provider_status'  : self.provider_status or Song.RESOLVED,
+      'providers'        : [p.serialize for p in providers]
     }
 
 class SongProvider(db.Model):
   __tablename__ = "song_provider"
 
   id = db.Column(db.Integer, primary_key = True)
-  song_id = db.Column(db.Integer, db.ForeignKey('song.id'))
+  song_id = db.Column(db.Integer, db.ForeignKey('song.id'), index = True)
   provider = db.Column(db.Enum("Rdio", "Spotify", name="provider"))
   provider_key = db.Column(db.String(50))
 
@@ -87,34 +196,179 @@ class SongProvider(db.Model):
 
 class Blip(db.Model):
   __tablename__ = 'blip'
+  # Blips are partitioned by day within the geohash index, so the feed reads
+  # just the recent days of the cells around a point
+  __table_args__ = (db.Index('ix_blip_day_geohash', 'day', 'geohash'),)
 
   id        = db.Column(db.Integer, primary_key = True)
   song_id   = db.Column(db.Integer, db.ForeignKey('song.id'))
   user_id   = db.Column(db.Integer, db.ForeignKey('user.id'))
-  longitude = db.Column(db.Float)
-  latitude  = db.Column(db.Float)
-  timestamp = db.Column(db.DateTime, default=datetime.now)
+  longitude = db.Column(db.Float, index = True)
+  latitude  = db.Column(db.Float, index = True)
+  geohash   = db.Column(db.String(geo.GEOHASH_PRECISION), index = True)
+  timestamp = db.Column(db.DateTime, default=datetime.now, index = True)
+  day       = db.Column(db.Integer)
+  # Materialized counts, kept in step by the views that add and remove
+  # favorites and comments; reconcile_counts rebuilds them
+  favorite_count = db.Column(db.Integer, default = 0, nullable = False)
+  comment_count  = db.Column(db.Integer, default = 0, nullable = False)
 
   def __init__(self, song_id, user_id, longitude, latitude):
     self.song_id   = song_id
     self.user_id   = user_id
     self.longitude = longitude
     self.latitude  = latitude
+    self.geohash   = geo.geohash_encode(float(latitude), float(longitude))
+    self.timestamp = datetime.now()
+    self.day       = self.timestamp.toordinal()
+    self.favorite_count = 0
+    self.comment_count  = 0
+
+  @classmethod
+  def adjust_counts(cls, blip_id, favorites=0, comments=0):
+    """Add to a blip's counters in the current transaction"""
+    cls.query.filter_by(id=blip_id).update(
+      {cls.favorite_count : cls.favorite_count + favorites,
+       cls.comment_count  : cls.comment_count + comments}, synchronize_session=False)
+
+  @classmethod
+  def reconcile_counts(cls):
+    """Recount every blip's favorites and comments in one statement"""
+    db.session.execute(cls.recount())
+    db.session.commit()
+
+  @classmethod
+  def recount(cls):
+    """UPDATE statement setting every blip's counters from the source tables"""
+    favorites = db.select([db.func.count(Favorite.id)]).where(Favorite.blip_id == cls.id).as_scalar()
+    comments  = db.select([db.func.count(Comment.id)]).where(Comment.blip_id == cls.id).as_scalar()
+    return cls.__table__.update().values(favorite_count=favorites, comment_count=comments)
+
+  @classmethod
+  def row(cls, song_id, user_id, longitude, latitude):
+    """Column values for inserting a blip without building the object"""
+    longitude, latitude = float(longitude), float(latitude)
+    timestamp = datetime.now()
+    return {'song_id'   : int(song_id),
+            'user_id'   : int(user_id),
+            'longitude' : longitude,
+            'latitude'  : latitude,
+            'geohash'   : geo.geohash_encode(latitude, longitude),
+            'timestamp' : timestamp,
+            'day'       : timestamp.toordinal()}
+
+  @classmethod
+  def geohash_filter(cls, cells):
+    """Filter clause matching blips inside any of the given geohash cells"""
+    return db.or_(*[db.and_(cls.geohash >= low, cls.geohash < high)
+                    for low, high in geo.cell_ranges(cells)])
+
+  @classmethod
+  def nearest(cls, latitude, longitude, limit=25):
+    """The `limit` blips closest to a point, ordered by distance.
+
+    Counts blips in the 3x3 block of geohash cells around the point, widening
+    one precision level at a time until the block holds at least `limit`.
+    The `limit`-th closest of those bounds the search radius, and exact
+    distance is then computed only for blips in cells covering that circle."""
+    distance = lambda row: geo.haversine(latitude, longitude, row.latitude, row.longitude)
+    located = db.session.query(cls.id, cls.latitude, cls.longitude)
+    for precision in range(NEAREST_START_PRECISION, 0, -1):
+      block = cls.geohash_filter(geo.neighbourhood(latitude, longitude, precision))
+      if db.session.query(db.func.count(cls.id)).filter(block).scalar() >= limit:
+        radius = sorted(map(distance, located.filter(block)))[limit - 1]
+        box = geo.bounding_box(latitude, longitude, radius)
+        candidates = located.filter(cls.geohash_filter(geo.cover(box))).all()
+        break
+    else:
+      candidates = located.all()
+    return cls.by_ids([row.id for row in heapq.nsmallest(limit, candidates, key=distance)])
+
+  @classmethod
+  def box_filter(cls, box):
+    """Indexable lat/lng range predicate for a (south, west, north, east)
+    box; west > east wraps across the antimeridian"""
+    south, west, north, east = box
+    if west <= east:
+      longitude = cls.longitude.between(west, east)
+    else:
+      longitude = db.or_(cls.longitude >= west, cls.longitude <= east)
+    return db.and_(cls.latitude.between(south, north), longitude)
+
+  @classmethod
+  def within_radius(cls, latitude, longitude, radius, limit=25, after=None):
+    """Blips within `radius` miles of a point as (distance, id) ranked pairs
+    and blips, ordered by distance and starting after the `after` pair"""
+    located = db.session.query(cls.id, cls.latitude, cls.longitude).filter(
+      cls.box_filter(geo.bounding_box(latitude, longitude, radius)))
+    ranked = [(geo.haversine(latitude, longitude, row.latitude, row.longitude), row.id)
+              for row in located]
+    ranked = heapq.nsmallest(limit, [rank for rank in ranked
+                                     if rank[0] <= radius and (after is None or rank > after)])
+    return ranked, cls.by_ids([blip_id for distance, blip_id in ranked])
+
+  @classmethod
+  def feed(cls, latitude, longitude, radius, hours, limit=25, after=None, now=None):
+    """Blips from the last `hours` hours within `radius` miles of a point as
+    (-score, id) ranked pairs and blips, best first and starting after the
+    `after` pair. Scores fall off with both distance and age (see
+    feed_score) and are taken as of `now`, so pages ranked as of the same
+    time line up."""
+    now = now or datetime.now()
+    since = now - timedelta(hours=hours)
+    ranges = geo.cell_ranges(geo.cover(geo.bounding_box(latitude, longitude, radius)))
+    located = db.session.query(cls.id, cls.latitude, cls.longitude, cls.timestamp).filter(
+      db.or_(*[db.and_(cls.day == day, cls.geohash >= low, cls.geohash < high)
+               for day in range(since.toordinal(), now.toordinal() + 1)
+               for low, high in ranges]),
+      cls.timestamp >= since, cls.timestamp <= now)
+    ranked = []
+    for row in located:
+      distance = geo.haversine(latitude, longitude, row.latitude, row.longitude)
+      if distance <= radius:
+        age = (now - row.timestamp).total_seconds() / 3600.0
+        ranked.append((-feed_score(distance, age), row.id))
+    ranked = heapq.nsmallest(limit, [rank for rank in ranked if after is None or rank > after])
+    return ranked, cls.by_ids([blip_id for score, blip_id in ranked])
+
+  @classmethod
+  def by_ids(cls, ids):
+    """Blips for the given ids, in the same order"""
+    blips = dict((blip.id, blip) for blip in cls.query.filter(cls.id.in_(ids))) if ids else {}
+    return [blips[blip_id] for blip_id in ids]
+
+  @classmethod
+  def backfill_geohash(cls):
+    """Index blips that were stored before the geohash column existed"""
+    for blip in cls.query.filter(cls.geohash == None):
+      blip.geohash = geo.geohash_encode(blip.latitude, blip.longitude)
+    db.session.commit()
 
   @property
   def serialize(self):
-    song = Song.query.filter_by(id=self.song_id).first()
+    return serialize_blips([self])[0]
+
+  @property
+  def fragment_version(self):
+    """What can change in a blip's serialization after it is created"""
+    return "%d.%d" % (self.favorite_count or 0, self.comment_count or 0)
+
+  def serialize_with(self, song):
     return {
       'id'        : self.id,
-      'song'      : song.serialize,
+      'song'      : song,
       'user_id'   : self.user_id,
       'longitude' : self.longitude,
       'latitude'  : self.latitude,
-      'timestamp' : self.timestamp.isoformat()
+      'timestamp' : self.timestamp.isoformat(),
+      'favorite_count' : self.favorite_count,
+      'comment_count'  : self.comment_count
     }
 
 class Comment(db.Model):
   __tablename__ = "comment"
+  # A blip's comments, newest first, by (timestamp, id) keyset
+  __table_args__ = (db.Index('ix_comment_blip_timestamp', 'blip_id', 'timestamp', 'id'),)
 
   id = db.Column(db.Integer, primary_key = True)
   blip_id   = db.Column(db.Integer, db.ForeignKey('blip.id'))
@@ -129,10 +383,26 @@ class Comment(db.Model):
 
   @property
   def serialize(self):
-    blip = Blip.query.filter_by(id=self.blip_id).first()
+    return serialize_comments([self])[0]
+
+  @classmethod
+  def thread(cls, blip_id, limit=25, after=None):
+    """A blip's comments, newest first and starting after the `after`
+    (timestamp, id) pair, read from ix_comment_blip_timestamp"""
+    comments = cls.query.filter(cls.blip_id == blip_id)
+    if after is not None:
+      timestamp, comment_id = after
+      # The first condition is implied by the second; it is the one an
+      # index range scan can start from
+      comments = comments.filter(cls.timestamp <= timestamp,
+                                 db.or_(cls.timestamp < timestamp,
+                                        db.and_(cls.timestamp == timestamp, cls.id < comment_id)))
+    return comments.order_by(db.desc(cls.timestamp), db.desc(cls.id)).limit(limit).all()
+
+  def serialize_with(self, blip):
     return {
       'id'       : self.id,
-      'blip'     : blip.serialize,
+      'blip'     : blip,
       'comment'  : self.comment,
       'user_id'  : self.user_id,
       'timestamp': self.timestamp.isoformat()
@@ -140,6 +410,9 @@ class Comment(db.Model):
 
 class Favorite(db.Model):
   __tablename__ = "favorite"
+  # (user_id, blip_id) backs a user's favorites, (blip_id, user_id) a blip's
+  __table_args__ = (db.UniqueConstraint('user_id', 'blip_id', name='uq_favorite_user_blip'),
+                    db.Index('ix_favorite_blip_user', 'blip_id', 'user_id'))
 
   id      = db.Column(db.Integer, primary_key = True)
   user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
@@ -155,4 +428,85 @@ class Favorite(db.Model):
       'id'     : self.id,
       'user_id': self.user_id,
       'blip_id': self.blip_id
-    }
\ No newline at end of file
+    }
+
+class Tile(db.Model):
+  """Running summary of the blips inside a geohash cell, kept at every
+  precision in tiles.TILE_PRECISIONS (see tiles.py)"""
+  __tablename__ = "tile"
+
+  cell      = db.Column(db.String(geo.GEOHASH_PRECISION), primary_key = True)
+  count     = db.Column(db.Integer, default = 0, nullable = False)
+  latest    = db.Column(db.DateTime)
+  # The most blipped songs as "song_id:count,..." most blipped first
+  top_songs = db.Column(db.String(200), default = "")
+
+  def __init__(self, cell):
+    self.cell      = cell
+    self.count     = 0
+    self.top_songs = ""
+
+  @classmethod
+  def encode_top(cls, songs):
+    return ",".join("%d:%d" % song for song in songs)
+
+  @classmethod
+  def decode_top(cls, top_songs):
+    """[(song_id, count)] from top_songs"""
+    return [tuple(map(int, entry.split(":"))) for entry in (top_songs or "").split(",") if entry]
+
+  @property
+  def serialize(self):
+    south, west, north, east = geo.geohash_bounds(self.cell)
+    return {
+      'cell'      : self.cell,
+      'latitude'  : (south + north) / 2,
+      'longitude' : (west + east) / 2,
+      'count'     : self.count,
+      'latest'    : self.latest.isoformat() if self.latest else None,
+      'songs'     : Tile.decode_top(self.top_songs)
+    }
+
+class TileSong(db.Model):
+  """Blips of one song inside a tile"""
+  __tablename__ = "tile_song"
+
+  cell    = db.Column(db.String(geo.GEOHASH_PRECISION), primary_key = True)
+  song_id = db.Column(db.Integer, db.ForeignKey('song.id'), primary_key = True)
+  count   = db.Column(db.Integer, default = 0, nullable = False)
+
+  def __init__(self, cell, song_id):
+    self.cell    = cell
+    self.song_id = song_id
+    self.count   = 0
+
+def feed_score(distance, age):
+  """Ranking of a blip `distance` miles away and `age` hours old, in (0, 1]"""
+  return 1.0 / ((1 + distance / FEED_DISTANCE_SCALE) * (1 + age / FEED_AGE_SCALE))
+
+##################################################
+# BATCHED SERIALIZATION
+##################################################
+#
+# Serializing a list of objects costs a fixed number of queries, one per
+# level of nesting, however many objects there are.
+
+def serialize_songs(songs):
+  providers = defaultdict(list)
+  song_ids = set(song.id for song in songs)
+  if song_ids:
+    for provider in SongProvider.query.filter(SongProvider.song_id.in_(song_ids)).order_by(SongProvider.id):
+      providers[provider.song_id].append(provider)
+  return [song.serialize_with(providers[song.id]) for song in songs]
+
+def serialize_blips(blips):
+  song_ids = set(blip.song_id for blip in blips)
+  songs = Song.query.filter(Song.id.in_(song_ids)).all() if song_ids else []
+  serialized = dict(zip([song.id for song in songs], serialize_songs(songs)))
+  return [blip.serialize_with(serialized[int(blip.song_id)]) for blip in blips]
+
+def serialize_comments(comments):
+  blip_ids = set(comment.blip_id for comment in comments)
+  blips = Blip.query.filter(Blip.id.in_(blip_ids)).all() if blip_ids else []
+  serialized = dict(zip([blip.id for blip in blips], serialize_blips(blips)))
+  return [comment.serialize_with(serialized[int(comment.blip_id)]) for comment in comments]
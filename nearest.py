@@ -0,0 +1,143 @@
+##################################################
+# IN-MEMORY NEAREST-BLIP ENGINE
+##################################################
+#
+# With NEAREST_ENGINE = "memory" and NumPy installed, the nearest and radius
+# modes of GET /api/blip rank blips against coordinates held in process, in
+# contiguous arrays, with one vectorized haversine pass per query. Only the
+# ids of the winners go to the database, to be hydrated through the models.
+# Without NumPy, or with NEAREST_ENGINE = "sql", the SQL path in models.py
+# is used.
+#
+# The arrays catch up with the blip table by loading the rows with ids above
+# the last one seen: right after this process inserts blips, and before a
+# query once NEAREST_SYNC_INTERVAL seconds have passed, which picks up other
+# processes' blips. Every NEAREST_RELOAD_INTERVAL seconds they are reloaded
+# in full, in case a blip committed after one with a higher id.
+
+import time
+import threading
+from settings import *
+from models import *
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+INITIAL_CAPACITY = 1024
+
+index = None
+
+def get_index():
+  """The process's NearestIndex, or None when the SQL path should be used"""
+  global index
+  if app.config['NEAREST_ENGINE'] != "memory" or numpy is None:
+    return None
+  if index is None:
+    index = NearestIndex()
+  if time.time() - index.loaded > app.config['NEAREST_RELOAD_INTERVAL']:
+    index.load()
+  elif time.time() - index.synced > app.config['NEAREST_SYNC_INTERVAL']:
+    index.sync()
+  return index
+
+def blips_added():
+  """Called after this process inserts blips"""
+  if index is not None:
+    index.sync()
+
+class NearestIndex(object):
+  """Blip ids and coordinates (in radians, with the cosine of the latitude)
+  in arrays that grow by doubling. Appends only write past `size`, so a
+  query works on a consistent snapshot taken under the lock."""
+
+  def __init__(self):
+    self.lock    = threading.Lock()
+    self.ids = self.lats = self.lngs = self.coslats = None
+    self.size    = 0
+    self.last_id = 0
+    self.loaded  = 0
+    self.synced  = 0
+    self._allocate(INITIAL_CAPACITY)
+
+  def load(self):
+    with self.lock:
+      # New arrays, as queries may still be reading the old ones
+      self.ids = self.lats = self.lngs = self.coslats = None
+      self.size    = 0
+      self.last_id = 0
+      self._allocate(INITIAL_CAPACITY)
+      self._fetch()
+      self.loaded  = time.time()
+
+  def sync(self):
+    with self.lock:
+      self._fetch()
+
+  def nearest(self, latitude, longitude, limit=25):
+    """Ids of the `limit` blips closest to a point, closest first"""
+    ids, distances = self._distances(latitude, longitude)
+    if len(ids) > limit:
+      closest = numpy.argpartition(distances, limit - 1)[:limit]
+      ids, distances = ids[closest], distances[closest]
+    order = numpy.lexsort((ids, distances))
+    return [int(blip_id) for blip_id in ids[order]]
+
+  def within(self, latitude, longitude, radius, limit=25, after=None):
+    """(distance, id) pairs of the blips within `radius` miles of a point,
+    ordered by distance and starting after the `after` pair, as in
+    Blip.within_radius"""
+    ids, distances = self._distances(latitude, longitude)
+    keep = distances <= radius
+    if after is not None:
+      keep &= (distances > after[0]) | ((distances == after[0]) & (ids > after[1]))
+    ids, distances = ids[keep], distances[keep]
+    if len(ids) > limit:
+      closest = numpy.argpartition(distances, limit - 1)[:limit]
+      ids, distances = ids[closest], distances[closest]
+    order = numpy.lexsort((ids, distances))
+    return [(float(distances[i]), int(ids[i])) for i in order]
+
+  def __len__(self):
+    return self.size
+
+  def _distances(self, latitude, longitude):
+    """(ids, haversine distances in miles) for every indexed blip"""
+    with self.lock:
+      size = self.size
+      ids, lats, lngs, coslats = self.ids, self.lats, self.lngs, self.coslats
+    ids, lats, lngs, coslats = ids[:size], lats[:size], lngs[:size], coslats[:size]
+    latitude, longitude = numpy.radians(latitude), numpy.radians(longitude)
+    a = (numpy.sin((lats - latitude) / 2) ** 2 +
+         numpy.cos(latitude) * coslats * numpy.sin((lngs - longitude) / 2) ** 2)
+    return ids, 2 * geo.EARTH_RADIUS_MILES * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+
+  def _fetch(self):
+    """Append the blips with ids above the last one seen"""
+    rows = db.session.query(Blip.id, Blip.latitude, Blip.longitude).filter(
+      Blip.id > self.last_id, Blip.latitude != None, Blip.longitude != None).order_by(Blip.id).all()
+    self.synced = time.time()
+    if not rows:
+      return
+    if self.size + len(rows) > len(self.ids):
+      self._allocate(max(2 * len(self.ids), self.size + len(rows)))
+    end = self.size + len(rows)
+    ids, lats, lngs = zip(*rows)
+    self.ids[self.size:end]     = ids
+    self.lats[self.size:end]    = numpy.radians(lats)
+    self.lngs[self.size:end]    = numpy.radians(lngs)
+    self.coslats[self.size:end] = numpy.cos(self.lats[self.size:end])
+    self.size    = end
+    self.last_id = ids[-1]
+
+  def _allocate(self, capacity):
+    """Fresh arrays of `capacity` holding the current entries"""
+    arrays = []
+    for current, dtype in [(self.ids, numpy.int64), (self.lats, float),
+                           (self.lngs, float), (self.coslats, float)]:
+      array = numpy.zeros(capacity, dtype=dtype)
+      if current is not None:
+        array[:self.size] = current[:self.size]
+      arrays.append(array)
+    self.ids, self.lats, self.lngs, self.coslats = arrays
@@ -0,0 +1,337 @@
+##################################################
+# PREFORK RUNNER
+##################################################
+#
+#   python prefork.py                             # a worker per CPU
+#   python prefork.py --workers 4 --port 8000 --mode threaded
+#
+# The master imports the app, and everything the app imports, and opens the
+# listening socket before forking the workers, so the workers share the
+# loaded modules copy-on-write and accept connections on one socket. Each
+# worker serves requests as serve.py does, on green threads or threads.
+#
+# * A worker exits after PREFORK_MAX_REQUESTS requests (plus up to 10%, so
+#   the workers do not all restart at once) and is replaced, as is one that
+#   dies.
+# * SIGHUP reloads gracefully: the master re-executes itself with the socket
+#   left open, loads the new code, starts new workers and only then asks the
+#   old ones to finish their requests and exit.
+# * SIGTERM or SIGINT stops the workers accepting, gives them
+#   PREFORK_GRACEFUL_TIMEOUT seconds to finish their requests, then exits.
+#
+# With more than one worker, LIVE_BROKER "auto" fans new blips out to every
+# worker's GET /api/blip/live streams over sockets in a shared directory.
+#
+# The workers share a cache.SharedMemoryCache, mapped before the fork. It is
+# the response cache's shared backend, so a write in one worker invalidates
+# the cached responses of all of them, and holds the encoded song and blip
+# fragments, so one worker's provider lookups serve every worker.
+
+import os
+import sys
+import time
+import errno
+import random
+import shutil
+import signal
+import socket
+import argparse
+import tempfile
+import threading
+import traceback
+import multiprocessing
+import serve
+
+# Set across a SIGHUP re-exec: the listening socket's fd, the workers of
+# the previous code to retire once the new ones are up, and the directory
+# of the workers' live blip sockets
+LISTENER_ENV = 'LATITUNE_PREFORK_FD'
+RETIRE_ENV   = 'LATITUNE_PREFORK_RETIRE'
+LIVE_ENV     = 'LATITUNE_PREFORK_LIVE'
+
+LISTEN_BACKLOG = 2048
+
+def on_signal(mode, signum, handler):
+  """Call handler() on signum; through the hub in gevent mode"""
+  if mode == "gevent":
+    import gevent
+    return gevent.signal_handler(signum, handler)
+  signal.signal(signum, lambda signum, frame: handler())
+
+def listen(host, port):
+  """The listening socket, inherited across a reload or newly bound. It is
+  non-blocking so idle workers woken for a connection another one took go
+  back to waiting."""
+  fd = os.environ.pop(LISTENER_ENV, None)
+  if fd:
+    listener = socket.fromfd(int(fd), socket.AF_INET, socket.SOCK_STREAM)
+    os.close(int(fd))
+  else:
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(LISTEN_BACKLOG)
+  listener.setblocking(False)
+  return listener
+
+def install_shared_cache(app):
+  import controllers
+  import serialization
+  from cache import SharedMemoryCache
+  shared = SharedMemoryCache(app.config['SHARED_CACHE_SIZE'], app.config['SHARED_CACHE_SLOT_SIZE'],
+                             ttl=app.config['RESPONSE_CACHE_TTL'])
+  controllers.response_cache.shared = shared
+  serialization.shared_cache = shared
+  return shared
+
+def share_live_blips(app, workers):
+  """Have the workers' GET /api/blip/live streams see the blips created in
+  any worker: LIVE_BROKER "auto" becomes a socket directory they share
+  (see realtime.SocketBroker), and "local" is refused. Returns the
+  directory, to be removed on exit, or None."""
+  broker = app.config['LIVE_BROKER']
+  if workers > 1 and broker == "local":
+    sys.exit("LIVE_BROKER local only reaches one worker's streams; use auto, "
+             "a unix:// directory or a redis:// URL with %d workers" % workers)
+  if workers == 1 or broker != "auto":
+    return None
+  directory = os.environ.get(LIVE_ENV) or tempfile.mkdtemp(prefix="latitune-live-")
+  os.environ[LIVE_ENV] = directory
+  app.config['LIVE_BROKER'] = "unix://" + directory
+  return directory
+
+##################################################
+# MASTER
+##################################################
+
+class Master(object):
+
+  def __init__(self, app, db, listener, mode, workers, max_requests, graceful_timeout):
+    self.app              = app
+    self.db               = db
+    self.listener         = listener
+    self.mode             = mode
+    self.count            = workers
+    self.max_requests     = max_requests
+    self.graceful_timeout = graceful_timeout
+    self.workers          = set()
+    self.retiring         = set()
+    self.signals          = []
+    self.handlers         = []
+
+  def run(self):
+    for signum in [signal.SIGHUP, signal.SIGTERM, signal.SIGINT]:
+      self.handlers.append(on_signal(self.mode, signum, lambda signum=signum: self.signals.append(signum)))
+    self.spawn_workers()
+    self.retire([int(pid) for pid in os.environ.pop(RETIRE_ENV, "").split(",") if pid])
+    while True:
+      self.reap()
+      if self.signals:
+        if self.signals.pop(0) == signal.SIGHUP:
+          self.reload()
+        self.stop()
+        return
+      self.spawn_workers()
+      time.sleep(0.1)
+
+  def spawn_workers(self):
+    while len(self.workers) < self.count:
+      self.spawn()
+
+  def spawn(self):
+    # Connections the master opened while loading must not be shared
+    self.db.dispose_engines(self.app)
+    limit = self.max_requests + random.randint(0, self.max_requests // 10)
+    pid = os.fork()
+    if pid:
+      self.workers.add(pid)
+      return
+    for handler in self.handlers:
+      if handler is not None:
+        handler.cancel()
+    code = 0
+    try:
+      Worker(self.app, self.listener, self.mode, limit, self.graceful_timeout).run()
+    except Exception:
+      traceback.print_exc()
+      code = 1
+    finally:
+      os._exit(code)
+
+  def retire(self, pids):
+    for pid in pids:
+      self.signal(pid, signal.SIGTERM)
+      self.retiring.add(pid)
+
+  def reap(self):
+    while True:
+      try:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+      except OSError as e:
+        if e.errno != errno.ECHILD:
+          raise
+        pid = 0
+      if not pid:
+        break
+      self.workers.discard(pid)
+      self.retiring.discard(pid)
+    # Children reaped elsewhere, e.g. by gevent's SIGCHLD handling
+    for pid in list(self.workers | self.retiring):
+      if not self.signal(pid, 0):
+        self.workers.discard(pid)
+        self.retiring.discard(pid)
+
+  def reload(self):
+    """Re-execute the master on the same socket; the new master retires
+    these workers once its own are running"""
+    env = dict(os.environ)
+    env[LISTENER_ENV] = str(self.listener.fileno())
+    env[RETIRE_ENV] = ",".join(str(pid) for pid in self.workers | self.retiring)
+    print "master %d reloading" % os.getpid()
+    sys.stdout.flush()
+    os.execve(sys.executable, [sys.executable] + sys.argv, env)
+
+  def stop(self):
+    self.retire(self.workers)
+    self.workers = set()
+    deadline = time.time() + self.graceful_timeout
+    while self.retiring and time.time() < deadline:
+      time.sleep(0.1)
+      self.reap()
+    for pid in self.retiring:
+      self.signal(pid, signal.SIGKILL)
+    self.reap()
+
+  def signal(self, pid, signum):
+    """Send signum to pid; False if it no longer exists"""
+    try:
+      os.kill(pid, signum)
+    except OSError as e:
+      if e.errno != errno.ESRCH:
+        raise
+      return False
+    return True
+
+##################################################
+# WORKER
+##################################################
+
+class Worker(object):
+  """Serves requests from the shared socket until it has served
+  `max_requests` or is sent SIGTERM, then lets its requests finish"""
+
+  def __init__(self, app, listener, mode, max_requests, graceful_timeout):
+    self.app              = app
+    self.listener         = listener
+    self.mode             = mode
+    self.max_requests     = max_requests
+    self.graceful_timeout = graceful_timeout
+    self.requests         = 0
+    self.stopping         = False
+    self.shutdown         = None
+
+  def run(self):
+    # Ctrl-C reaches the whole process group; the master decides what to do
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    app = self.counted(self.app)
+    if self.mode == "gevent":
+      import gevent
+      from gevent.pool import Pool
+      from gevent.pywsgi import WSGIServer
+      server = WSGIServer(self.listener, app, spawn=Pool(self.app.config['SERVE_CONNECTIONS']), log=None)
+      self.shutdown = lambda: gevent.spawn(server.stop, self.graceful_timeout)
+      on_signal(self.mode, signal.SIGTERM, self.stop)
+      server.serve_forever()
+    else:
+      server = threaded_server(self.listener, app)
+      self.shutdown = lambda: threading.Thread(target=server.shutdown).start()
+      on_signal(self.mode, signal.SIGTERM, self.stop)
+      server.serve_forever()
+      deadline = time.time() + self.graceful_timeout
+      while server.active and time.time() < deadline:
+        time.sleep(0.05)
+    self.drain()
+
+  def drain(self):
+    """Give queued provider lookups the graceful timeout to finish; any
+    still queued after it are rescheduled by another worker's sweep"""
+    import providers
+    if providers.queue is not None and not providers.queue.wait(self.graceful_timeout):
+      print >>sys.stderr, "worker %d exiting with provider lookups queued" % os.getpid()
+
+  def stop(self):
+    if not self.stopping:
+      self.stopping = True
+      self.shutdown()
+
+  def counted(self, app):
+    def counted_app(environ, start_response):
+      self.requests += 1
+      if self.requests >= self.max_requests:
+        self.stop()
+      return app(environ, start_response)
+    return counted_app
+
+def threaded_server(listener, app):
+  """werkzeug's threaded server accepting on an already listening socket,
+  counting the requests it is handling in `active`"""
+  from werkzeug.serving import ThreadedWSGIServer
+
+  class ListenerWSGIServer(ThreadedWSGIServer):
+    def __init__(self):
+      self.active = 0
+      self.lock   = threading.Lock()
+      host, port  = listener.getsockname()[:2]
+      ThreadedWSGIServer.__init__(self, host, port, app)
+
+    def server_bind(self):
+      self.socket.close()
+      self.socket = listener
+      self.server_address = listener.getsockname()
+      self.server_name, self.server_port = self.server_address[:2]
+
+    def server_activate(self):
+      pass
+
+    def process_request(self, request, client_address):
+      # Counted before the thread starts, so a worker that stops right
+      # after accepting still waits for the request
+      with self.lock:
+        self.active += 1
+      ThreadedWSGIServer.process_request(self, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+      try:
+        ThreadedWSGIServer.process_request_thread(self, request, client_address)
+      finally:
+        with self.lock:
+          self.active -= 1
+
+  return ListenerWSGIServer()
+
+def main(argv):
+  parser = argparse.ArgumentParser(description="serve the latitune API from preforked workers")
+  parser.add_argument("--mode", choices=["auto", "gevent", "threaded"], default="auto")
+  parser.add_argument("--host", default="0.0.0.0")
+  parser.add_argument("--port", type=int, default=int(os.environ.get('PORT', 5000)))
+  parser.add_argument("--workers", type=int, help="default WEB_CONCURRENCY, or one per CPU")
+  parser.add_argument("--max-requests", type=int, help="default PREFORK_MAX_REQUESTS")
+  args = parser.parse_args(argv)
+
+  mode = serve.prepare(args.mode)
+  import latitune
+  app = latitune.create_app()
+  install_shared_cache(app)
+  workers = args.workers or app.config['PREFORK_WORKERS'] or multiprocessing.cpu_count()
+  live = share_live_blips(app, workers)
+  listener = listen(args.host, args.port)
+  print "master %d serving on %s:%d with %d %s workers" % (os.getpid(), args.host, args.port, workers, mode)
+  sys.stdout.flush()
+  Master(app, latitune.db, listener, mode, workers, args.max_requests or app.config['PREFORK_MAX_REQUESTS'],
+         app.config['PREFORK_GRACEFUL_TIMEOUT']).run()
+  if live:
+    shutil.rmtree(live, ignore_errors=True)
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
@@ -0,0 +1,163 @@
+##################################################
+# SONG PROVIDER RESOLUTION
+##################################################
+#
+# Looks up the Rdio/Spotify tracks for a song through the Echo Nest. This
+# runs on a background job queue so creating a song never waits on the
+# Echo Nest; the song is returned with provider_status "pending" and
+# flips to "resolved" (or "failed") once the lookup finishes.
+#
+# Lookups are cached by echonest_id, so the same track created under a
+# different artist/title spelling never goes back to the network, and the
+# uncached ids of a batch of songs share multi-id profile requests.
+#
+# The queue lives in the process's memory, so a worker that exits (crashing,
+# or replaced by prefork.py) loses its queued lookups. sweep() schedules
+# the songs left pending again; each process enqueues it on its first
+# request and every PROVIDER_SWEEP_INTERVAL seconds after.
+
+import sys
+import time
+import traceback
+from datetime import datetime, timedelta
+
+import instrumentation
+from settings import *
+from models import *
+from jobs import JobQueue
+from cache import LRUCache, DiskStore
+
+# (SongProvider.provider, Echo Nest catalog) pairs to resolve
+CATALOGS = [("Rdio", "rdio-US"), ("Spotify", "spotify-WW")]
+
+# Songs looked up per Echo Nest profile request
+PROFILE_BATCH_SIZE = 10
+
+# Songs sweep() schedules at once
+SWEEP_BATCH_SIZE = 100
+
+# Anything with pyechonest.song's profile(ids=, buckets=); tests swap in a
+# fake. Left unset, get_client imports pyechonest on the first lookup.
+client = None
+
+queue = None
+track_cache = None
+last_sweep = 0
+
+def get_queue():
+  global queue
+  if queue is None:
+    queue = JobQueue(workers  = app.config['PROVIDER_WORKERS'],
+                     retries  = app.config['PROVIDER_RETRIES'],
+                     backoff  = app.config['PROVIDER_BACKOFF'],
+                     eager    = app.config['JOBS_EAGER'],
+                     teardown = db.session.remove)
+  return queue
+
+# The Echo Nest SDK is slow to import, so it is loaded the first time it is
+# used rather than when a worker boots
+def get_client():
+  global client
+  if client is None:
+    from pyechonest import config, song
+    config.ECHO_NEST_API_KEY = echonest_api_key
+    client = song
+  return client
+
+def get_track_cache():
+  global track_cache
+  if track_cache is None:
+    path = app.config['PROVIDER_CACHE_PATH']
+    track_cache = LRUCache(maxsize = app.config['PROVIDER_CACHE_SIZE'],
+                           ttl     = app.config['PROVIDER_CACHE_TTL'],
+                           store   = DiskStore(path) if path else None)
+    track_cache.warm()
+  return track_cache
+
+def lookup_tracks(echonest_ids):
+  """{echonest_id: {catalog: [track keys]}} for Echo Nest song ids, making
+  one multi-id profile call per PROFILE_BATCH_SIZE ids that are not cached"""
+  cache = get_track_cache()
+  found = {}
+  missing = []
+  for echonest_id in echonest_ids:
+    tracks = cache.get(echonest_id)
+    if tracks is None:
+      missing.append(echonest_id)
+    else:
+      found[echonest_id] = tracks
+  for start in range(0, len(missing), PROFILE_BATCH_SIZE):
+    batch = missing[start:start + PROFILE_BATCH_SIZE]
+    fetched = dict((echonest_id, dict((catalog, []) for provider, catalog in CATALOGS))
+                   for echonest_id in batch)
+    with instrumentation.timed("http"):
+      results = get_client().profile(ids=batch,
+                                     buckets=['id:' + catalog for provider, catalog in CATALOGS])
+    for ensong in results:
+      tracks = fetched.setdefault(ensong.id, dict((catalog, []) for provider, catalog in CATALOGS))
+      for provider, catalog in CATALOGS:
+        tracks[catalog].extend(track["foreign_id"].split(":")[2]
+                               for track in ensong.get_tracks(catalog))
+    for echonest_id in batch:
+      cache.set(echonest_id, fetched[echonest_id])
+      found[echonest_id] = fetched[echonest_id]
+  return found
+
+def schedule(song_ids):
+  get_queue().enqueue(resolve_providers, (song_ids,), on_failure=mark_failed)
+
+def resolve_providers(song_ids):
+  songs = Song.query.filter(Song.id.in_(song_ids), Song.provider_status == Song.PENDING).all()
+  if not songs:
+    return
+  try:
+    tracks = lookup_tracks(sorted(set(str(song.echonestID) for song in songs)))
+    for song in songs:
+      for provider, catalog in CATALOGS:
+        for key in tracks[str(song.echonestID)][catalog]:
+          db.session.add(SongProvider(song.id, provider, key))
+      song.provider_status = Song.RESOLVED
+    db.session.commit()
+  except:
+    db.session.rollback()
+    raise
+
+def sweep():
+  """Schedule the lookups of up to SWEEP_BATCH_SIZE songs still pending
+  PROVIDER_STALE_AFTER seconds after theirs was. Each song is claimed with
+  a conditional update, so concurrent sweeps schedule it once. Returns the
+  ids scheduled."""
+  now = datetime.now()
+  stale = db.and_(Song.provider_status == Song.PENDING,
+                  db.or_(Song.provider_scheduled == None,
+                         Song.provider_scheduled < now - timedelta(seconds=app.config['PROVIDER_STALE_AFTER'])))
+  candidates = [row.id for row in db.session.query(Song.id).filter(stale).order_by(Song.id).limit(SWEEP_BATCH_SIZE)]
+  claimed = [song_id for song_id in candidates
+             if Song.query.filter(Song.id == song_id, stale).update(
+               {'provider_scheduled': now}, synchronize_session=False)]
+  db.session.commit()
+  if claimed:
+    schedule(claimed)
+  return claimed
+
+def sweep_due():
+  """Enqueue sweep() if PROVIDER_SWEEP_INTERVAL has passed since this
+  process last did; not in eager mode, where it would hold up a request"""
+  global last_sweep
+  if app.config['JOBS_EAGER'] or time.time() - last_sweep < app.config['PROVIDER_SWEEP_INTERVAL']:
+    return
+  last_sweep = time.time()
+  get_queue().enqueue(run_sweep)
+
+def run_sweep():
+  # A failed sweep is not retried; the next one takes its place
+  try:
+    sweep()
+  except Exception:
+    db.session.rollback()
+    traceback.print_exc(file=sys.stderr)
+
+def mark_failed(song_ids):
+  Song.query.filter(Song.id.in_(song_ids), Song.provider_status == Song.PENDING).update(
+    {'provider_status': Song.FAILED}, synchronize_session=False)
+  db.session.commit()
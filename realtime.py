@@ -0,0 +1,273 @@
+##################################################
+# NEARBY BLIP PUSH
+##################################################
+#
+# GET /api/blip/live streams the blips created near a point as server-sent
+# events, instead of clients polling GET /api/blip for them.
+#
+# Each stream is a Subscription to a circle, registered in the process's
+# Registry under the geohash cells (of up to SUBSCRIPTION_PRECISION
+# characters) that cover the circle. create_blip publishes every new blip
+# through the broker; a process delivering one looks up the prefixes of its
+# geohash, so only the subscriptions in its cell are checked against their
+# circle, however many streams are open.
+#
+# The broker is LIVE_BROKER:
+#
+# * "local" delivers to this process's subscribers ("auto" is the same,
+#   except that prefork.py replaces it with a unix:// directory)
+# * unix:///a/directory fans out to every process on the host that uses the
+#   same directory, over a datagram socket each
+# * a redis:// URL publishes through Redis, reaching every process on every
+#   host
+#
+# Events carry the blip's id, so a client that reconnects with
+# Last-Event-ID is first sent the nearby blips it missed.
+
+import os
+import sys
+import json
+import time
+import errno
+import Queue
+import socket
+import threading
+import traceback
+from settings import *
+from models import *
+import geo
+import serialization
+
+try:
+  import redis
+except ImportError:
+  redis = None
+
+# Cells of 4 characters are about 24 by 12 miles
+SUBSCRIPTION_PRECISION = 4
+SUBSCRIPTION_MAX_CELLS = 32
+
+# Redis channel new blips are published on
+CHANNEL = "latitune:blips"
+
+# Seconds the Redis listener waits before reconnecting
+RECONNECT_DELAY = 1.0
+
+# Largest event a SocketBroker receives
+MAX_DATAGRAM = 65536
+
+class Subscription(object):
+  """A stream's circle and its queue of (blip_id, json) events. When more
+  than `size` events are waiting the subscription is closed, so a client
+  that cannot keep up reconnects and catches up through Last-Event-ID."""
+
+  def __init__(self, latitude, longitude, radius, size=100):
+    self.latitude  = latitude
+    self.longitude = longitude
+    self.radius    = radius
+    self.cells     = geo.cover(geo.bounding_box(latitude, longitude, radius),
+                               SUBSCRIPTION_MAX_CELLS, SUBSCRIPTION_PRECISION)
+    self.events    = Queue.Queue(size)
+    self.closed    = False
+
+  def contains(self, latitude, longitude):
+    return geo.haversine(self.latitude, self.longitude, latitude, longitude) <= self.radius
+
+  def put(self, event):
+    """Queue an event; False if the subscription is full and now closed"""
+    try:
+      self.events.put_nowait(event)
+    except Queue.Full:
+      self.closed = True
+      return False
+    return True
+
+  def get(self, timeout):
+    """The next event, or None after `timeout` seconds without one"""
+    try:
+      return self.events.get(timeout=timeout)
+    except Queue.Empty:
+      return None
+
+class Registry(object):
+  """This process's subscriptions, by the geohash cells covering them"""
+
+  def __init__(self):
+    self.lock  = threading.Lock()
+    self.cells = {}
+
+  def subscribe(self, subscription):
+    with self.lock:
+      for cell in subscription.cells:
+        self.cells.setdefault(cell, set()).add(subscription)
+
+  def unsubscribe(self, subscription):
+    with self.lock:
+      for cell in subscription.cells:
+        subscribers = self.cells.get(cell)
+        if subscribers is not None:
+          subscribers.discard(subscription)
+          if not subscribers:
+            del self.cells[cell]
+
+  def deliver(self, latitude, longitude, blip_id, encoded):
+    """Queue a blip for the subscriptions whose circle contains it"""
+    cell = geo.geohash_encode(latitude, longitude, SUBSCRIPTION_PRECISION)
+    with self.lock:
+      candidates = set()
+      for precision in range(1, len(cell) + 1):
+        candidates.update(self.cells.get(cell[:precision], ()))
+    for subscription in candidates:
+      if subscription.contains(latitude, longitude) and not subscription.put((blip_id, encoded)):
+        self.unsubscribe(subscription)
+
+  def __len__(self):
+    with self.lock:
+      return len(set().union(*self.cells.values())) if self.cells else 0
+
+registry = Registry()
+
+##################################################
+# BROKERS
+##################################################
+
+class LocalBroker(object):
+  """Delivers to the subscribers of this process"""
+
+  def __init__(self, registry):
+    self.registry = registry
+
+  def publish(self, latitude, longitude, blip_id, encoded):
+    self.registry.deliver(latitude, longitude, blip_id, encoded)
+
+class SocketBroker(object):
+  """Fans out to the processes on this host that share `directory`. Each
+  binds a datagram socket there, named after its pid, and a thread
+  delivers what arrives on it to its own subscribers. Publishing sends to
+  every socket in the directory, removing those of processes that have
+  exited. An event for a process too far behind to take it is dropped."""
+
+  def __init__(self, registry, directory):
+    self.registry  = registry
+    self.directory = directory
+    self.path      = os.path.join(directory, "%d.sock" % os.getpid())
+    if os.path.exists(self.path):
+      os.unlink(self.path)
+    self.listener  = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    self.listener.bind(self.path)
+    self.sender    = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    self.sender.setblocking(False)
+    self.thread    = threading.Thread(target=self._listen, name="live-broker")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def publish(self, latitude, longitude, blip_id, encoded):
+    message = json.dumps([latitude, longitude, blip_id, encoded])
+    for name in os.listdir(self.directory):
+      path = os.path.join(self.directory, name)
+      try:
+        self.sender.sendto(message, path)
+      except socket.error as e:
+        if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+          self._forget(path)
+        elif e.errno == errno.EAGAIN:
+          print >>sys.stderr, "live blip %d dropped for %s" % (blip_id, path)
+        else:
+          raise
+
+  def _forget(self, path):
+    try:
+      os.unlink(path)
+    except OSError:
+      pass
+
+  def _listen(self):
+    while True:
+      message = self.listener.recv(MAX_DATAGRAM)
+      try:
+        self.registry.deliver(*json.loads(message))
+      except Exception:
+        traceback.print_exc(file=sys.stderr)
+
+class RedisBroker(object):
+  """Publishes on a Redis channel that a thread in every process listens
+  to, delivering to its own subscribers. The thread reconnects after
+  RECONNECT_DELAY when the connection is lost."""
+
+  def __init__(self, registry, url, channel=CHANNEL):
+    if redis is None:
+      raise ValueError("LIVE_BROKER %s needs the redis package" % url)
+    self.registry = registry
+    self.channel  = channel
+    self.client   = redis.StrictRedis.from_url(url)
+    self.thread   = threading.Thread(target=self._listen, name="live-broker")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def publish(self, latitude, longitude, blip_id, encoded):
+    self.client.publish(self.channel, json.dumps([latitude, longitude, blip_id, encoded]))
+
+  def _listen(self):
+    while True:
+      try:
+        pubsub = self.client.pubsub()
+        pubsub.subscribe(self.channel)
+        for message in pubsub.listen():
+          if message['type'] == 'message':
+            self.registry.deliver(*json.loads(message['data']))
+      except Exception:
+        traceback.print_exc(file=sys.stderr)
+        time.sleep(RECONNECT_DELAY)
+
+broker = None
+
+def get_broker():
+  """The process's broker for LIVE_BROKER, created on first use so that
+  each prefork.py worker has its own socket or Redis connection"""
+  global broker
+  if broker is None:
+    url = app.config['LIVE_BROKER']
+    if url in ("local", "auto"):
+      broker = LocalBroker(registry)
+    elif url.startswith("unix://"):
+      broker = SocketBroker(registry, url[len("unix://"):])
+    else:
+      broker = RedisBroker(registry, url)
+  return broker
+
+def publish(blip):
+  """Push a new blip to the streams around it"""
+  fragment = serialization.blips([blip])[0]
+  get_broker().publish(float(blip.latitude), float(blip.longitude), blip.id, fragment.json)
+
+##################################################
+# STREAMS
+##################################################
+
+def missed(subscription, last_id, limit):
+  """(blip_id, json) events of the latest `limit` blips after `last_id` in
+  the subscription's box, oldest first, leaving those outside its circle"""
+  box = geo.bounding_box(subscription.latitude, subscription.longitude, subscription.radius)
+  blips = Blip.query.filter(Blip.id > last_id, Blip.box_filter(box)).order_by(db.desc(Blip.id)).limit(limit).all()
+  blips = [blip for blip in reversed(blips) if subscription.contains(blip.latitude, blip.longitude)]
+  return [(blip.id, fragment.json) for blip, fragment in zip(blips, serialization.blips(blips))]
+
+def stream(subscription, backlog=(), keepalive=15):
+  """Server-sent events for a registered subscription: the `backlog`, then
+  each event as it arrives, with a comment every `keepalive` seconds so
+  dead connections are noticed. Unsubscribes when the client goes away or
+  the subscription is closed."""
+  last_id = 0
+  try:
+    for blip_id, encoded in backlog:
+      last_id = max(last_id, blip_id)
+      yield "id: %d\nevent: blip\ndata: %s\n\n" % (blip_id, encoded)
+    while not subscription.closed or not subscription.events.empty():
+      event = subscription.get(keepalive)
+      if event is None:
+        yield ": keepalive\n\n"
+      elif event[0] > last_id:
+        # Blips created while the backlog was read arrive twice
+        yield "id: %d\nevent: blip\ndata: %s\n\n" % event
+  finally:
+    registry.unsubscribe(subscription)
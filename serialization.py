@@ -0,0 +1,173 @@
+##################################################
+# JSON SERIALIZATION
+##################################################
+#
+# Responses are encoded by dumps() with the fastest JSON library available
+# (JSON_ENCODER: "ujson", "simplejson", "json", or "auto" for the first of
+# those that is installed), compactly rather than pretty-printed.
+#
+# Songs and blips are encoded once and kept as Fragments of JSON in
+# fragment_cache under their model, id and version, the parts of the row
+# that change after it is created (a song's provider_status, a blip's
+# counts). dumps() embeds fragments verbatim, so a page of cached blips is
+# encoded as a list of strings, and songs found in the cache skip the
+# provider lookup. With a shared_cache (set up by prefork.py) fragments
+# encoded by one worker are found by the others.
+#
+# With shape=normalized, list endpoints return blips that reference their
+# song by song_id, and each song once in a top-level "songs" list.
+
+import re
+import json
+import uuid
+from settings import *
+from models import *
+from cache import LRUCache
+
+try:
+  import ujson
+except ImportError:
+  ujson = None
+
+try:
+  import simplejson
+except ImportError:
+  simplejson = None
+
+class Fragment(object):
+  """Already encoded JSON, embedded verbatim by dumps"""
+  __slots__ = ['json']
+
+  def __init__(self, encoded):
+    self.json = encoded
+
+  def __json__(self):
+    # ujson embeds what this returns as is
+    return self.json
+
+def with_fragments(module, **options):
+  """dumps for a json-like module: fragments are encoded as marker strings
+  by the `default` hook and swapped for their JSON afterwards"""
+  def dumps(value):
+    fragments = []
+    marker = uuid.uuid4().hex
+    def default(obj):
+      if isinstance(obj, Fragment):
+        fragments.append(obj.json)
+        return "%s:%d" % (marker, len(fragments) - 1)
+      raise TypeError("%r is not JSON serializable" % obj)
+    encoded = module.dumps(value, default=default, separators=(',', ':'), **options)
+    if not fragments:
+      return encoded
+    return re.sub('"%s:(\\d+)"' % marker, lambda match: fragments[int(match.group(1))], encoded)
+  return dumps
+
+def embeds_fragments(dumps):
+  """Whether `dumps` embeds fragments rather than encoding them as
+  objects, which ujson versions without the __json__ hook do"""
+  try:
+    return dumps([Fragment('{"a":1}')]) == '[{"a":1}]'
+  except Exception:
+    return False
+
+def ujson_dumps(value):
+  return ujson.dumps(value, escape_forward_slashes=False)
+
+if ujson is not None and not embeds_fragments(ujson_dumps):
+  ujson = None
+
+ENCODERS = [('ujson',      ujson and ujson_dumps),
+            ('simplejson', simplejson and with_fragments(simplejson)),
+            ('json',       with_fragments(json))]
+
+def get_encoder(name):
+  for encoder, dumps in ENCODERS:
+    if dumps is not None and name in (encoder, "auto"):
+      return dumps
+  raise ValueError("JSON encoder %s is not available" % name)
+
+def dumps(value):
+  return get_encoder(app.config['JSON_ENCODER'])(value)
+
+fragment_cache = LRUCache(app.config['FRAGMENT_CACHE_SIZE'])
+
+# Anything with get(key) and set(key, value), e.g. a cache.SharedMemoryCache
+shared_cache = None
+
+def fragment_key(model, obj):
+  return "fragment:%s:%d:%s" % (model, obj.id, obj.fragment_version)
+
+def get_fragment(key):
+  fragment = fragment_cache.get(key)
+  if fragment is None and shared_cache is not None:
+    encoded = shared_cache.get(key)
+    if encoded is not None:
+      fragment = Fragment(encoded)
+      fragment_cache.set(key, fragment)
+  return fragment
+
+def set_fragment(key, fragment):
+  fragment_cache.set(key, fragment)
+  if shared_cache is not None:
+    shared_cache.set(key, fragment.json)
+
+##################################################
+# FRAGMENTS
+##################################################
+
+def songs(songs):
+  """Fragments of `songs`; only the uncached ones have their providers
+  looked up"""
+  fragments = dict((song.id, get_fragment(fragment_key("song", song))) for song in songs)
+  missing = [song for song in songs if fragments[song.id] is None]
+  for song, serialized in zip(missing, serialize_songs(missing)):
+    fragments[song.id] = Fragment(dumps(serialized))
+    set_fragment(fragment_key("song", song), fragments[song.id])
+  return [fragments[song.id] for song in songs]
+
+def blips(blips, included=None):
+  """Fragments of `blips` embedding their songs. Given an `included`
+  OrderedDict, the blips reference their songs by song_id instead and the
+  songs' fragments are added to it by id."""
+  song_ids = set(blip.song_id for blip in blips)
+  found = Song.query.filter(Song.id.in_(song_ids)).all() if song_ids else []
+  by_id = dict((song.id, song) for song in found)
+  song_fragments = dict(zip([song.id for song in found], songs(found)))
+  fragments = []
+  for blip in blips:
+    song = by_id[int(blip.song_id)]
+    if included is None:
+      key = fragment_key("blip", blip) + ":" + song.fragment_version
+    else:
+      key = fragment_key("blip", blip) + ":ref"
+      included.setdefault(song.id, song_fragments[song.id])
+    fragment = get_fragment(key)
+    if fragment is None:
+      if included is None:
+        serialized = blip.serialize_with(song_fragments[song.id])
+      else:
+        serialized = blip.serialize_with(None)
+        del serialized['song']
+        serialized['song_id'] = song.id
+      fragment = Fragment(dumps(serialized))
+      set_fragment(key, fragment)
+    fragments.append(fragment)
+  return fragments
+
+def comments(comments, included=None):
+  """Fragments of `comments` embedding their blips, as blips()"""
+  blip_ids = set(comment.blip_id for comment in comments)
+  found = Blip.query.filter(Blip.id.in_(blip_ids)).all() if blip_ids else []
+  blip_fragments = dict(zip([blip.id for blip in found], blips(found, included)))
+  return [Fragment(dumps(comment.serialize_with(blip_fragments[int(comment.blip_id)])))
+          for comment in comments]
+
+def thread(comments):
+  """Serialized `comments` of one blip, referencing it by blip_id"""
+  serialized = []
+  for comment in comments:
+    fields = comment.serialize_with(None)
+    del fields['blip']
+    fields['blip_id'] = int(comment.blip_id)
+    serialized.append(fields)
+  return serialized
@@ -0,0 +1,74 @@
+##################################################
+# PRODUCTION SERVER
+##################################################
+#
+#   python serve.py                   # gevent if installed, else threaded
+#   python serve.py --mode threaded --port 8000
+#
+# In gevent mode the standard library is monkey-patched before the app is
+# imported, so every blocking call (sockets, sleeps, locks and queues)
+# yields to other requests instead of holding a thread: Postgres queries
+# (through psycopg2 once psycogreen has made it cooperative), Echo Nest
+# lookups on the provider job queue and waits for a pooled connection. One
+# process serves up to SERVE_CONNECTIONS concurrent requests, each on a
+# greenlet. The sampling profiler follows OS threads, so it records nothing
+# in this mode.
+#
+# Threaded mode serves each request on its own thread with werkzeug, as
+# `python latitune.py` does but without the reloader and debugger.
+
+import os
+import sys
+import argparse
+
+def gevent_available():
+  try:
+    import gevent
+  except ImportError:
+    return False
+  return True
+
+def patch_gevent():
+  """Make blocking calls cooperative; must run before anything imports
+  socket, threading or psycopg2 for use"""
+  from gevent import monkey
+  monkey.patch_all()
+  try:
+    from psycogreen.gevent import patch_psycopg
+  except ImportError:
+    print "psycogreen is not installed: Postgres queries will block the process"
+  else:
+    patch_psycopg()
+
+def prepare(mode):
+  """Resolve mode "auto" and patch for gevent; runs before the app is
+  imported. Returns "gevent" or "threaded"."""
+  if mode == "auto":
+    mode = "gevent" if gevent_available() else "threaded"
+  if mode == "gevent":
+    patch_gevent()
+  return mode
+
+def main(argv):
+  parser = argparse.ArgumentParser(description="serve the latitune API")
+  parser.add_argument("--mode", choices=["auto", "gevent", "threaded"], default="auto")
+  parser.add_argument("--host", default="0.0.0.0")
+  parser.add_argument("--port", type=int, default=int(os.environ.get('PORT', 5000)))
+  args = parser.parse_args(argv)
+
+  mode = prepare(args.mode)
+  import latitune
+  app = latitune.create_app()
+  print "serving on %s:%d (%s)" % (args.host, args.port, mode)
+  sys.stdout.flush()
+  if mode == "gevent":
+    from gevent.pool import Pool
+    from gevent.pywsgi import WSGIServer
+    WSGIServer((args.host, args.port), app, spawn=Pool(app.config['SERVE_CONNECTIONS']),
+               log=None).serve_forever()
+  else:
+    from werkzeug.serving import run_simple
+    run_simple(args.host, args.port, app, threaded=True)
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
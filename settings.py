@@ -6,13 +6,7 @@ import os
 import sys
 from flask import Flask
 from flask_heroku import Heroku
-from flask.ext.sqlalchemy import SQLAlchemy
-import gdata.youtube
-import gdata.youtube.service
-from pyechonest import config
-
-yt_service = gdata.youtube.service.YouTubeService()
-yt_service.developer_key = 'AI39si4fdpqYBz4_a6E7choIqT5hIlYhbI4Ucp5eiXGDt5jzE46XM_KxWn5KtwdrAZp6WeMF9Jrzk-sXabs0R_F9T9MHZdiOYA'
+from database import LatituneSQLAlchemy
 
 echonest_api_key = "DUQVSZTKUIUQIMZXI"
 
@@ -23,8 +17,6 @@ echonest_shared_secret = "ILLKK9HORVm37YkaFfTP3w"
 rdio_api_key = "xya6sc2u4x73sgvsdtc8ef4k"
 rdio_shared_secret = "hs68psbjtH"
 
-config.ECHO_NEST_API_KEY=echonest_api_key
-
 
 app       = Flask (__name__)
 if os.environ.get('LATITUNE_LOCAL') == "true":
@@ -34,4 +26,84 @@ else:
   heroku    = Heroku(app)
 app.debug = True
 
-db        = SQLAlchemy (app)
+# Signs the auth tokens handed out by PUT /api/user/token; only a local
+# development server may run without one
+app.secret_key = os.environ.get('LATITUNE_SECRET_KEY')
+if not app.secret_key:
+  if os.environ.get('LATITUNE_LOCAL') != "true":
+    sys.exit("LATITUNE_SECRET_KEY must be set outside LATITUNE_LOCAL development")
+  app.secret_key = 'latitune development secret'
+app.config['AUTH_TOKEN_TTL'] = int(os.environ.get('LATITUNE_AUTH_TOKEN_TTL', 7 * 24 * 3600))
+
+# Background Echo Nest provider lookups (see providers.py). JOBS_EAGER runs
+# jobs inline, which is what the tests want.
+app.config['PROVIDER_WORKERS'] = int(os.environ.get('LATITUNE_PROVIDER_WORKERS', 4))
+app.config['PROVIDER_RETRIES'] = 3
+app.config['PROVIDER_BACKOFF'] = 2.0
+app.config['JOBS_EAGER']       = os.environ.get('LATITUNE_JOBS_EAGER') == "true"
+# Songs still pending this many seconds after their lookup was scheduled
+# lost it and are scheduled again, checked at most every SWEEP_INTERVAL
+app.config['PROVIDER_STALE_AFTER']   = 600
+app.config['PROVIDER_SWEEP_INTERVAL'] = 60
+
+# Echo Nest track lookups cached by echonest_id, optionally persisted to an
+# SQLite file that every worker reads and writes
+app.config['PROVIDER_CACHE_SIZE'] = 10000
+app.config['PROVIDER_CACHE_TTL']  = 7 * 24 * 3600
+app.config['PROVIDER_CACHE_PATH'] = os.environ.get('LATITUNE_PROVIDER_CACHE_PATH')
+
+# Rendered responses of hot GET endpoints, invalidated by the writes that
+# change them (see cached_response in controllers.py)
+app.config['RESPONSE_CACHE_ENABLED'] = True
+app.config['RESPONSE_CACHE_SIZE']    = 10000
+app.config['RESPONSE_CACHE_TTL']     = 300
+
+# Response encoding and the cache of encoded songs and blips (see serialization.py)
+app.config['JSON_ENCODER']        = os.environ.get('LATITUNE_JSON_ENCODER', 'auto')
+app.config['FRAGMENT_CACHE_SIZE'] = 50000
+
+# "memory" ranks nearest/radius blip queries in process with NumPy (see nearest.py)
+app.config['NEAREST_ENGINE']          = os.environ.get('LATITUNE_NEAREST_ENGINE', 'sql')
+app.config['NEAREST_SYNC_INTERVAL']   = 5
+app.config['NEAREST_RELOAD_INTERVAL'] = 600
+
+# Per-route timing histograms at GET /api/metrics, and sampled stacks of the
+# slowest requests at GET /api/metrics/profile (see instrumentation.py)
+app.config['INSTRUMENTATION_ENABLED'] = True
+app.config['PROFILE_ENABLED']         = os.environ.get('LATITUNE_PROFILE') == "true"
+app.config['PROFILE_INTERVAL']        = 0.005
+app.config['PROFILE_KEEP']            = 20
+# Both take ?metrics_token=LATITUNE_METRICS_TOKEN; without one set they are
+# only served with LATITUNE_LOCAL
+app.config['METRICS_TOKEN']           = os.environ.get('LATITUNE_METRICS_TOKEN')
+
+# Concurrent requests one serve.py process takes in gevent mode
+app.config['SERVE_CONNECTIONS'] = int(os.environ.get('LATITUNE_SERVE_CONNECTIONS', 1000))
+
+# prefork.py: worker processes, requests a worker serves before it is
+# replaced, seconds a stopping worker gets to finish its requests, and the
+# shared-memory cache the workers share (bytes, and bytes per entry)
+app.config['PREFORK_WORKERS']          = int(os.environ.get('WEB_CONCURRENCY', 0)) or None
+app.config['PREFORK_MAX_REQUESTS']     = int(os.environ.get('LATITUNE_MAX_REQUESTS', 10000))
+app.config['PREFORK_GRACEFUL_TIMEOUT'] = 30
+app.config['SHARED_CACHE_SIZE']        = 128 * 1024 * 1024
+app.config['SHARED_CACHE_SLOT_SIZE']   = 8192
+
+# GET /api/blip/live (see realtime.py): "auto", "local", a unix:// directory
+# or a redis:// URL; seconds between keepalives; events a slow stream may
+# fall behind by before it is closed
+app.config['LIVE_BROKER']     = os.environ.get('LATITUNE_LIVE_BROKER', 'auto')
+app.config['LIVE_KEEPALIVE']  = 15
+app.config['LIVE_QUEUE_SIZE'] = 100
+
+# Connection pool (see database.py); SQLite keeps Flask-SQLAlchemy's pools
+app.config['SQLALCHEMY_POOL_SIZE']     = int(os.environ.get('LATITUNE_DB_POOL_SIZE', 10))
+app.config['SQLALCHEMY_MAX_OVERFLOW']  = int(os.environ.get('LATITUNE_DB_MAX_OVERFLOW', 10))
+app.config['SQLALCHEMY_POOL_TIMEOUT']  = 10
+app.config['SQLALCHEMY_POOL_RECYCLE']  = 1800
+app.config['SQLALCHEMY_POOL_PRE_PING'] = True
+# GET requests read from this database when it is set
+if os.environ.get('LATITUNE_READ_REPLICA_URL'):
+  app.config['SQLALCHEMY_BINDS'] = {'replica': os.environ['LATITUNE_READ_REPLICA_URL']}
+
+db        = LatituneSQLAlchemy (app)
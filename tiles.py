@@ -0,0 +1,211 @@
+##################################################
+# TILE AGGREGATES
+##################################################
+#
+# Zoomed-out map views are served from per-tile summaries (blip count,
+# latest blip and most blipped songs) instead of raw blips. A tile is a
+# geohash cell, kept at every precision in TILE_PRECISIONS, so a viewport
+# costs one lookup of at most MAX_VIEWPORT_TILES tiles however many blips
+# it holds.
+#
+# New blips are folded into their tiles in the transaction that creates
+# them (record), which locks the tiles until it commits. Every blip in a
+# region touches the same coarse tiles (a precision 1 cell is ~5000km
+# across), so blip writes in a region are applied one at a time; see
+# `benchmarks.py ingest --writers` for what that costs.
+# rebuild() recomputes every tile from the blip table, binning with NumPy
+# when it is installed and in plain Python otherwise:
+#
+#   python latitune.py rebuild_tiles
+
+from settings import *
+from models import *
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# Geohash precisions tiles are kept at, ~5000km down to ~1.2km cells
+TILE_PRECISIONS = range(1, 7)
+
+# Songs listed per tile
+TILE_TOP_SONGS = 3
+
+# Tiles returned for one viewport; wider viewports get coarser tiles
+MAX_VIEWPORT_TILES = 64
+
+# Attempts record makes when a concurrent request creates the same tile
+RECORD_ATTEMPTS = 3
+
+def top_songs(songs):
+  """The TILE_TOP_SONGS most blipped of [(song_id, count)], ties to the
+  lowest song id"""
+  return sorted(songs, key=lambda song: (-song[1], song[0]))[:TILE_TOP_SONGS]
+
+def aggregate(blips):
+  """({cell: [count, latest]}, {(cell, song_id): count}) for an iterable of
+  (geohash, song_id, timestamp) at every tile precision"""
+  tiles = {}
+  songs = defaultdict(int)
+  for geohash, song_id, timestamp in blips:
+    for precision in TILE_PRECISIONS:
+      cell = geohash[:precision]
+      tile = tiles.get(cell)
+      if tile is None:
+        tiles[cell] = [1, timestamp]
+      else:
+        tile[0] += 1
+        tile[1] = max(tile[1], timestamp)
+      songs[(cell, song_id)] += 1
+  return tiles, songs
+
+def record(blips, write=None):
+  """Fold newly created (geohash, song_id, timestamp) blips into their tiles
+  in one transaction, with a fixed number of statements however many
+  tiles they touch. The touched tiles are locked while their song counts
+  and top songs are updated; as counts only grow, merging the changed songs
+  into the stored top songs keeps them exact.
+
+  `write`, if given, is called first in the same transaction to insert the
+  blips themselves, so the blips and their tiles are committed together or
+  not at all. It is called again on every attempt."""
+  tiles, songs = aggregate(blips)
+  for attempt in range(RECORD_ATTEMPTS):
+    try:
+      if write is not None:
+        write()
+      if not tiles:
+        db.session.commit()
+        return
+      # Rows are locked, and new ones inserted, in cell order, so that
+      # overlapping writes wait for each other instead of deadlocking
+      existing = dict((row.cell, row) for row in db.session.query(
+        Tile.cell, Tile.latest, Tile.top_songs).filter(Tile.cell.in_(tiles.keys()))
+        .order_by(Tile.cell).with_lockmode('update'))
+      counts = dict(((row.cell, row.song_id), row.count) for row in db.session.query(
+        TileSong.cell, TileSong.song_id, TileSong.count).filter(
+          TileSong.cell.in_(tiles.keys()),
+          TileSong.song_id.in_(set(song_id for cell, song_id in songs))))
+
+      changed = defaultdict(dict)
+      new_songs, song_updates = [], []
+      for (cell, song_id), count in sorted(songs.items()):
+        changed[cell][song_id] = counts.get((cell, song_id), 0) + count
+        if (cell, song_id) in counts:
+          song_updates.append({'tile_cell': cell, 'tile_song': song_id, 'added': count})
+        else:
+          new_songs.append({'cell': cell, 'song_id': song_id, 'count': count})
+
+      new_tiles, tile_updates = [], []
+      for cell, (count, latest) in sorted(tiles.items()):
+        tile = existing.get(cell)
+        top = dict(Tile.decode_top(tile.top_songs) if tile else [])
+        top.update(changed[cell])
+        top = Tile.encode_top(top_songs(top.items()))
+        if tile is None:
+          new_tiles.append({'cell': cell, 'count': count, 'latest': latest, 'top_songs': top})
+        else:
+          tile_updates.append({'tile_cell': cell, 'added': count, 'new_top': top,
+                               'new_latest': max(tile.latest, latest) if tile.latest else latest})
+
+      tile_table, song_table = Tile.__table__, TileSong.__table__
+      if new_tiles:
+        db.session.execute(tile_table.insert(), new_tiles)
+      if tile_updates:
+        db.session.execute(tile_table.update()
+                           .where(tile_table.c.cell == db.bindparam('tile_cell'))
+                           .values(count=tile_table.c.count + db.bindparam('added'),
+                                   latest=db.bindparam('new_latest'),
+                                   top_songs=db.bindparam('new_top')), tile_updates)
+      if new_songs:
+        db.session.execute(song_table.insert(), new_songs)
+      if song_updates:
+        db.session.execute(song_table.update()
+                           .where(db.and_(song_table.c.cell == db.bindparam('tile_cell'),
+                                          song_table.c.song_id == db.bindparam('tile_song')))
+                           .values(count=song_table.c.count + db.bindparam('added')), song_updates)
+      db.session.commit()
+      return
+    except IntegrityError:
+      db.session.rollback()
+  raise IntegrityError("tile record", None, None)
+
+def viewport(box, precision=None):
+  """(precision, tiles) for a (south, west, north, east) box, at the given
+  precision or the finest one that covers it with MAX_VIEWPORT_TILES tiles"""
+  if precision is None:
+    cells = geo.cover(box, MAX_VIEWPORT_TILES, max(TILE_PRECISIONS))
+  else:
+    precision = max(min(precision, max(TILE_PRECISIONS)), min(TILE_PRECISIONS))
+    cells = geo.cover(box, MAX_VIEWPORT_TILES, precision)
+  precision = len(cells[0])
+  return precision, Tile.query.filter(Tile.cell.in_(cells)).order_by(Tile.cell).all()
+
+##################################################
+# BULK REBUILD
+##################################################
+
+def rebuild(bind=None):
+  """Recompute every tile from the blip table. `bind` is the session
+  (default) or a connection to run in; a session is committed."""
+  bind = bind or db.session
+  blips = Blip.__table__
+  rows = bind.execute(db.select([blips.c.geohash, blips.c.song_id, blips.c.timestamp]).where(
+    db.and_(blips.c.geohash != None, blips.c.song_id != None, blips.c.timestamp != None))).fetchall()
+  tiles, songs = (bin_numpy if numpy is not None else bin_python)(rows)
+  bind.execute(TileSong.__table__.delete())
+  bind.execute(Tile.__table__.delete())
+  if tiles:
+    bind.execute(Tile.__table__.insert(), [
+      {'cell': cell, 'count': count, 'latest': latest,
+       'top_songs': Tile.encode_top(top)}
+      for cell, (count, latest, top) in tiles.items()])
+    bind.execute(TileSong.__table__.insert(), [
+      {'cell': cell, 'song_id': song_id, 'count': count}
+      for (cell, song_id), count in songs.items()])
+  if bind is db.session:
+    db.session.commit()
+
+def bin_python(rows):
+  """({cell: (count, latest, top songs)}, {(cell, song_id): count}) for
+  (geohash, song_id, timestamp) rows"""
+  tiles, songs = aggregate(rows)
+  tops = defaultdict(list)
+  for (cell, song_id), count in songs.items():
+    tops[cell].append((song_id, count))
+  return (dict((cell, (count, latest, top_songs(tops[cell])))
+               for cell, (count, latest) in tiles.items()), dict(songs))
+
+def bin_numpy(rows):
+  """bin_python, binning each precision with array operations"""
+  tiles, songs = {}, {}
+  if not rows:
+    return tiles, songs
+  geohashes = numpy.array([str(row[0]) for row in rows], dtype='S%d' % geo.GEOHASH_PRECISION)
+  song_ids  = numpy.array([row[1] for row in rows], dtype=numpy.int64)
+  # Only orders the timestamps; the latest one is read back from its row
+  stamps    = numpy.array([(row[2] - datetime(1970, 1, 1)).total_seconds() for row in rows])
+  span      = song_ids.max() + 1
+  for precision in TILE_PRECISIONS:
+    cells, tile_of = numpy.unique(geohashes.astype('S%d' % precision), return_inverse=True)
+    counts = numpy.bincount(tile_of, minlength=len(cells))
+
+    by_time = numpy.lexsort((stamps, tile_of))
+    latest = by_time[numpy.searchsorted(tile_of[by_time], numpy.arange(len(cells)), side='right') - 1]
+
+    pairs, pair_of = numpy.unique(tile_of * span + song_ids, return_inverse=True)
+    pair_counts = numpy.bincount(pair_of, minlength=len(pairs))
+    pair_tile, pair_song = pairs // span, pairs % span
+    ranked = numpy.lexsort((pair_song, -pair_counts, pair_tile))
+    rank = numpy.arange(len(ranked)) - numpy.searchsorted(pair_tile[ranked], pair_tile[ranked])
+    tops = defaultdict(list)
+    for index in ranked[rank < TILE_TOP_SONGS]:
+      tops[int(pair_tile[index])].append((int(pair_song[index]), int(pair_counts[index])))
+
+    cells = [str(cell) for cell in cells]
+    for index, cell in enumerate(cells):
+      tiles[cell] = (int(counts[index]), rows[latest[index]][2], tops[index])
+    for index in xrange(len(pairs)):
+      songs[(cells[pair_tile[index]], int(pair_song[index]))] = int(pair_counts[index])
+  return tiles, songs